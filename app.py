@@ -1,10 +1,17 @@
 import streamlit as st
+import streamlit.components.v1 as components
 
 from components.main_col import main_col
 from components.side_col import side_col
+from utils.session_store import create_session_store, is_session_id, new_session_id
 from utils.snowflake import SnowflakeConnector
 from utils.styles import init_styles
-from utils.video_details import get_video_transcript
+from utils.video_registry import create_video_registry
+
+# Browser cookie holding the chat session ID
+SESSION_COOKIE = 'PROFESSOR_PROMPT_SESSION'
+# How long the cookie lasts when chats never expire
+SESSION_COOKIE_MAX_AGE_SECONDS = 365 * 24 * 3600
 
 # Load secrets
 page_title = st.secrets['app']['page_title']
@@ -17,17 +24,67 @@ def load_snowflake():
 	return SnowflakeConnector(st.secrets)
 
 
+# Shared by every session. It caches each video's transcript and index itself, with a
+# memory cap, see utils/video_registry.py.
+@st.cache_resource
+def load_video_registry():
+	video_registry = create_video_registry(st.secrets)
+	load_snowflake().telemetry.watch_stats(
+		'video_registry', video_registry.stats, 'Videos and transcripts held in memory.'
+	)
+	return video_registry
+
+
+# Chats live here rather than in st.session_state, so any replica can serve the next
+# question and a restarted one doesn't lose them, see utils/session_store.py.
+@st.cache_resource
+def load_session_store():
+	return create_session_store(st.secrets.get('sessions', {}))
+
+
+# The chat session ID is kept in a cookie so it follows the browser to whichever replica
+# handles its next page load, without ending up in links people share. Cookies are only
+# read when a session starts, so the ID is also kept in session state for this one.
+def load_session_id():
+	if 'chat_session_id' not in st.session_state:
+		session_id = st.context.cookies.get(SESSION_COOKIE)
+		st.session_state.chat_session_id = (
+			session_id if is_session_id(session_id) else new_session_id()
+		)
+
+	return st.session_state.chat_session_id
+
+
+# Streamlit can't set cookies from Python, so a script in a zero height component sets it
+# on the app's page, just like the disclaimer cookie in components/main_col.py
+def save_session_cookie(session_id, max_age_seconds):
+	if st.context.cookies.get(SESSION_COOKIE) == session_id:
+		return
+
+	components.html(
+		f"""
+		<script>
+			window.parent.document.cookie =
+				"{SESSION_COOKIE}={session_id}; path=/; max-age={max_age_seconds}; SameSite=Strict";
+		</script>
+		""",
+		height=0,
+	)
+
+
 # I would love to cache this result with st.cache_resource, but
 # for some reason that causes the entire app to duplicate itself, then remove
 # the original UI and then not load the video again. No idea why.
+# The video is picked with ?video=<key>, or the default video without it.
 def load_video_details():
-	return {
-		'video_tags': st.secrets['mux']['video_tags'],
-		'video_transcript': get_video_transcript(
-			st.secrets['mux']['playback_id'],
-			st.secrets['mux']['track_id'],
-		),
-	}
+	video_registry = load_video_registry()
+	video_key = st.query_params.get('video')
+
+	if video_key is not None and video_key not in video_registry:
+		st.error(f'Unknown video "{video_key}".')
+		st.stop()
+
+	return video_registry.get(video_key)
 
 
 def main():
@@ -40,6 +97,11 @@ def main():
 	# Load video details
 	video_details = load_video_details()
 
+	# Each video has its own chat in the session
+	session_store = load_session_store()
+	session_id = load_session_id()
+	chat_session_id = f'{session_id}:{video_details["key"]}'
+
 	# Create two columns with 65/35 ratio
 	main_col_container, side_col_container = st.columns([0.6, 0.3])
 
@@ -48,11 +110,13 @@ def main():
 
 	# Main section
 	with main_col_container:
-		main_col()
+		main_col(video_details)
 
 	# Side section - Chat interface
 	with side_col_container:
-		side_col(snowflake, video_details)
+		side_col(snowflake, video_details, session_store, chat_session_id)
+
+	save_session_cookie(session_id, session_store.ttl_seconds or SESSION_COOKIE_MAX_AGE_SECONDS)
 
 
 if __name__ == '__main__':
@@ -3,11 +3,10 @@ import streamlit as st
 from utils.gen_simple_component import gen_simple_component
 
 
-def main_col():
-	# Load env vars
-	mux_playback_id = st.secrets['mux']['playback_id']
-	mux_video_title = st.secrets['mux']['video_title']
-	mux_video_description = st.secrets['mux']['video_description']
+def main_col(video_details):
+	mux_playback_id = video_details['playback_id']
+	mux_video_title = video_details['video_title']
+	mux_video_description = video_details['video_description']
 	primary_color = st.get_option('theme.primaryColor')
 
 	# -----------------------------------------
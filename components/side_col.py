@@ -1,5 +1,7 @@
 import streamlit as st
 
+from utils.snowflake import COACH_BUSY_MESSAGE
+
 COACH_RUNNING_LABEL = 'The professor is thinking...'
 COACH_COMPLETE_LABEL = 'Professor Prompt is waiting for your next question.'
 COACH_ERROR_LABEL = 'An error occurred. Please try again.'
@@ -13,10 +15,9 @@ def update_status(status_widget, new_status, new_state):
 	status_widget.update(label=new_status, state=new_state, expanded=False)
 
 
-def side_col(snowflake, video_details):
-	# Initialize chat history in session state if it doesn't exist
-	if 'messages' not in st.session_state:
-		st.session_state.messages = []
+def side_col(snowflake, video_details, session_store, chat_session_id):
+	# Load chat history from the session store, it may have been written by another replica
+	messages = session_store.messages(chat_session_id)
 
 	# Initialize status and state in session state if they don't exist
 	if 'status' not in st.session_state:
@@ -27,11 +28,12 @@ def side_col(snowflake, video_details):
 	# Display chat history
 	# Create a container with 100% height and scrollable contents
 	# height is managed with custom styles in lib/styles.py
-	with st.container(key='chat-container', height=100):
-		if len(st.session_state.messages) == 0:
+	chat_container = st.container(key='chat-container', height=100)
+	with chat_container:
+		if len(messages) == 0:
 			st.write(MESSAGES_PLACEHOLDER)
 
-		for message in st.session_state.messages:
+		for message in messages:
 			with st.chat_message(message['role']):
 				st.markdown(message['content'])
 
@@ -47,27 +49,48 @@ def side_col(snowflake, video_details):
 		update_status(status_widget, COACH_RUNNING_LABEL, 'running')
 
 		try:
-			formatted_prompt, reference_urls = snowflake.generate_coach_prompt(
+			response_chunks, reference_urls = snowflake.stream_coach_answer(
+				video_details['video_id'],
 				video_details['video_tags'],
-				video_details['video_transcript'],
+				video_details['transcript_index'],
 				st.session_state.mux_player_time,  # This comes from the main_col.py file
 				prompt,
-				st.session_state.messages,
-			)
-
-			response = response = snowflake.query_cortex_chat(formatted_prompt)
-
-			response = (
-				response + '\n\n**References:**\n\n' + '\n- '.join([''] + list(reference_urls))
+				messages,
+				video_details['search_filter'],
 			)
 
-			# Add user message to chat history
-			st.session_state.messages.append({'role': 'user', 'content': prompt})
-
-			# Add assistant response to chat history
-			st.session_state.messages.append({'role': 'assistant', 'content': response})
-
-			update_status(status_widget, COACH_COMPLETE_LABEL, 'complete')
+			answer_chunks = []
+
+			def stream_with_references():
+				for chunk in response_chunks:
+					answer_chunks.append(chunk)
+					yield chunk
+
+				# A busy coach didn't answer, so there's nothing to reference
+				if ''.join(answer_chunks) != COACH_BUSY_MESSAGE:
+					yield '\n\n**References:**\n\n' + '\n- '.join([''] + list(reference_urls))
+
+			# Render the answer as it comes in, it's saved to the chat history once complete
+			with chat_container:
+				with st.chat_message('user'):
+					st.markdown(prompt)
+
+				with st.chat_message('assistant'):
+					response = st.write_stream(stream_with_references())
+
+			# The busy message isn't an answer, it stays out of the chat history (and so out
+			# of later prompts) and is left in the status widget instead
+			if ''.join(answer_chunks) == COACH_BUSY_MESSAGE:
+				update_status(status_widget, COACH_BUSY_MESSAGE, 'error')
+			else:
+				session_store.append(
+					chat_session_id,
+					[
+						{'role': 'user', 'content': prompt},
+						{'role': 'assistant', 'content': response},
+					],
+				)
+				update_status(status_widget, COACH_COMPLETE_LABEL, 'complete')
 
 		except Exception as e:
 			update_status(status_widget, COACH_ERROR_LABEL, 'error')
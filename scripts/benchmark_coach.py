@@ -0,0 +1,314 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+
+import toml
+
+root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(root_path)
+
+from utils.chunking import CHARS_PER_TOKEN  # noqa: E402
+from utils.snowflake import SnowflakeConnector  # noqa: E402
+from utils.stand_in import CortexStandIn, create_stand_in_server  # noqa: E402
+from utils.system_prompts import COACH_SYSTEM_PROMPT  # noqa: E402
+from utils.transcript_index import TranscriptIndex  # noqa: E402
+
+BENCHMARKS_PATH = os.path.join(root_path, 'benchmarks')
+STAGES = ('prompt_assembly', 'enhancer', 'search', 'completion', 'post_processing', 'turn')
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, p):
+	if not sorted_values:
+		return None
+
+	# Linear interpolation between the closest ranks
+	rank = (len(sorted_values) - 1) * p / 100
+	lower = int(rank)
+	upper = min(lower + 1, len(sorted_values) - 1)
+	return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+def summarize(values, scale=1):
+	values = sorted(value * scale for value in values)
+	summary = {'count': len(values)}
+	if values:
+		summary['mean'] = round(sum(values) / len(values), 3)
+		summary.update({f'p{p}': round(percentile(values, p), 3) for p in PERCENTILES})
+		summary['max'] = round(values[-1], 3)
+	return summary
+
+
+# Collects per stage timings. Enhancer and search run on the connector's pipeline
+# threads, so their samples go straight into the shared lists. The rest is measured
+# on the thread running the turn and kept in `local` until the turn is recorded.
+class StageRecorder:
+	def __init__(self):
+		self.samples = {stage: [] for stage in STAGES}
+		self.prompt_bytes = []
+		self.prompt_tokens = []
+		self.errors = 0
+		self.local = threading.local()
+		self._lock = threading.Lock()
+
+	def add(self, stage, seconds):
+		with self._lock:
+			self.samples[stage].append(seconds)
+
+	def add_turn(self, prompt_bytes, prompt_tokens):
+		with self._lock:
+			self.prompt_bytes.append(prompt_bytes)
+			self.prompt_tokens.append(prompt_tokens)
+
+	def add_error(self):
+		with self._lock:
+			self.errors += 1
+
+	def results(self):
+		return {
+			'stages_ms': {
+				stage: summarize(samples, 1000) for stage, samples in self.samples.items()
+			},
+			'prompt_bytes': summarize(self.prompt_bytes),
+			'prompt_tokens': summarize(self.prompt_tokens),
+			'errors': self.errors,
+		}
+
+
+# Wraps the connector's stage methods on this instance only, so the benchmark measures
+# the real code paths without the connector knowing about it
+def instrument(snowflake, recorder):
+	def timed(method, stage):
+		def wrapper(*args, **kwargs):
+			started = time.perf_counter()
+			try:
+				return method(*args, **kwargs)
+			finally:
+				recorder.add(stage, time.perf_counter() - started)
+
+		return wrapper
+
+	snowflake._enhance_query = timed(snowflake._enhance_query, 'enhancer')
+	snowflake._search_knowledge_base = timed(snowflake._search_knowledge_base, 'search')
+
+	wait_for_stage = snowflake._wait_for_stage
+	cortex_complete = snowflake._cortex_complete
+
+	# Time spent waiting on the enhancer and searches isn't prompt assembly
+	def timed_wait_for_stage(*args, **kwargs):
+		started = time.perf_counter()
+		try:
+			return wait_for_stage(*args, **kwargs)
+		finally:
+			recorder.local.waited += time.perf_counter() - started
+
+	def timed_cortex_complete(messages, *args, **kwargs):
+		started = time.perf_counter()
+		result = cortex_complete(messages, *args, **kwargs)
+
+		if messages[0]['content'] == COACH_SYSTEM_PROMPT:
+			recorder.local.completion = time.perf_counter() - started
+			recorder.local.usage = result.get('usage', {})
+
+		return result
+
+	snowflake._wait_for_stage = timed_wait_for_stage
+	snowflake._cortex_complete = timed_cortex_complete
+
+
+def clear_caches(snowflake):
+	for cache in (snowflake.answer_cache, snowflake.enhancer_cache, snowflake.search_cache):
+		cache.clear()
+
+
+def run_turn(snowflake, recorder, data, transcript_index, question):
+	recorder.local.waited = 0.0
+	recorder.local.completion = 0.0
+	recorder.local.usage = {}
+
+	try:
+		started = time.perf_counter()
+		prompt, _ = snowflake.generate_coach_prompt(
+			data['video_tags'],
+			transcript_index,
+			question['user_timestamp'],
+			question['user_question'],
+			[],
+		)
+		prompt_ready = time.perf_counter()
+
+		snowflake.query_cortex_chat(prompt)
+		finished = time.perf_counter()
+	except Exception as e:
+		print(f'Error answering "{question["user_question"]}": {e}')
+		recorder.add_error()
+		return
+
+	recorder.add('prompt_assembly', prompt_ready - started - recorder.local.waited)
+	recorder.add('completion', recorder.local.completion)
+	recorder.add('post_processing', finished - prompt_ready - recorder.local.completion)
+	recorder.add('turn', finished - started)
+	recorder.add_turn(
+		len(prompt.encode()),
+		recorder.local.usage.get('prompt_tokens')
+		or (len(COACH_SYSTEM_PROMPT) + len(prompt)) // CHARS_PER_TOKEN,
+	)
+
+
+def compare_to_baseline(results, baseline, max_regression):
+	regressions = []
+	print(
+		f'{"stage":<16}{"p50 ms":>12}{"baseline":>12}{"p95 ms":>12}{"baseline":>12}{"change":>10}'
+	)
+
+	for stage in STAGES:
+		current = results['stages_ms'].get(stage, {})
+		previous = baseline['stages_ms'].get(stage, {})
+		if not current.get('count') or not previous.get('count'):
+			continue
+
+		change = (current['p95'] - previous['p95']) / previous['p95'] if previous['p95'] else 0.0
+		print(
+			f'{stage:<16}{current["p50"]:>12.1f}{previous["p50"]:>12.1f}'
+			f'{current["p95"]:>12.1f}{previous["p95"]:>12.1f}{change:>+10.1%}'
+		)
+
+		if max_regression is not None and change > max_regression:
+			regressions.append(stage)
+
+	return regressions
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(
+		description='Benchmark the coach pipeline stage by stage over a fixed question set.'
+	)
+	parser.add_argument(
+		'--questions', default=os.path.join(BENCHMARKS_PATH, 'coach_questions.json')
+	)
+	parser.add_argument('--secrets', default=os.path.join(root_path, '.streamlit', 'secrets.toml'))
+	parser.add_argument(
+		'--stand-in',
+		action='store_true',
+		help='Run against an in-process Cortex stand-in (see scripts/stand_in_server.py).',
+	)
+	parser.add_argument('--seed', type=int, default=0, help='Seed for the stand-in.')
+	parser.add_argument('--search-engine', choices=['cortex', 'local'], help='Override [search].')
+	parser.add_argument('--repeats', type=int, default=3, help='Passes over the question set.')
+	parser.add_argument('--concurrency', type=int, default=1, help='Turns run at once.')
+	parser.add_argument(
+		'--warm-caches',
+		action='store_true',
+		help='Keep the answer, enhancer and search caches between passes.',
+	)
+	parser.add_argument('--label', default='coach', help='Name for the results file.')
+	parser.add_argument('--output', help='Where to save the results JSON.')
+	parser.add_argument('--baseline', help='Results JSON of an earlier run to compare against.')
+	parser.add_argument(
+		'--max-regression',
+		type=float,
+		help='Exit with an error if any stage p95 is this much slower than the baseline (0.2 = 20%%).',
+	)
+	return parser.parse_args()
+
+
+def main():
+	args = parse_args()
+
+	with open(args.questions) as f:
+		data = json.load(f)
+
+	secrets = {}
+	if os.path.exists(args.secrets):
+		with open(args.secrets) as f:
+			secrets = toml.load(f)
+
+	stand_in_server = None
+	if args.stand_in:
+		stand_in_server = create_stand_in_server(CortexStandIn(seed=args.seed), port=0)
+		threading.Thread(target=stand_in_server.serve_forever, daemon=True).start()
+
+		snowflake_config = secrets.setdefault('snowflake', {})
+		snowflake_config['stand_in_url'] = f'http://127.0.0.1:{stand_in_server.server_port}'
+		for key, value in {
+			'database': 'DB',
+			'schema': 'SCHEMA',
+			'cortex_search_name': 'KB',
+		}.items():
+			snowflake_config.setdefault(key, value)
+
+	if args.search_engine:
+		secrets.setdefault('search', {})['engine'] = args.search_engine
+
+	snowflake = SnowflakeConnector(secrets)
+	recorder = StageRecorder()
+	instrument(snowflake, recorder)
+	transcript_index = TranscriptIndex(data['transcript'])
+	questions = data['questions'] * args.repeats
+
+	print(f'Running {len(questions)} turns, {args.concurrency} at a time...')
+	started = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+		for _ in range(args.repeats):
+			# Caches are cleared between passes, not turns, so concurrent turns never
+			# clear them under each other. Each question is only asked once per pass.
+			if not args.warm_caches:
+				clear_caches(snowflake)
+
+			wait(
+				[
+					executor.submit(run_turn, snowflake, recorder, data, transcript_index, question)
+					for question in data['questions']
+				]
+			)
+	elapsed = time.perf_counter() - started
+
+	results = {
+		'label': args.label,
+		'created': datetime.now().isoformat(timespec='seconds'),
+		'config': {
+			'backend': 'stand-in' if args.stand_in else 'snowflake',
+			'search_engine': secrets.get('search', {}).get('engine', 'cortex'),
+			'questions': len(data['questions']),
+			'repeats': args.repeats,
+			'concurrency': args.concurrency,
+			'warm_caches': args.warm_caches,
+			'seed': args.seed if args.stand_in else None,
+		},
+		'elapsed_seconds': round(elapsed, 3),
+		'turns_per_second': round(len(questions) / elapsed, 3) if elapsed else None,
+		**recorder.results(),
+	}
+
+	output = args.output or os.path.join(
+		BENCHMARKS_PATH, 'results', f'{args.label}-{datetime.now():%Y%m%d-%H%M%S}.json'
+	)
+	os.makedirs(os.path.dirname(output), exist_ok=True)
+	with open(output, 'w') as f:
+		json.dump(results, f, indent=2)
+
+	print(json.dumps(results['stages_ms'], indent=2))
+	print(f'Results saved to {output}')
+
+	if stand_in_server:
+		stand_in_server.shutdown()
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+
+		regressions = compare_to_baseline(results, baseline, args.max_regression)
+		if regressions:
+			print(
+				f'p95 regressed by more than {args.max_regression:.0%} in: {", ".join(regressions)}'
+			)
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -1,18 +1,25 @@
-import hashlib
+import argparse
 import json
 import os
-import pathlib
 import sys
 from pprint import pprint
 
 import toml
-import wikipedia
 
 root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(root_path)
 
+from utils.chunking import create_chunker  # noqa: E402
+from utils.dedup import NearDuplicateIndex  # noqa: E402
+from utils.kb_checkpoint import KB_STAGES, KBCheckpoint, hash_input  # noqa: E402
+from utils.kb_writers import (  # noqa: E402
+	JSONObjectStreamWriter,
+	get_kb_output_format,
+)
+from utils.pipeline import Pipeline, PipelineError  # noqa: E402
 from utils.snowflake import SnowflakeConnector  # noqa: E402
 from utils.video_details import get_video_transcript  # noqa: E402
+from utils.wiki_harvester import WIKIPEDIA_API_URL, WikipediaHarvester  # noqa: E402
 
 
 def load_secrets(file_path):
@@ -23,128 +30,268 @@ def load_secrets(file_path):
 def get_transcript(secrets):
 	playback_id = secrets['mux']['playback_id']
 	track_id = secrets['mux']['track_id']
-	return json.loads(get_video_transcript(playback_id, track_id))
+	return get_video_transcript(playback_id, track_id)
 
 
-def search_wikipedia_and_populate_dict(snowflake, keywords):
-	pages_dict = {}
-	failed_pages = []
-	results_per_search = 5
-
-	for keyword in keywords:
-		print(f'Searching Wikipedia for keyword: {keyword}')
-		search_results = [
-			result
-			for result in wikipedia.search(keyword, results=results_per_search, suggestion=False)
-			if '(disambiguation)' not in result
-		]
-		print(f'Found {len(search_results)} results for keyword: {keyword}: {search_results}')
-
-		for title in search_results:
-			print(f'Processing result: {title}')
-			try:
-				wiki_page = wikipedia.page(title, auto_suggest=False)
-				wiki_page_summary = wikipedia.summary(title, auto_suggest=False)
-			except wikipedia.exceptions.DisambiguationError:
-				print(f'DisambiguationError for result: {title}')
-				failed_pages.append({'title': title, 'error': 'DisambiguationError'})
-				continue
-			except wikipedia.exceptions.PageError:
-				print(f'PageError for result: {title}')
-				failed_pages.append({'title': title, 'error': 'PageError'})
-				continue
+def create_harvester(kb_config):
+	return WikipediaHarvester(
+		api_url=kb_config.get('wikipedia_api_url', WIKIPEDIA_API_URL),
+		requests_per_second=kb_config.get('wikipedia_requests_per_second', 5),
+		burst=kb_config.get('wikipedia_burst'),
+		max_workers=kb_config.get('harvest_max_workers', 8),
+	)
+
+
+def tag_page(snowflake, keywords, page_summary):
+	page_tags_str = snowflake.tag_page_with_cortex(keywords, page_summary)
+	return [tag.strip() for tag in page_tags_str.split(',') if tag.strip()]
+
+
+def tag_page_batch(snowflake, keywords, page_summaries):
+	# A single page isn't worth the batch prompt
+	if len(page_summaries) == 1:
+		tags_by_page = {}
+	else:
+		tags_by_page = snowflake.tag_pages_with_cortex(keywords, page_summaries)
+
+	# Anything the batch call didn't tag gets tagged on its own
+	for page_hash, page_summary in page_summaries.items():
+		if page_hash not in tags_by_page:
+			tags_by_page[page_hash] = tag_page(snowflake, keywords, page_summary)
+
+	return tags_by_page
 
-			page_content = f'{wiki_page.title}\n{wiki_page.content}'
-			page_hash = hashlib.sha256(page_content.encode()).hexdigest()
-
-			print('generating page tags...')
-			page_tags_str = snowflake.tag_page_with_cortex(keywords, wiki_page_summary)
-			page_tags = [tag.strip() for tag in page_tags_str.split(',')]
-			print('page tagged with:', page_tags)
-
-			try:
-				pages_dict[page_hash] = {
-					'page_content': page_content,
-					'page_summary': wiki_page_summary,
-					'images': wiki_page.images,
-					'page_url': wiki_page.url,
-					'page_tags': page_tags,
-				}
-			except Exception as e:
-				print(f'Unexpected error building dict for result: {title}')
-				failed_pages.append({'title': title, 'error': e.__str__()})
+
+# Tags a list of (page hash, page info) pairs in place and returns it. Pages already
+# tagged with the same keywords in the checkpoint aren't tagged again, the rest are
+# tagged with one Cortex call (see tag_page_batch) and recorded in the checkpoint.
+def tag_page_list(snowflake, keywords, pages, checkpoint=None):
+	keywords_hash = hash_input(keywords)
+	page_summaries = {}
+
+	for page_hash, page_info in pages:
+		tagged = checkpoint.get('tag', page_hash) if checkpoint else None
+
+		if tagged and tagged['keywords_hash'] == keywords_hash:
+			page_info['page_tags'] = tagged['page_tags']
+		else:
+			page_summaries[page_hash] = page_info['page_summary']
+
+	if page_summaries:
+		tags_by_page = tag_page_batch(snowflake, keywords, page_summaries)
+
+		for page_hash, page_info in pages:
+			if page_hash not in tags_by_page:
 				continue
 
-			print(f'Added page {wiki_page.title} to dictionary with hash: {page_hash}')
+			page_info['page_tags'] = tags_by_page[page_hash]
+			print(f'Page {page_hash} tagged with:', page_info['page_tags'])
 
-	return pages_dict, failed_pages
+			if checkpoint:
+				checkpoint.record(
+					'tag',
+					page_hash,
+					{'keywords_hash': keywords_hash, 'page_tags': page_info['page_tags']},
+				)
 
+	return pages
 
-def convert_pages_to_kb_format(pages_dict):
-	knowledge_base_data = []
+
+def page_to_kb_entries(page_hash, page_info, chunker):
 	source = 'Wikipedia'
-	chunk_size = 200
-	overlap = 10
-
-	for page_hash, page_info in pages_dict.items():
-		page_content = page_info['page_content']
-		page_summary = page_info['page_summary']
-		images = page_info['images']
-		page_url = page_info['page_url']
-		page_tags = page_info['page_tags']
-
-		# Chunk page content into chunks of `chunk_size` words each with `overlap`
-		words = page_content.split()
-		chunks = []
-		for i in range(0, len(words), chunk_size - overlap):
-			chunk = ' '.join(words[i : i + chunk_size])
-			chunks.append(chunk)
-
-		for chunk in chunks:
-			knowledge_base_data.append(
-				{
-					'SOURCE': source,
-					'SOURCE_ID': page_hash,
-					'CHUNK_TEXT': chunk,
-					'TAGS': page_tags,
-					'REFERENCE_URL': page_url,
-					'prompt': None,  # set this if you want to enhance the chunks, but get a tea cause it's gunna be awhile
-				}
-			)
 
-		# Add entries for images
-		for image_url in images:
-			knowledge_base_data.append(
-				{
-					'SOURCE': source,
-					'SOURCE_ID': page_hash,
-					'CHUNK_TEXT': image_url,
-					'TAGS': page_tags,
-					'REFERENCE_URL': page_url,
-					'prompt': f'Provide the best possible description of what this image is based on the filename and provided context. Context: {page_summary}',
-				}
+	page_content = page_info['page_content']
+	page_summary = page_info['page_summary']
+	images = page_info['images']
+	page_url = page_info['page_url']
+	page_tags = page_info['page_tags']
+
+	# Chunk page content with the configured chunker (see utils/chunking.py)
+	for chunk_index, chunk_text in enumerate(chunker.split(page_content)):
+		yield {
+			'CHECKPOINT_KEY': f'{page_hash}:{chunk_index}',
+			'SOURCE': source,
+			'SOURCE_ID': page_hash,
+			'CHUNK_TEXT': chunk_text,
+			'TAGS': page_tags,
+			'REFERENCE_URL': page_url,
+			'prompt': None,  # set this if you want to enhance the chunks, but get a tea cause it's gunna be awhile
+		}
+
+	# Add entries for images
+	for image_index, image_url in enumerate(images):
+		yield {
+			'CHECKPOINT_KEY': f'{page_hash}:image-{image_index}',
+			'SOURCE': source,
+			'SOURCE_ID': page_hash,
+			'CHUNK_TEXT': image_url,
+			'TAGS': page_tags,
+			'REFERENCE_URL': page_url,
+			'prompt': f'Provide the best possible description of what this image is based on the filename and provided context. Context: {page_summary}',
+		}
+
+
+# The whole build as one streaming pipeline: fetch -> tag -> chunk -> transform -> write.
+# Stages are connected by bounded queues so only a handful of pages and chunks are in
+# memory at any time, whatever the size of the corpus, and a slow stage (usually Cortex)
+# holds back the ones before it instead of letting work pile up.
+def build_knowledge_base(snowflake, keywords, kb_config, checkpoint, wiki_data_file, output_file):
+	harvester = create_harvester(kb_config)
+	chunker = create_chunker(kb_config)
+	failed_pages = []
+
+	print('Searching Wikipedia...')
+	titles = harvester.search_titles(keywords)
+	print(f'Building knowledge base from {len(titles)} unique pages...')
+
+	# Pages fetched by an earlier run are only fetched again if they changed since
+	recorded_titles = set(checkpoint.keys('fetch'))
+	fetched_titles = [title for title in titles if title in recorded_titles]
+	print(f'Checking {len(fetched_titles)} fetched pages for changes...')
+	latest_revisions = harvester.latest_revisions(fetched_titles)
+
+	with (
+		JSONObjectStreamWriter(wiki_data_file) as wiki_data_writer,
+		get_kb_output_format(kb_config)['writer'](output_file, kb_config) as kb_writer,
+	):
+
+		def save_and_chunk_page(page):
+			page_hash, page_info = page
+			wiki_data_writer.write(page_hash, page_info)
+			return page_to_kb_entries(page_hash, page_info, chunker)
+
+		pipeline = (
+			Pipeline(
+				queue_size=kb_config.get('pipeline_queue_size', 64), telemetry=snowflake.telemetry
 			)
+			.add_stage(
+				'fetch',
+				lambda title: harvester.fetch_title(
+					title, checkpoint, failed_pages, latest_revisions
+				),
+				workers=kb_config.get('harvest_max_workers', 8),
+			)
+			.add_stage(
+				'tag',
+				lambda pages: tag_page_list(snowflake, keywords, pages, checkpoint),
+				workers=kb_config.get('tagging_max_workers', 8),
+				batch_size=kb_config.get('tagging_batch_size', 10) or 1,
+			)
+			.add_stage('chunk', save_and_chunk_page)
+		)
+		snowflake.add_kb_stages(
+			pipeline,
+			kb_writer,
+			batch_size=kb_config.get('transform_batch_size', 50),
+			checkpoint=checkpoint,
+		)
 
-	return knowledge_base_data
+		# A failed stage dropped rows. The error leaves the with block, so the writers
+		# keep the previous output instead of publishing a partial knowledge base.
+		try:
+			stats = pipeline.run(titles)
+		except PipelineError as e:
+			print('Pipeline stats')
+			pprint(e.stats)
+			raise
+
+	print('Failed pages')
+	pprint(failed_pages)
+
+	print('Pipeline stats')
+	pprint(stats)
+	print(f'{kb_writer.rows_written} rows written to {output_file}.')
+
+
+# Collapses near duplicate chunks in the knowledge base output. Overlapping keywords pull in
+# overlapping pages (Sun, Stars, Solar System...) and their nearly identical chunks crowd
+# each other out of the search results. The first chunk of each group of near duplicates
+# is kept and takes on the tags of the rest, but keeps its own reference URL so
+# REFERENCE_URL is always a single URL. It reads the file twice, once to find duplicates
+# and once to rewrite it, holding only the index in memory: about 2 KB a chunk (see
+# NearDuplicateIndex), comparable to the chunk text itself, plus the merged tags.
+def dedupe_knowledge_base(output_file, kb_config):
+	index = NearDuplicateIndex(
+		threshold=kb_config.get('dedup_threshold', 0.8),
+		num_perm=kb_config.get('dedup_num_perm', 128),
+		bands=kb_config.get('dedup_bands', 16),
+		shingle_size=kb_config.get('dedup_shingle_size', 5),
+	)
+	output_format = get_kb_output_format(kb_config)
+	merged = {}
+	duplicates = set()
+	rows_before = 0
+	text_bytes_before = 0
+	text_bytes_after = 0
+
+	for row_number, row in enumerate(output_format['reader'](output_file)):
+		text_bytes = len(row['CHUNK_TEXT'].encode())
+		rows_before += 1
+		text_bytes_before += text_bytes
+
+		survivor = index.add(row_number, row['CHUNK_TEXT'])
+		if survivor is None:
+			text_bytes_after += text_bytes
+			continue
+
+		duplicates.add(row_number)
+		merged.setdefault(survivor, {}).update(dict.fromkeys(row['TAGS']))
+
+	if duplicates:
+		with output_format['writer'](output_file, kb_config) as kb_writer:
+			for row_number, row in enumerate(output_format['reader'](output_file)):
+				if row_number in duplicates:
+					continue
+
+				if row_number in merged:
+					row['TAGS'] = list(dict.fromkeys([*row['TAGS'], *merged[row_number]]))
+
+				kb_writer.write_row(row)
+
+	reduction = 1 - text_bytes_after / text_bytes_before if text_bytes_before else 0
+	print('Near duplicate chunks removed')
+	pprint(
+		{
+			'rows_before': rows_before,
+			'rows_after': rows_before - len(duplicates),
+			'duplicates_removed': len(duplicates),
+			'survivors_merged_into': len(merged),
+			'chunk_text_bytes_before': text_bytes_before,
+			'chunk_text_bytes_after': text_bytes_after,
+			'index_size_reduction': f'{reduction:.1%}',
+		}
+	)
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Build the knowledge base files for Snowflake.')
+	parser.add_argument(
+		'--force',
+		nargs='+',
+		choices=[*KB_STAGES, 'all'],
+		default=[],
+		help='Redo these stages from scratch instead of resuming from the progress log.',
+	)
+	return parser.parse_args()
 
 
 def main():
+	args = parse_args()
+	force_stages = KB_STAGES if 'all' in args.force else args.force
+
 	# -------------------------
 	# INITIAL SETUP
 	# -------------------------
 	print('Loading secrets...')
 	secrets_file_path = os.path.join(root_path, '.streamlit', 'secrets.toml')
 	secrets = load_secrets(secrets_file_path)
+	kb_config = secrets.get('knowledge_base', {})
 	print('Secrets loaded.')
 
 	print('Initializing Snowflake connector...')
 	snowflake = SnowflakeConnector(secrets)
 	print('Snowflake connector initialized.')
 
-	print('Setting Wikipedia rate limiting...')
-	wikipedia.set_rate_limiting(True)
-	print('Wikipedia rate limiting set.')
-
 	# -------------------------
 	# GET TAGS FROM TRANSCRIPT
 	# -------------------------
@@ -157,53 +304,42 @@ def main():
 		print('Transcript obtained.')
 
 		print('Extracting keywords from transcript...')
-		keywords = snowflake.get_cortex_keywords_from_transcript(transcript).split(',')
+		keywords_str = snowflake.get_cortex_keywords_from_transcript(json.dumps(transcript))
+		keywords = [keyword.strip() for keyword in keywords_str.split(',') if keyword.strip()]
 		print('Keywords extracted:', keywords)
 
 	# -------------------------
-	# GET WIKIPEDIA PAGES
+	# BUILD KNOWLEDGE BASE
 	# -------------------------
-	wiki_data_file = pathlib.Path(root_path, 'generated_files/wiki_data.json')
-
-	if wiki_data_file.exists():
-		print('wiki_data.json file exists. Loading data from file...')
-		with open(wiki_data_file) as f:
-			pages_dict = json.load(f)
-
-		print('Data loaded from wiki_data.json.')
-
-	else:
-		failed_pages = []
-
-		print(
-			'wiki_data.json file does not exist. Searching Wikipedia and populating dictionary...'
-		)
-		pages_dict, failed_pages = search_wikipedia_and_populate_dict(snowflake, keywords)
-		print('Dictionary populated with Wikipedia pages.')
-
-		print('Saving pages_dict to wiki_data.json...')
-		os.makedirs(wiki_data_file.parent, exist_ok=True)
-
-		with open(wiki_data_file, 'w') as f:
-			json.dump(pages_dict, f)
-
-		print('pages_dict saved to wiki_data.json.')
-
-		print('Failed pages')
-		pprint(failed_pages)
+	# Every fetched page, tagged page and transformed chunk is recorded in the progress
+	# log as soon as it's done. Reruns only do the work that isn't in the log yet.
+	progress_file = os.path.join(root_path, 'generated_files', 'kb_progress.jsonl')
+	checkpoint = KBCheckpoint(progress_file, force_stages)
+	print('Resuming from progress log:', checkpoint.counts())
+
+	# knowledge_base.csv, or a directory of Parquet files with output_format = "parquet"
+	output_file = os.path.join(
+		root_path, 'generated_files', get_kb_output_format(kb_config)['file_name']
+	)
+	build_knowledge_base(
+		snowflake,
+		keywords,
+		kb_config,
+		checkpoint,
+		wiki_data_file=os.path.join(root_path, 'generated_files', 'wiki_data.json'),
+		output_file=output_file,
+	)
+	checkpoint.close()
 
 	# -------------------------
-	# GENERATE CSVS FOR SNOWFLAKE
+	# REMOVE NEAR DUPLICATES
 	# -------------------------
-	output_file_path = os.path.join(root_path, 'generated_files', 'knowledge_base.csv')
+	if kb_config.get('dedup', True):
+		print('Removing near duplicate chunks...')
+		dedupe_knowledge_base(output_file, kb_config)
 
-	if pathlib.Path(output_file_path).exists():
-		print(f'{output_file_path} already exists. Skipping CSV generation.')
-
-	else:
-		print('Writing CSV to be inserted to Snowflake...')
-		knowledge_base_entries = convert_pages_to_kb_format(pages_dict)
-		snowflake.write_knowledge_base_csv(knowledge_base_entries, output_file_path)
+	# Writes the final metrics to the configured exporters, see [telemetry]
+	snowflake.telemetry.flush()
 
 
 if __name__ == '__main__':
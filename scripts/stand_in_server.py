@@ -0,0 +1,110 @@
+import argparse
+import json
+import os
+import sys
+
+root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(root_path)
+
+from utils.kb_writers import KB_OUTPUT_FORMATS  # noqa: E402
+from utils.local_search import load_or_build_index  # noqa: E402
+from utils.stand_in import CortexStandIn, LatencyModel, create_stand_in_server  # noqa: E402
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(
+		description='Run a local stand-in for Cortex COMPLETE and Cortex Search. Point '
+		'SnowflakeConnector at it with stand_in_url in the [snowflake] section of secrets.toml.'
+	)
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8765)
+	parser.add_argument('--seed', type=int, default=0, help='Seed for latencies and failures.')
+	parser.add_argument('--complete-latency-ms', type=float, default=800)
+	parser.add_argument('--complete-latency-sigma', type=float, default=0.4)
+	parser.add_argument('--token-latency-ms', type=float, default=15)
+	parser.add_argument('--search-latency-ms', type=float, default=120)
+	parser.add_argument('--search-latency-sigma', type=float, default=0.3)
+	parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests to fail.')
+	parser.add_argument(
+		'--throttle-rate', type=float, default=0.0, help='Share of requests to answer with 429.'
+	)
+	parser.add_argument(
+		'--max-concurrency',
+		type=int,
+		default=0,
+		help='Answer with 429 past this many requests in flight (0 for no limit).',
+	)
+	parser.add_argument(
+		'--responses',
+		help='JSON file with a list of {"match": ..., "response": ...} rules. A COMPLETE call '
+		'whose system prompt contains `match` is answered with `response`.',
+	)
+	parser.add_argument(
+		'--knowledge-base',
+		help='Knowledge base CSV or Parquet directory to search. Defaults to the one in '
+		'generated_files if it exists, otherwise search returns made up chunks.',
+	)
+	parser.add_argument('--verbose', action='store_true', help='Log every request.')
+	return parser.parse_args()
+
+
+def find_knowledge_base(path):
+	candidates = [path] if path else []
+	candidates += [
+		os.path.join(root_path, 'generated_files', output_format['file_name'])
+		for output_format in KB_OUTPUT_FORMATS.values()
+	]
+
+	for candidate in candidates:
+		if not os.path.exists(candidate):
+			continue
+
+		reader = KB_OUTPUT_FORMATS['parquet' if os.path.isdir(candidate) else 'csv']['reader']
+		return candidate, reader
+
+	return None, None
+
+
+def main():
+	args = parse_args()
+
+	responses = []
+	if args.responses:
+		with open(args.responses) as f:
+			responses = json.load(f)
+
+	search_index = None
+	kb_path, read_rows = find_knowledge_base(args.knowledge_base)
+	if kb_path:
+		search_index = load_or_build_index(
+			kb_path, os.path.join(root_path, 'generated_files', 'stand_in_search.index'), read_rows
+		)
+	else:
+		print('No knowledge base found, search will return made up chunks.')
+
+	stand_in = CortexStandIn(
+		complete_latency=LatencyModel(args.complete_latency_ms, args.complete_latency_sigma),
+		token_latency=LatencyModel(args.token_latency_ms),
+		search_latency=LatencyModel(args.search_latency_ms, args.search_latency_sigma),
+		error_rate=args.error_rate,
+		throttle_rate=args.throttle_rate,
+		max_concurrency=args.max_concurrency,
+		responses=responses,
+		search_index=search_index,
+		seed=args.seed,
+	)
+
+	server = create_stand_in_server(stand_in, args.host, args.port, args.verbose)
+	print(f'Cortex stand-in listening on http://{args.host}:{args.port}')
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		print('Stand-in stats:', json.dumps(stand_in.stats))
+
+
+if __name__ == '__main__':
+	main()
@@ -210,6 +210,31 @@ resource "snowflake_file_format" "kb_csv_format" {
   ]
 }
 
+resource "snowflake_file_format" "kb_parquet_format" {
+  name        = "KB_PARQUET_FORMAT"
+  database    = snowflake_database.rag_n_roll_db.name
+  schema      = snowflake_schema.rag_n_roll_schema.name
+  format_type = "PARQUET"
+  compression = "AUTO"
+
+  depends_on = [
+    snowflake_database.rag_n_roll_db,
+    snowflake_schema.rag_n_roll_schema
+  ]
+}
+
+# Parquet files are already compressed and split into parts by populate_kb.py, so they're
+# uploaded as they are and loaded from a folder on the stage instead of a single .gz file
+locals {
+  kb_stage_path     = "${snowflake_database.rag_n_roll_db.name}.${snowflake_schema.rag_n_roll_schema.name}.${snowflake_stage.kb_csv_stage.name}"
+  kb_is_parquet     = var.knowledge_base_format == "parquet"
+  kb_local_files    = local.kb_is_parquet ? "${var.knowledge_base_directory_path}/${var.knowledge_base_file_name}/*.parquet" : "${var.knowledge_base_directory_path}/${var.knowledge_base_file_name}"
+  kb_staged_path    = local.kb_is_parquet ? "${var.knowledge_base_file_name}/" : "${var.knowledge_base_file_name}.gz"
+  kb_put_options    = local.kb_is_parquet ? "AUTO_COMPRESS=FALSE PARALLEL=8" : "AUTO_COMPRESS=TRUE"
+  kb_file_format    = local.kb_is_parquet ? snowflake_file_format.kb_parquet_format.name : snowflake_file_format.kb_csv_format.name
+  kb_put_stage_path = local.kb_is_parquet ? "${local.kb_stage_path}/${var.knowledge_base_file_name}" : local.kb_stage_path
+}
+
 resource "snowflake_stage" "kb_csv_stage" {
   name        = "KB_CSV_STAGE"
   database    = snowflake_database.rag_n_roll_db.name
@@ -240,14 +265,15 @@ resource "terraform_data" "build_knowledge_base" {
 
 resource "snowflake_execute" "put_csv_on_stage" {
   execute = <<-EOT
-    PUT file://${var.knowledge_base_directory_path}/${var.knowledge_base_file_name} @${snowflake_database.rag_n_roll_db.name}.${snowflake_schema.rag_n_roll_schema.name}.${snowflake_stage.kb_csv_stage.name} AUTO_COMPRESS=TRUE;
+    PUT file://${local.kb_local_files} @${local.kb_put_stage_path} ${local.kb_put_options};
   EOT
-  revert  = "REMOVE @${snowflake_database.rag_n_roll_db.name}.${snowflake_schema.rag_n_roll_schema.name}.${snowflake_stage.kb_csv_stage.name}/${var.knowledge_base_file_name}.gz"
-  query   = "LIST @${snowflake_database.rag_n_roll_db.name}.${snowflake_schema.rag_n_roll_schema.name}.${snowflake_stage.kb_csv_stage.name}"
+  revert  = "REMOVE @${local.kb_stage_path}/${local.kb_staged_path}"
+  query   = "LIST @${local.kb_stage_path}"
 
   depends_on = [
     snowflake_table.knowledge_base,
     snowflake_file_format.kb_csv_format,
+    snowflake_file_format.kb_parquet_format,
     terraform_data.build_knowledge_base
   ]
 }
@@ -255,8 +281,8 @@ resource "snowflake_execute" "put_csv_on_stage" {
 resource "snowflake_execute" "load_kb_csv" {
   execute = <<-EOT
     COPY INTO ${snowflake_database.rag_n_roll_db.name}.${snowflake_schema.rag_n_roll_schema.name}.${snowflake_table.knowledge_base.name}
-      FROM @${snowflake_database.rag_n_roll_db.name}.${snowflake_schema.rag_n_roll_schema.name}.${snowflake_stage.kb_csv_stage.name}/${var.knowledge_base_file_name}.gz
-      FILE_FORMAT = (FORMAT_NAME = ${snowflake_database.rag_n_roll_db.name}.${snowflake_schema.rag_n_roll_schema.name}.${snowflake_file_format.kb_csv_format.name})
+      FROM @${local.kb_stage_path}/${local.kb_staged_path}
+      FILE_FORMAT = (FORMAT_NAME = ${snowflake_database.rag_n_roll_db.name}.${snowflake_schema.rag_n_roll_schema.name}.${local.kb_file_format})
       MATCH_BY_COLUMN_NAME='CASE_INSENSITIVE';
   EOT
   revert  = "TRUNCATE TABLE ${snowflake_database.rag_n_roll_db.name}.${snowflake_schema.rag_n_roll_schema.name}.${snowflake_table.knowledge_base.name}"
@@ -275,6 +301,8 @@ resource "snowflake_cortex_search_service" "kb_search_service" {
   schema     = snowflake_schema.rag_n_roll_schema.name
   name       = "KB_SEARCH_SERVICE"
   on         = "CHUNK_TEXT"
+  # Filterable columns, the app limits search to chunks sharing a tag with the video
+  attributes = ["TAGS"]
   target_lag = "2 minutes"
   warehouse  = snowflake_warehouse.cortex_search_warehouse.name
   query      = "SELECT SOURCE, SOURCE_ID, CHUNK_TEXT, TAGS, REFERENCE_URL FROM \"${snowflake_database.rag_n_roll_db.name}\".\"${snowflake_schema.rag_n_roll_schema.name}\".\"${snowflake_table.knowledge_base.name}\""
@@ -311,6 +339,20 @@ resource "snowflake_grant_ownership" "kb_csv_format_ownership" {
   ]
 }
 
+resource "snowflake_grant_ownership" "kb_parquet_format_ownership" {
+  account_role_name   = snowflake_account_role.streamlit_role.name
+  outbound_privileges = "COPY"
+  on {
+    object_type = "FILE FORMAT"
+    object_name = "${snowflake_database.rag_n_roll_db.name}.${snowflake_schema.rag_n_roll_schema.name}.${snowflake_file_format.kb_parquet_format.name}"
+  }
+
+  depends_on = [
+    snowflake_file_format.kb_parquet_format,
+    snowflake_account_role.streamlit_role
+  ]
+}
+
 resource "snowflake_grant_privileges_to_account_role" "kb_csv_stage_usage" {
   privileges        = ["READ", "WRITE"]
   account_role_name = snowflake_account_role.streamlit_role.name
@@ -36,10 +36,21 @@ variable "build_knowledge_base_command" {
 }
 
 variable "knowledge_base_file_name" {
-  description = "The name of the knowledge base file"
+  description = "The name of the knowledge base file (or directory of Parquet files)"
   type        = string
 }
 
+variable "knowledge_base_format" {
+  description = "The format populate_kb.py writes the knowledge base in, csv or parquet (must match output_format in secrets.toml)"
+  type        = string
+  default     = "csv"
+
+  validation {
+    condition     = contains(["csv", "parquet"], var.knowledge_base_format)
+    error_message = "knowledge_base_format must be csv or parquet."
+  }
+}
+
 variable "knowledge_base_directory_path" {
   description = "The directory where the knowledge base file is located"
   type        = string
@@ -0,0 +1,76 @@
+import threading
+import unittest
+
+from utils.pipeline import Pipeline, PipelineError
+
+
+class PipelineTest(unittest.TestCase):
+	# Fails the test instead of hanging it if the run never finishes
+	def run_pipeline(self, pipeline, source, timeout=5):
+		outcome = {}
+
+		def run():
+			try:
+				outcome['stats'] = pipeline.run(source)
+			except Exception as e:
+				outcome['error'] = e
+
+		thread = threading.Thread(target=run, daemon=True)
+		thread.start()
+		thread.join(timeout)
+		self.assertFalse(thread.is_alive(), 'Pipeline.run did not finish')
+		return outcome
+
+	def test_passes_items_through_stages(self):
+		written = []
+		pipeline = (
+			Pipeline(queue_size=2)
+			.add_stage('double', lambda item: [item, item], workers=2)
+			.add_stage('write', written.append)
+		)
+
+		outcome = self.run_pipeline(pipeline, range(5))
+
+		self.assertEqual(sorted(written), [0, 0, 1, 1, 2, 2, 3, 3, 4, 4])
+		self.assertEqual([stage['items_in'] for stage in outcome['stats'][1:]], [5, 10])
+
+	def test_raises_after_run_when_a_stage_fails(self):
+		written = []
+
+		def fail_on_two(item):
+			if item == 2:
+				raise ValueError('bad item')
+			return [item]
+
+		pipeline = Pipeline().add_stage('check', fail_on_two).add_stage('write', written.append)
+
+		outcome = self.run_pipeline(pipeline, range(4))
+
+		self.assertIsInstance(outcome['error'], PipelineError)
+		self.assertEqual(sorted(written), [0, 1, 3])
+
+	def test_generator_stage_failing_partway_through_does_not_hang(self):
+		written = []
+
+		def chunks(item):
+			yield f'{item}-a'
+			if item == 1:
+				raise ValueError('bad page')
+			yield f'{item}-b'
+
+		pipeline = (
+			Pipeline(queue_size=1)
+			.add_stage('chunk', chunks, workers=2)
+			.add_stage('write', written.append)
+		)
+
+		outcome = self.run_pipeline(pipeline, range(3))
+
+		self.assertIsInstance(outcome['error'], PipelineError)
+		self.assertEqual(sorted(written), ['0-a', '0-b', '1-a', '2-a', '2-b'])
+		chunk_stats = outcome['error'].stats[1]
+		self.assertEqual((chunk_stats['items_in'], chunk_stats['errors']), (3, 1))
+
+
+if __name__ == '__main__':
+	unittest.main()
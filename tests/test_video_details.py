@@ -0,0 +1,175 @@
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from utils.video_details import TranscriptStore
+
+VTT = """WEBVTT
+
+00:00:00.000 --> 00:00:04.000
+Welcome to the solar system.
+
+00:00:04.000 --> 00:00:08.000
+The Sun is a star.
+"""
+UPDATED_VTT = """WEBVTT
+
+00:00:00.000 --> 00:00:04.000
+Welcome back to the solar system.
+"""
+LAST_MODIFIED = 'Sat, 17 Oct 2026 12:00:00 GMT'
+
+
+# A stand-in for Mux serving one transcript at /<playback_id>/text/<track_id>.vtt. It
+# answers conditional requests with a 304 when the ETag or Last-Modified matches, and
+# with a 500 while `failing` is set.
+class MuxStandIn:
+	def __init__(self):
+		self.vtt = VTT
+		self.etag = '"v1"'
+		self.last_modified = LAST_MODIFIED
+		self.failing = False
+		self.requests = []
+		self.statuses = []
+
+		stand_in = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				stand_in.requests.append((self.path, dict(self.headers)))
+
+				if stand_in.failing:
+					stand_in.statuses.append(500)
+					self.send_error(500)
+					return
+
+				if (
+					self.headers.get('If-None-Match') == stand_in.etag
+					or self.headers.get('If-Modified-Since') == stand_in.last_modified
+				):
+					stand_in.statuses.append(304)
+					self.send_response(304)
+					self.end_headers()
+					return
+
+				body = stand_in.vtt.encode()
+				stand_in.statuses.append(200)
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/vtt')
+				self.send_header('Content-Length', str(len(body)))
+				self.send_header('ETag', stand_in.etag)
+				self.send_header('Last-Modified', stand_in.last_modified)
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.url = f'http://127.0.0.1:{self.server.server_port}'
+		self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self._thread.start()
+
+	def update(self, vtt, etag, last_modified):
+		self.vtt = vtt
+		self.etag = etag
+		self.last_modified = last_modified
+
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+
+class TranscriptStoreTest(unittest.TestCase):
+	def setUp(self):
+		self.mux = MuxStandIn()
+		self.addCleanup(self.mux.close)
+
+		cache_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(cache_dir.cleanup)
+		self.cache_dir = cache_dir.name
+
+	def store(self, revalidate_seconds=0):
+		return TranscriptStore(
+			cache_dir=self.cache_dir,
+			base_url=self.mux.url,
+			revalidate_seconds=revalidate_seconds,
+			timeout=5,
+		)
+
+	def test_fetches_and_parses_transcript(self):
+		captions = self.store().get('playback', 'track')
+
+		self.assertEqual(
+			captions,
+			[
+				{'start': 0.0, 'end': 4.0, 'text': 'Welcome to the solar system.'},
+				{'start': 4.0, 'end': 8.0, 'text': 'The Sun is a star.'},
+			],
+		)
+		self.assertEqual([path for path, _ in self.mux.requests], ['/playback/text/track.vtt'])
+		self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'playback_track.json')))
+
+	def test_serves_from_memory_until_revalidation(self):
+		store = self.store(revalidate_seconds=300)
+		store.get('playback', 'track')
+		store.get('playback', 'track')
+
+		self.assertEqual(len(self.mux.requests), 1)
+
+	def test_revalidates_with_etag_and_last_modified(self):
+		store = self.store()
+		captions = store.get('playback', 'track')
+
+		self.assertEqual(store.get('playback', 'track'), captions)
+		_, headers = self.mux.requests[-1]
+		self.assertEqual(headers['If-None-Match'], '"v1"')
+		self.assertEqual(headers['If-Modified-Since'], LAST_MODIFIED)
+		self.assertEqual(self.mux.statuses, [200, 304])
+
+	def test_refetches_changed_transcript(self):
+		store = self.store()
+		store.get('playback', 'track')
+		self.mux.update(UPDATED_VTT, '"v2"', 'Sun, 18 Oct 2026 12:00:00 GMT')
+
+		self.assertEqual(
+			store.get('playback', 'track'),
+			[{'start': 0.0, 'end': 4.0, 'text': 'Welcome back to the solar system.'}],
+		)
+		self.assertEqual(self.mux.statuses, [200, 200])
+
+	def test_serves_stale_transcript_when_mux_fails(self):
+		store = self.store()
+		captions = store.get('playback', 'track')
+		self.mux.failing = True
+
+		self.assertEqual(store.get('playback', 'track'), captions)
+		self.assertEqual(self.mux.statuses, [200, 500])
+
+	def test_raises_when_mux_fails_without_a_cached_transcript(self):
+		self.mux.failing = True
+
+		with self.assertRaises(requests.RequestException):
+			self.store().get('playback', 'track')
+
+	def test_reloads_transcript_from_disk(self):
+		captions = self.store().get('playback', 'track')
+
+		# A new store (a restarted worker) revalidates the copy on disk instead of
+		# downloading it again
+		self.assertEqual(self.store(revalidate_seconds=300).get('playback', 'track'), captions)
+		_, headers = self.mux.requests[-1]
+		self.assertEqual(headers['If-None-Match'], '"v1"')
+		self.assertEqual(self.mux.statuses, [200, 304])
+
+		# ...and serves it even if Mux is down
+		self.mux.failing = True
+		self.assertEqual(self.store().get('playback', 'track'), captions)
+
+
+if __name__ == '__main__':
+	unittest.main()
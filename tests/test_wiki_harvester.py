@@ -0,0 +1,113 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from utils.kb_checkpoint import KBCheckpoint
+from utils.wiki_harvester import WikipediaHarvester
+from utils.wiki_stand_in import MAX_TITLES, WikipediaStandIn, create_wikipedia_stand_in_server
+
+PAGES = {
+	'Mars': {
+		'content': 'Mars is the fourth planet.\n\n\n== Moons ==\nPhobos and Deimos.',
+		'revision': 10,
+		'images': ['Mars.jpg', 'Phobos.jpg', 'Deimos.jpg', 'Olympus_Mons.jpg', 'Valles.jpg'],
+	},
+	'Jupiter': {'content': 'Jupiter is the largest planet.', 'revision': 20},
+	'Mercury': {'content': 'Mercury may refer to a planet or an element.', 'disambiguation': True},
+	'Planet': {'content': 'Mars and Jupiter are planets, Mercury too.', 'revision': 30},
+}
+REDIRECTS = {'Red Planet': 'Mars'}
+
+
+class WikipediaHarvesterTest(unittest.TestCase):
+	def setUp(self):
+		self.wikipedia = WikipediaStandIn(PAGES, REDIRECTS, images_per_response=2)
+		server = create_wikipedia_stand_in_server(self.wikipedia)
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		self.addCleanup(server.server_close)
+		self.addCleanup(server.shutdown)
+
+		self.harvester = WikipediaHarvester(
+			api_url=f'http://127.0.0.1:{server.server_port}/w/api.php',
+			requests_per_second=1000,
+			max_workers=4,
+		)
+
+	def checkpoint(self):
+		checkpoint_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(checkpoint_dir.cleanup)
+		checkpoint = KBCheckpoint(os.path.join(checkpoint_dir.name, 'progress.jsonl'))
+		self.addCleanup(checkpoint.close)
+		return checkpoint
+
+	def test_search_titles_are_unique_across_keywords(self):
+		self.assertEqual(
+			self.harvester.search_titles(['planet', 'mars']),
+			['Mars', 'Jupiter', 'Mercury', 'Planet'],
+		)
+
+	def test_fetch_page_follows_redirects_and_image_continuation(self):
+		page = self.harvester.fetch_page('Red_Planet')
+
+		self.assertEqual(page['title'], 'Mars')
+		self.assertEqual(page['summary'], 'Mars is the fourth planet.')
+		self.assertEqual(page['url'], 'https://en.wikipedia.org/wiki/Mars')
+		self.assertEqual(page['revision'], 10)
+		self.assertEqual(
+			page['images'],
+			[f'https://upload.wikimedia.org/{image}' for image in PAGES['Mars']['images']],
+		)
+		image_requests = [r for r in self.wikipedia.requests if r.get('generator') == 'images']
+		self.assertEqual(len(image_requests), 3)
+
+	def test_fetch_title_reports_failures(self):
+		failed_pages = []
+
+		self.assertEqual(self.harvester.fetch_title('Mercury', failed_pages=failed_pages), [])
+		self.assertEqual(self.harvester.fetch_title('Pluto', failed_pages=failed_pages), [])
+		self.assertEqual(
+			failed_pages,
+			[
+				{'title': 'Mercury', 'error': 'DisambiguationError'},
+				{'title': 'Pluto', 'error': 'PageError'},
+			],
+		)
+
+	def test_latest_revisions_batches_titles(self):
+		missing = [f'Missing page {index}' for index in range(2 * MAX_TITLES)]
+		titles = ['mars', 'Red Planet', *missing, 'Jupiter']
+
+		revisions = self.harvester.latest_revisions(titles)
+
+		self.assertEqual(revisions, {'mars': 10, 'Red Planet': 10, 'Jupiter': 20})
+		info_requests = [r for r in self.wikipedia.requests if r.get('prop') == 'info']
+		self.assertEqual(len(info_requests), 3)
+		self.assertTrue(all(len(r['titles'].split('|')) <= MAX_TITLES for r in info_requests))
+
+	def test_fetch_title_refetches_changed_pages(self):
+		checkpoint = self.checkpoint()
+		[(page_hash, _)] = self.harvester.fetch_title('Jupiter', checkpoint)
+
+		# Unchanged, the recorded page is reused without fetching it again
+		fetches = len(self.wikipedia.requests)
+		revisions = self.harvester.latest_revisions(['Jupiter'])
+		self.assertEqual(
+			self.harvester.fetch_title('Jupiter', checkpoint, latest_revisions=revisions)[0][0],
+			page_hash,
+		)
+		self.assertEqual(len(self.wikipedia.requests), fetches + 1)
+
+		self.wikipedia.pages['Jupiter'].update(content='Jupiter is a gas giant.', revision=21)
+		revisions = self.harvester.latest_revisions(['Jupiter'])
+		[(new_hash, page_info)] = self.harvester.fetch_title(
+			'Jupiter', checkpoint, latest_revisions=revisions
+		)
+
+		self.assertNotEqual(new_hash, page_hash)
+		self.assertEqual(page_info['page_content'], 'Jupiter\nJupiter is a gas giant.')
+		self.assertEqual(checkpoint.get('fetch', 'Jupiter')['revision'], 21)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,252 @@
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition
+
+from utils.rate_limit import TokenBucket
+from utils.telemetry import current_span
+
+# Lane for Cortex Search calls, COMPLETE calls get a lane per model
+SEARCH_LANE = 'search'
+# HTTP statuses (and Snowflake error messages) that mean the service wants us to slow down
+THROTTLE_STATUS_CODES = (429, 503)
+THROTTLE_MESSAGES = ('too many requests', 'throttl', 'rate limit', 'concurrency limit')
+
+
+# Raised when a call waited longer than `max_wait_seconds` to be admitted. Not a
+# TimeoutError, so coach stages report it as a failure rather than as running too long.
+class AdmissionTimeout(Exception):
+	pass
+
+
+def _status_code(error):
+	response = getattr(error, 'response', None)
+	return getattr(response, 'status_code', None) or getattr(error, 'status', None)
+
+
+def is_throttle_error(error):
+	if _status_code(error) in THROTTLE_STATUS_CODES:
+		return True
+
+	message = str(error).lower()
+	return any(text in message for text in THROTTLE_MESSAGES)
+
+
+# Calls we should stop sending for now, as opposed to calls that failed
+def is_overload_error(error):
+	return isinstance(error, AdmissionTimeout) or is_throttle_error(error)
+
+
+def _retry_after_seconds(error):
+	headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+
+	try:
+		return float(headers.get('Retry-After', 0))
+	except ValueError:
+		return 0.0
+
+
+# Limits for one lane: calls to one model, or to Cortex Search. At most
+# `max_concurrency` calls run at once, and with `requests_per_minute` or
+# `tokens_per_minute` set, starting them also takes from token buckets refilling at
+# that rate (with up to a minute's worth of burst). Calls are admitted strictly in the
+# order they arrived, so a big call waiting on the token bucket isn't overtaken forever
+# by small ones, and no caller's wait depends on how often it happens to wake up.
+class AdmissionLane:
+	def __init__(self, name, max_concurrency=8, requests_per_minute=None, tokens_per_minute=None):
+		self.name = name
+		self.max_concurrency = max_concurrency
+		self.request_bucket = (
+			TokenBucket(requests_per_minute / 60, requests_per_minute)
+			if requests_per_minute
+			else None
+		)
+		self.token_bucket = (
+			TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute else None
+		)
+		self.in_flight = 0
+		self.waiting = deque()
+		self.condition = Condition()
+
+
+# Admission control shared by every Cortex call path of a SnowflakeConnector. Calls
+# queue per lane (see AdmissionLane) and give up with AdmissionTimeout after
+# `max_wait_seconds`. Calls the service throttles are retried up to `max_retries`
+# times, after a random wait of up to `backoff_base_seconds` doubling with every retry
+# (capped at `backoff_max_seconds`, and never shorter than a Retry-After header), so
+# callers throttled together don't all come back at the same moment.
+# Queue depth, calls in flight, wait times, throttles and rejections are reported as
+# admission_* metrics, and retries on the call's span feed cortex_retries_total.
+class AdmissionController:
+	def __init__(
+		self,
+		telemetry,
+		lanes=None,
+		default_lane=None,
+		max_wait_seconds=20,
+		max_retries=3,
+		backoff_base_seconds=0.5,
+		backoff_max_seconds=8,
+	):
+		self.telemetry = telemetry
+		self.lanes = dict(lanes or {})
+		self.default_lane = default_lane or {}
+		self.max_wait_seconds = max_wait_seconds
+		self.max_retries = max_retries
+		self.backoff_base_seconds = backoff_base_seconds
+		self.backoff_max_seconds = backoff_max_seconds
+
+	def _lane(self, name):
+		lane = self.lanes.get(name)
+		if lane is None:
+			# Lanes for models without their own limits are made on first use
+			lane = self.lanes.setdefault(name, AdmissionLane(name, **self.default_lane))
+		return lane
+
+	def _reject(self, lane, ticket, reason):
+		with lane.condition:
+			lane.waiting.remove(ticket)
+			lane.condition.notify_all()
+
+		self.telemetry.gauge('admission_queue_depth').dec(lane=lane.name)
+		self.telemetry.counter('admission_rejected_total').inc(lane=lane.name, reason=reason)
+		raise AdmissionTimeout(
+			f'Waited more than {self.max_wait_seconds}s to call Cortex ({lane.name}).'
+		)
+
+	def _acquire(self, lane, tokens, span):
+		started = time.monotonic()
+		deadline = started + self.max_wait_seconds
+		ticket = object()
+
+		self.telemetry.gauge('admission_queue_depth').inc(lane=lane.name)
+		with lane.condition:
+			lane.waiting.append(ticket)
+
+			# Only the call at the head of the queue can be admitted
+			while True:
+				admissible = lane.waiting[0] is ticket and lane.in_flight < lane.max_concurrency
+				remaining = deadline - time.monotonic()
+				if admissible or remaining <= 0:
+					break
+				lane.condition.wait(remaining)
+
+		if not admissible:
+			self._reject(lane, ticket, 'concurrency')
+
+		# The calls behind this one keep waiting while it takes from the buckets. Calls
+		# bigger than the token bucket just take all of it.
+		if lane.request_bucket and not lane.request_bucket.acquire(
+			timeout=max(deadline - time.monotonic(), 0)
+		):
+			self._reject(lane, ticket, 'requests_per_minute')
+		if lane.token_bucket and not lane.token_bucket.acquire(
+			min(max(tokens, 1), lane.token_bucket.capacity),
+			timeout=max(deadline - time.monotonic(), 0),
+		):
+			self._reject(lane, ticket, 'tokens_per_minute')
+
+		with lane.condition:
+			lane.waiting.popleft()
+			lane.in_flight += 1
+			lane.condition.notify_all()
+
+		waited = time.monotonic() - started
+		self.telemetry.gauge('admission_queue_depth').dec(lane=lane.name)
+		self.telemetry.gauge('admission_in_flight').inc(lane=lane.name)
+		self.telemetry.histogram('admission_wait_seconds').observe(waited, lane=lane.name)
+		if span is not None:
+			span.set_attribute(
+				'admission_wait_seconds',
+				round(span.attributes.get('admission_wait_seconds', 0) + waited, 6),
+			)
+
+	def _release(self, lane):
+		with lane.condition:
+			lane.in_flight -= 1
+			lane.condition.notify_all()
+
+		self.telemetry.gauge('admission_in_flight').dec(lane=lane.name)
+
+	def _backoff_seconds(self, retry, error):
+		ceiling = min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** (retry - 1))
+		return max(random.uniform(0, ceiling), _retry_after_seconds(error))
+
+	# Waits for `lane` to admit the call, runs `start` and holds the call's place until
+	# the block exits, for calls whose results are read after `start` returns (cursors
+	# and streams). Throttled attempts give their place back while backing off.
+	@contextmanager
+	def admitted(self, lane_name, start, tokens=0, span=None):
+		lane = self._lane(lane_name)
+		span = span or current_span()
+		retries = 0
+
+		while True:
+			self._acquire(lane, tokens, span)
+
+			try:
+				result = start()
+			except Exception as e:
+				self._release(lane)
+				if not is_throttle_error(e):
+					raise
+
+				self.telemetry.counter('admission_throttled_total').inc(lane=lane.name)
+				if retries >= self.max_retries:
+					self.telemetry.counter('admission_rejected_total').inc(
+						lane=lane.name, reason='throttled'
+					)
+					raise
+
+				retries += 1
+				if span is not None:
+					span.set_attribute('retries', retries)
+					span.add_event('throttled', error=f'{type(e).__name__}: {e}')
+				time.sleep(self._backoff_seconds(retries, e))
+				continue
+
+			try:
+				yield result
+			finally:
+				self._release(lane)
+			return
+
+	def max_concurrency(self, lane_name):
+		return self._lane(lane_name).max_concurrency
+
+	def run(self, lane_name, fn, tokens=0, span=None):
+		with self.admitted(lane_name, fn, tokens, span) as result:
+			return result
+
+
+def _lane_limits(config, defaults):
+	return {
+		'max_concurrency': config.get('max_concurrency', defaults.get('max_concurrency', 8)),
+		'requests_per_minute': config.get(
+			'requests_per_minute', defaults.get('requests_per_minute')
+		),
+		'tokens_per_minute': config.get('tokens_per_minute', defaults.get('tokens_per_minute')),
+	}
+
+
+# Every model gets the limits in [admission], or its own from [admission.limits.<model>].
+# Cortex Search has its own lane, [admission.limits.search].
+def create_admission_controller(admission_config, telemetry):
+	default_lane = _lane_limits(admission_config, {})
+	lanes = {
+		name: AdmissionLane(name, **_lane_limits(lane_config, default_lane))
+		for name, lane_config in admission_config.get('limits', {}).items()
+	}
+	if SEARCH_LANE not in lanes:
+		lanes[SEARCH_LANE] = AdmissionLane(SEARCH_LANE, max_concurrency=16)
+
+	return AdmissionController(
+		telemetry,
+		lanes=lanes,
+		default_lane=default_lane,
+		max_wait_seconds=admission_config.get('max_wait_seconds', 20),
+		max_retries=admission_config.get('max_retries', 3),
+		backoff_base_seconds=admission_config.get('backoff_base_seconds', 0.5),
+		backoff_max_seconds=admission_config.get('backoff_max_seconds', 8),
+	)
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from utils.sqlite import create_sqlite_dir, sqlite_connection
+
+# ----------------
+# BACKENDS
+# ----------------
+# Backends store JSON serializable values with an absolute expiry time.
+# They all expose the same get/set/delete/clear/__len__ surface so the
+# caches below don't care where the data actually lives.
+
+
+class MemoryCacheBackend:
+	def __init__(self, max_entries=1024):
+		self.max_entries = max_entries
+		self._entries = OrderedDict()
+		self._lock = Lock()
+
+	def get(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				return None
+
+			value, expires_at = entry
+			if expires_at is not None and expires_at <= time.time():
+				del self._entries[key]
+				return None
+
+			self._entries.move_to_end(key)
+			return value
+
+	def set(self, key, value, ttl_seconds=None):
+		expires_at = time.time() + ttl_seconds if ttl_seconds else None
+
+		with self._lock:
+			self._entries[key] = (value, expires_at)
+			self._entries.move_to_end(key)
+
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(last=False)
+
+	def delete(self, key):
+		with self._lock:
+			self._entries.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def __len__(self):
+		return len(self._entries)
+
+
+# SQLite lets every Streamlit worker on the box share the same cache and
+# keeps it around between restarts. Values are stored as JSON text.
+class SQLiteCacheBackend:
+	def __init__(self, path, max_entries=1024, table='cache'):
+		self.path = path
+		self.max_entries = max_entries
+		self.table = table
+		self._lock = Lock()
+
+		create_sqlite_dir(path)
+
+		with sqlite_connection(self.path) as connection:
+			connection.execute(
+				f"""
+				CREATE TABLE IF NOT EXISTS {self.table} (
+					key TEXT PRIMARY KEY,
+					value TEXT NOT NULL,
+					expires_at REAL,
+					last_access REAL NOT NULL
+				)
+				"""
+			)
+			connection.execute(
+				f'CREATE INDEX IF NOT EXISTS {self.table}_last_access ON {self.table} (last_access)'
+			)
+
+	def get(self, key):
+		now = time.time()
+
+		with self._lock, sqlite_connection(self.path) as connection:
+			row = connection.execute(
+				f'SELECT value, expires_at FROM {self.table} WHERE key = ?', (key,)
+			).fetchone()
+			if row is None:
+				return None
+
+			value, expires_at = row
+			if expires_at is not None and expires_at <= now:
+				connection.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+				return None
+
+			connection.execute(f'UPDATE {self.table} SET last_access = ? WHERE key = ?', (now, key))
+			return json.loads(value)
+
+	def set(self, key, value, ttl_seconds=None):
+		now = time.time()
+		expires_at = now + ttl_seconds if ttl_seconds else None
+
+		with self._lock, sqlite_connection(self.path) as connection:
+			connection.execute(
+				f'INSERT OR REPLACE INTO {self.table} (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)',
+				(key, json.dumps(value), expires_at, now),
+			)
+			connection.execute(f'DELETE FROM {self.table} WHERE expires_at <= ?', (now,))
+			connection.execute(
+				f"""
+				DELETE FROM {self.table} WHERE key IN (
+					SELECT key FROM {self.table} ORDER BY last_access DESC LIMIT -1 OFFSET ?
+				)
+				""",
+				(self.max_entries,),
+			)
+
+	def delete(self, key):
+		with self._lock, sqlite_connection(self.path) as connection:
+			connection.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+
+	def clear(self):
+		with self._lock, sqlite_connection(self.path) as connection:
+			connection.execute(f'DELETE FROM {self.table}')
+
+	def __len__(self):
+		with sqlite_connection(self.path) as connection:
+			return connection.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+
+# Each named cache gets its own bound (`<name>_max_entries`, falling back to
+# `max_entries`) and, for SQLite, its own table in the shared file.
+def create_cache_backend(cache_config, default_path, name='answer'):
+	backend = cache_config.get('backend', 'memory')
+	max_entries = cache_config.get(f'{name}_max_entries', cache_config.get('max_entries', 1024))
+
+	if backend == 'memory':
+		return MemoryCacheBackend(max_entries=max_entries)
+	if backend == 'sqlite':
+		return SQLiteCacheBackend(
+			cache_config.get('path', default_path),
+			max_entries=max_entries,
+			table=f'{name}_cache',
+		)
+
+	raise ValueError(f'Unknown cache backend: {backend}')
+
+
+# ----------------
+# CACHES
+# ----------------
+
+
+class TTLCache:
+	def __init__(self, backend, ttl_seconds=None, namespace=''):
+		self.backend = backend
+		self.ttl_seconds = ttl_seconds
+		self.namespace = namespace
+		self.hits = 0
+		self.misses = 0
+		self._stats_lock = Lock()
+
+	def _namespaced(self, key):
+		return f'{self.namespace}:{key}' if self.namespace else key
+
+	def get(self, key):
+		value = self.backend.get(self._namespaced(key))
+
+		with self._stats_lock:
+			if value is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+
+		return value
+
+	def set(self, key, value):
+		self.backend.set(self._namespaced(key), value, self.ttl_seconds)
+
+	def clear(self):
+		self.backend.clear()
+
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'hit_rate': self.hits / lookups if lookups else 0.0,
+			'size': len(self.backend),
+		}
+
+
+def normalize_question(question):
+	# "What is the Kuiper belt?" and "what is the kuiper  belt" shouldn't be
+	# treated differently just because of casing, punctuation or spacing.
+	question = question.lower()
+	question = re.sub(r'[^\w\s]', '', question)
+	return ' '.join(question.split())
+
+
+# Caches the full coach answer (response text and reference URLs) for a
+# question asked at roughly the same point in the same video.
+class AnswerCache(TTLCache):
+	def __init__(self, backend, ttl_seconds=None, segment_seconds=30):
+		super().__init__(backend, ttl_seconds=ttl_seconds, namespace='answer')
+		self.segment_seconds = segment_seconds
+
+	def make_key(self, video_id, user_timestamp, user_question):
+		segment = int(user_timestamp or 0) // self.segment_seconds
+		raw_key = json.dumps([video_id, segment, normalize_question(user_question)])
+		return hashlib.sha256(raw_key.encode()).hexdigest()
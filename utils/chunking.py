@@ -0,0 +1,169 @@
+import math
+import re
+from collections import deque
+
+# Rough size of a token for the models we use. Good enough to budget chunks without
+# pulling in a tokenizer, and it only needs the length of a span, not its text.
+CHARS_PER_TOKEN = 4
+
+# A sentence runs up to the punctuation (and any closing quotes or brackets) that ends
+# it, or to the end of its line. Wikipedia extracts put headers and paragraphs on their
+# own lines, so every line break ends a segment too.
+SEGMENT_PATTERN = re.compile(r'\S.*?(?:[.!?]+["\')\]]*(?=\s)|$)', re.MULTILINE)
+# Section headers in Wikipedia plain text extracts look like `== History ==`
+HEADER_PATTERN = re.compile(r'={2,}[^=\n]+={2,}')
+WORD_PATTERN = re.compile(r'\S+')
+
+
+def estimate_tokens(start, end):
+	return math.ceil((end - start) / CHARS_PER_TOKEN)
+
+
+# Splits text into chunks of whole sentences that fit in `max_tokens`. A section header
+# always starts a new chunk and consecutive chunks of a section share up to
+# `overlap_tokens` worth of sentences. Chunks under `min_tokens` (usually the tail of a
+# section) are merged into a neighbour in the same section, going over the budget by at
+# most `min_tokens`, rather than left as a row of their own. A section that's little
+# more than its header stays a chunk of its own. Sentences longer than the budget are
+# split at the last space that fits.
+# It's a single pass over the text that only tracks offsets, chunks are sliced out of
+# the original string once they're complete.
+class SentenceChunker:
+	def __init__(self, max_tokens=256, overlap_tokens=32, min_tokens=64):
+		if overlap_tokens >= max_tokens:
+			raise ValueError('Chunk overlap must be smaller than the chunk size.')
+
+		self.max_tokens = max_tokens
+		self.overlap_tokens = overlap_tokens
+		self.min_tokens = min_tokens
+
+	def _segments(self, text):
+		max_chars = self.max_tokens * CHARS_PER_TOKEN
+
+		for match in SEGMENT_PATTERN.finditer(text):
+			start, end = match.span()
+			is_header = HEADER_PATTERN.fullmatch(text, start, end) is not None
+
+			while end - start > max_chars:
+				split_at = text.rfind(' ', start + 1, start + max_chars)
+				if split_at == -1:
+					split_at = start + max_chars
+				yield start, split_at, False
+
+				start = split_at
+				while start < end and text[start].isspace():
+					start += 1
+
+			yield start, end, is_header
+
+	# Yields (start, end, starts_section) for each chunk, before merging small ones
+	def _raw_spans(self, text):
+		segments = deque()
+		chunk_tokens = 0
+		has_new_content = False
+		starts_section = True
+
+		for start, end, is_header in self._segments(text):
+			tokens = estimate_tokens(start, end)
+
+			if is_header or chunk_tokens + tokens > self.max_tokens:
+				if has_new_content:
+					yield segments[0][0], segments[-1][1], starts_section
+
+				# Carry the last few sentences over into the next chunk of the same section
+				overlap = deque()
+				overlap_tokens = 0
+				if not is_header:
+					while segments and overlap_tokens + segments[-1][2] <= self.overlap_tokens:
+						overlap_tokens += segments[-1][2]
+						overlap.appendleft(segments.pop())
+
+				# ...as long as the sentence that starts it still fits
+				while overlap and overlap_tokens + tokens > self.max_tokens:
+					overlap_tokens -= overlap.popleft()[2]
+
+				segments = overlap
+				chunk_tokens = overlap_tokens
+				has_new_content = False
+				starts_section = is_header
+
+			segments.append((start, end, tokens))
+			chunk_tokens += tokens
+			has_new_content = True
+
+		if has_new_content:
+			yield segments[0][0], segments[-1][1], starts_section
+
+	# Yields the (start, end) offsets of each chunk in `text`
+	def spans(self, text):
+		pending = None
+
+		for start, end, starts_section in self._raw_spans(text):
+			if pending is not None:
+				pending_start, pending_end = pending
+				is_small = (
+					estimate_tokens(pending_start, pending_end) < self.min_tokens
+					or estimate_tokens(start, end) < self.min_tokens
+				)
+
+				if (
+					is_small
+					and not starts_section
+					and estimate_tokens(pending_start, end) <= self.max_tokens + self.min_tokens
+				):
+					pending = (pending_start, end)
+					continue
+
+				yield pending
+
+			pending = (start, end)
+
+		if pending is not None:
+			yield pending
+
+	def split(self, text):
+		for start, end in self.spans(text):
+			yield text[start:end]
+
+
+# The original chunking: windows of `chunk_size` words where consecutive windows share
+# `overlap` words, ignoring sentences and sections.
+class WordWindowChunker:
+	def __init__(self, chunk_size=200, overlap=10):
+		if overlap >= chunk_size:
+			raise ValueError('Chunk overlap must be smaller than the chunk size.')
+
+		self.chunk_size = chunk_size
+		self.overlap = overlap
+
+	def spans(self, text):
+		words = [match.span() for match in WORD_PATTERN.finditer(text)]
+
+		for i in range(0, len(words), self.chunk_size - self.overlap):
+			yield words[i][0], words[min(i + self.chunk_size, len(words)) - 1][1]
+
+	def split(self, text):
+		for start, end in self.spans(text):
+			yield text[start:end]
+
+
+CHUNKERS = {
+	'sentence': lambda config: SentenceChunker(
+		max_tokens=config.get('chunk_max_tokens', 256),
+		overlap_tokens=config.get('chunk_overlap_tokens', 32),
+		min_tokens=config.get('chunk_min_tokens', 64),
+	),
+	'words': lambda config: WordWindowChunker(
+		chunk_size=config.get('chunk_size', 200),
+		overlap=config.get('chunk_overlap', 10),
+	),
+}
+
+
+def create_chunker(kb_config):
+	chunker = kb_config.get('chunker', 'sentence')
+
+	if chunker not in CHUNKERS:
+		raise ValueError(f'Unknown chunker: {chunker}. Use one of {", ".join(CHUNKERS)}.')
+
+	return CHUNKERS[chunker](kb_config)
@@ -0,0 +1,180 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition
+
+
+# A bounded pool of database connections. Connections are created lazily up to
+# `max_size` (with `min_size` opened up front), handed out one per caller and
+# health checked with a cheap query when they've been idle for a while.
+# `connect` is any callable returning a DB-API connection.
+class ConnectionPool:
+	def __init__(
+		self,
+		connect,
+		min_size=1,
+		max_size=10,
+		checkout_timeout=60,
+		health_check_interval=300,
+	):
+		if min_size > max_size:
+			raise ValueError('Connection pool min_size cannot be larger than max_size.')
+
+		self._connect = connect
+		self.min_size = min_size
+		self.max_size = max_size
+		self.checkout_timeout = checkout_timeout
+		self.health_check_interval = health_check_interval
+
+		self._idle = deque()
+		self._size = 0
+		self._closed = False
+		self._condition = Condition()
+
+		self._checkouts = 0
+		self._waits = 0
+		self._timeouts = 0
+		self._wait_seconds = 0.0
+		self._created = 0
+		self._discarded = 0
+
+		for _ in range(min_size):
+			self._idle.append((self._connect(), time.monotonic()))
+			self._size += 1
+			self._created += 1
+
+	def _close_quietly(self, connection):
+		try:
+			connection.close()
+		except Exception as e:
+			print(f'Error closing pooled connection: {e}')
+
+	def _is_healthy(self, connection, idle_since):
+		if getattr(connection, 'is_closed', lambda: False)():
+			return False
+
+		if time.monotonic() - idle_since < self.health_check_interval:
+			return True
+
+		try:
+			cursor = connection.cursor()
+			cursor.execute('SELECT 1')
+			cursor.close()
+			return True
+		except Exception:
+			return False
+
+	def checkout(self, timeout=None):
+		timeout = self.checkout_timeout if timeout is None else timeout
+		started = time.monotonic()
+		deadline = started + timeout
+
+		with self._condition:
+			while True:
+				if self._closed:
+					raise RuntimeError('Connection pool is closed.')
+
+				if self._idle:
+					connection, idle_since = self._idle.pop()
+					break
+
+				if self._size < self.max_size:
+					# Reserve the slot now, the connection is opened below
+					self._size += 1
+					connection, idle_since = None, None
+					break
+
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					self._timeouts += 1
+					raise TimeoutError(
+						f'Timed out after {timeout}s waiting for a connection '
+						f'({self.max_size} of {self.max_size} in use).'
+					)
+
+				self._waits += 1
+				self._condition.wait(remaining)
+
+			self._checkouts += 1
+			self._wait_seconds += time.monotonic() - started
+
+		# Connecting and health checks happen outside the lock so other threads
+		# can keep checking connections in and out in the meantime. An unhealthy
+		# connection is replaced in the same slot.
+		if connection is not None and not self._is_healthy(connection, idle_since):
+			self._close_quietly(connection)
+			connection = None
+			with self._condition:
+				self._discarded += 1
+
+		if connection is None:
+			try:
+				connection = self._connect()
+			except Exception:
+				with self._condition:
+					self._size -= 1
+					self._condition.notify()
+				raise
+
+			with self._condition:
+				self._created += 1
+
+		return connection
+
+	def release(self, connection):
+		with self._condition:
+			if self._closed:
+				self._size -= 1
+				self._close_quietly(connection)
+			else:
+				self._idle.append((connection, time.monotonic()))
+			self._condition.notify()
+
+	def discard(self, connection):
+		self._close_quietly(connection)
+		with self._condition:
+			self._size -= 1
+			self._discarded += 1
+			self._condition.notify()
+
+	@contextmanager
+	def connection(self, timeout=None):
+		connection = self.checkout(timeout)
+		try:
+			yield connection
+		except Exception:
+			# Don't hand a broken connection to the next caller
+			if getattr(connection, 'is_closed', lambda: False)():
+				self.discard(connection)
+				connection = None
+			raise
+		finally:
+			if connection is not None:
+				self.release(connection)
+
+	def close(self):
+		with self._condition:
+			self._closed = True
+			while self._idle:
+				connection, _ = self._idle.pop()
+				self._size -= 1
+				self._close_quietly(connection)
+			self._condition.notify_all()
+
+	def stats(self):
+		with self._condition:
+			return {
+				'size': self._size,
+				'idle': len(self._idle),
+				'in_use': self._size - len(self._idle),
+				'min_size': self.min_size,
+				'max_size': self.max_size,
+				'checkouts': self._checkouts,
+				'waits': self._waits,
+				'timeouts': self._timeouts,
+				'avg_wait_seconds': self._wait_seconds / self._checkouts
+				if self._checkouts
+				else 0.0,
+				'created': self._created,
+				'discarded': self._discarded,
+			}
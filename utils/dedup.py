@@ -0,0 +1,129 @@
+import hashlib
+import re
+from array import array
+
+WORD_PATTERN = re.compile(r'\w+')
+MAX_HASH = (1 << 64) - 1
+# Signatures keep the low 32 bits of each hash. Two different hashes agreeing on those
+# by chance is rare enough (1 in 4 billion) not to move the similarity estimate.
+SIGNATURE_MASK = (1 << 32) - 1
+
+
+def _hash_shingle(shingle):
+	return int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), 'little')
+
+
+# MinHash signatures of word shingles. Instead of hashing every shingle `num_perm`
+# times, each shingle is hashed once and the hash space is split into `num_perm` bins
+# that each keep their smallest hash (one permutation hashing). Empty bins borrow
+# from the next filled bin so short texts still get a full signature. Two signatures
+# agree at each position with probability equal to the Jaccard similarity of the texts.
+# Signatures are arrays of 32 bit ints, 4 bytes a hash.
+class MinHasher:
+	def __init__(self, num_perm=128, shingle_size=5):
+		self.num_perm = num_perm
+		self.shingle_size = shingle_size
+		self._bin_width = (MAX_HASH // num_perm) + 1
+
+	def _shingles(self, text):
+		words = WORD_PATTERN.findall(text.lower())
+
+		if len(words) <= self.shingle_size:
+			yield ' '.join(words)
+			return
+
+		for i in range(len(words) - self.shingle_size + 1):
+			yield ' '.join(words[i : i + self.shingle_size])
+
+	def signature(self, text):
+		bins = [None] * self.num_perm
+
+		for shingle in self._shingles(text):
+			shingle_hash = _hash_shingle(shingle)
+			index, value = divmod(shingle_hash, self._bin_width)
+			if bins[index] is None or value < bins[index]:
+				bins[index] = value
+
+		filled = [index for index, value in enumerate(bins) if value is not None]
+		if not filled:
+			return array('I', [0] * self.num_perm)
+
+		# Walk backwards so every empty bin can copy the next filled one (wrapping around).
+		# The distance is mixed in so copied values don't collide with real ones.
+		next_filled = filled[0] + self.num_perm
+		for index in range(self.num_perm - 1, -1, -1):
+			if bins[index] is None:
+				bins[index] = _hash_shingle(
+					f'{bins[next_filled % self.num_perm]} {next_filled - index}'
+				)
+			else:
+				next_filled = index
+
+		return array('I', [value & SIGNATURE_MASK for value in bins])
+
+
+def estimate_similarity(signature_a, signature_b):
+	matches = sum(a == b for a, b in zip(signature_a, signature_b, strict=True))
+	return matches / len(signature_a)
+
+
+# Locality sensitive hashing over MinHash signatures. Signatures are cut into `bands`
+# bands and two texts become candidates when any band matches exactly, so only a
+# handful of candidates are compared instead of every pair. With 128 hashes in 16 bands
+# of 8, texts that are ~70% similar or more are very likely to share a band.
+# Signatures are stored back to back in one array and each band is hashed to a single int.
+# An indexed text costs about 2 KB whatever its length: 512 bytes of signature, the rest
+# its entries in the band buckets.
+class NearDuplicateIndex:
+	def __init__(self, threshold=0.8, num_perm=128, bands=16, shingle_size=5):
+		if num_perm % bands:
+			raise ValueError('The number of hashes must divide evenly into bands.')
+
+		self.threshold = threshold
+		self.bands = bands
+		self.rows = num_perm // bands
+		self.num_perm = num_perm
+		self.hasher = MinHasher(num_perm, shingle_size)
+		# Band hash to the position of the text, or a list of positions once it's shared
+		self._buckets = {}
+		self._signatures = array('I')
+		self._keys = []
+
+	def _band_keys(self, signature):
+		for band in range(self.bands):
+			yield hash((band, signature[band * self.rows : (band + 1) * self.rows].tobytes()))
+
+	def _signature(self, position):
+		return self._signatures[position * self.num_perm : (position + 1) * self.num_perm]
+
+	# Returns the key of an indexed text that `text` is a near duplicate of, or adds
+	# `text` to the index under `key` and returns None if there isn't one.
+	def add(self, key, text):
+		signature = self.hasher.signature(text)
+		band_keys = list(self._band_keys(signature))
+		checked = set()
+
+		for band_key in band_keys:
+			candidates = self._buckets.get(band_key)
+			if candidates is None:
+				continue
+
+			for candidate in candidates if isinstance(candidates, list) else (candidates,):
+				if candidate in checked:
+					continue
+				checked.add(candidate)
+
+				if estimate_similarity(signature, self._signature(candidate)) >= self.threshold:
+					return self._keys[candidate]
+
+		position = len(self._keys)
+		self._keys.append(key)
+		self._signatures.extend(signature)
+		for band_key in band_keys:
+			candidates = self._buckets.setdefault(band_key, position)
+			if isinstance(candidates, list):
+				candidates.append(position)
+			elif candidates != position:
+				self._buckets[band_key] = [candidates, position]
+
+		return None
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+from threading import Lock
+
+KB_STAGES = ('fetch', 'tag', 'transform')
+
+
+def hash_input(value):
+	return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+# Append-only progress log for the knowledge base build. Every completed item is
+# written as one JSON line ({'stage', 'key', 'value'}) as soon as it's done, so a
+# crashed build can pick up where it stopped. Keys are page titles for fetching,
+# page hashes for tagging and `<page hash>:<chunk index>` for transforms.
+# Invalidating a stage appends a marker that hides everything recorded before it.
+# Only the file offset of each record is kept in memory, values are read back from
+# the log when needed, so memory doesn't grow with the size of the pages.
+class KBCheckpoint:
+	def __init__(self, path, force_stages=()):
+		self.path = path
+		self._offsets = {stage: {} for stage in KB_STAGES}
+		self._lock = Lock()
+
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		self._load()
+		self._file = open(self.path, 'a+b')  # noqa: SIM115
+
+		for stage in force_stages:
+			self.invalidate(stage)
+
+	def _load(self):
+		if not os.path.exists(self.path):
+			return
+
+		offset = 0
+		last_line = b''
+
+		with open(self.path, 'rb') as f:
+			for line in f:
+				last_line = line
+				line_offset = offset
+				offset += len(line)
+
+				try:
+					record = json.loads(line)
+				except ValueError:
+					# Most likely a line cut short by a crash, skip it
+					continue
+
+				stage = record.get('stage')
+				if stage not in self._offsets:
+					continue
+
+				if record.get('invalidate'):
+					self._offsets[stage] = {}
+				else:
+					self._offsets[stage][record['key']] = line_offset
+
+		# Terminate a line cut short by a crash so new records start on their own line
+		if last_line and not last_line.endswith(b'\n'):
+			with open(self.path, 'ab') as f:
+				f.write(b'\n')
+
+	def _append(self, record):
+		self._file.seek(0, os.SEEK_END)
+		offset = self._file.tell()
+		self._file.write(json.dumps(record).encode() + b'\n')
+		self._file.flush()
+		os.fsync(self._file.fileno())
+		return offset
+
+	def get(self, stage, key):
+		with self._lock:
+			offset = self._offsets[stage].get(key)
+			if offset is None:
+				return None
+
+			self._file.seek(offset)
+			return json.loads(self._file.readline())['value']
+
+	def keys(self, stage):
+		return list(self._offsets[stage].keys())
+
+	def record(self, stage, key, value):
+		with self._lock:
+			self._offsets[stage][key] = self._append({'stage': stage, 'key': key, 'value': value})
+
+	def invalidate(self, stage):
+		if stage not in self._offsets:
+			raise ValueError(f'Unknown knowledge base stage: {stage}')
+
+		with self._lock:
+			self._offsets[stage] = {}
+			self._append({'stage': stage, 'invalidate': True})
+
+	def counts(self):
+		return {stage: len(offsets) for stage, offsets in self._offsets.items()}
+
+	def close(self):
+		self._file.close()
@@ -0,0 +1,244 @@
+import csv
+import json
+import os
+import shutil
+from threading import Lock
+
+KB_FIELDNAMES = ['SOURCE', 'SOURCE_ID', 'CHUNK_TEXT', 'TAGS', 'REFERENCE_URL']
+
+
+# Writers for the knowledge base build. Both write to a temporary file and only move
+# it into place once closed, so a crashed build never leaves a half written file
+# where the Terraform load step would pick it up. Leaving the `with` block on an
+# exception aborts instead: the temporary file is deleted and the last good output kept.
+class KnowledgeBaseCSVWriter:
+	def __init__(self, output_file_path):
+		self.output_file_path = output_file_path
+		self.rows_written = 0
+		self._tmp_path = f'{output_file_path}.tmp'
+		self._lock = Lock()
+
+		if os.path.dirname(output_file_path):
+			os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+
+		self._file = open(self._tmp_path, 'w', newline='')  # noqa: SIM115
+		self._writer = csv.DictWriter(self._file, fieldnames=KB_FIELDNAMES)
+		self._writer.writeheader()
+
+	def write_row(self, row):
+		# Tags are written as a JSON array so Snowflake loads them straight into the ARRAY
+		# column and read_knowledge_base_csv can read them back
+		row = {**row, 'TAGS': json.dumps(row['TAGS'])}
+
+		with self._lock:
+			self._writer.writerow({field: row[field] for field in KB_FIELDNAMES})
+			self.rows_written += 1
+
+	def close(self):
+		self._file.close()
+		os.replace(self._tmp_path, self.output_file_path)
+
+	def abort(self):
+		self._file.close()
+		os.remove(self._tmp_path)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
+
+
+def read_knowledge_base_csv(file_path):
+	with open(file_path, newline='') as f:
+		for row in csv.DictReader(f):
+			yield {**row, 'TAGS': json.loads(row['TAGS'])}
+
+
+# Writes the knowledge base as Parquet files with a real list column for TAGS, so
+# Snowflake doesn't have to parse quoted multi-line CSV text or stringified lists.
+# Rows are buffered and written as a row group every `rows_per_group` rows, and a new
+# file is started every `rows_per_file` rows so COPY INTO can load them in parallel.
+# `output_file_path` is a directory of part files, replaced as a whole on close.
+# pyarrow is only needed for this writer, so it's imported here rather than at the top.
+class KnowledgeBaseParquetWriter:
+	def __init__(
+		self, output_file_path, rows_per_group=10_000, rows_per_file=100_000, compression='snappy'
+	):
+		try:
+			import pyarrow as pa
+			import pyarrow.parquet as pq
+		except ImportError as e:
+			raise ImportError(
+				'Writing the knowledge base as Parquet requires pyarrow: pip install pyarrow'
+			) from e
+
+		self._pa = pa
+		self._pq = pq
+		self.schema = pa.schema(
+			[
+				('SOURCE', pa.string()),
+				('SOURCE_ID', pa.string()),
+				('CHUNK_TEXT', pa.string()),
+				('TAGS', pa.list_(pa.string())),
+				('REFERENCE_URL', pa.string()),
+			]
+		)
+		self.output_file_path = output_file_path
+		self.rows_per_group = rows_per_group
+		self.rows_per_file = rows_per_file
+		self.compression = compression
+		self.rows_written = 0
+		self.files_written = 0
+		self._tmp_path = f'{output_file_path}.tmp'
+		self._lock = Lock()
+		self._file_writer = None
+		self._file_rows = 0
+		self._buffer = {field: [] for field in KB_FIELDNAMES}
+
+		shutil.rmtree(self._tmp_path, ignore_errors=True)
+		os.makedirs(self._tmp_path)
+
+	def _flush(self):
+		rows = len(self._buffer['CHUNK_TEXT'])
+		if not rows:
+			return
+
+		if self._file_writer is None:
+			self._file_writer = self._pq.ParquetWriter(
+				os.path.join(self._tmp_path, f'part-{self.files_written:05d}.parquet'),
+				self.schema,
+				compression=self.compression,
+			)
+			self.files_written += 1
+
+		self._file_writer.write_table(self._pa.Table.from_pydict(self._buffer, schema=self.schema))
+		self._buffer = {field: [] for field in KB_FIELDNAMES}
+		self._file_rows += rows
+
+		if self._file_rows >= self.rows_per_file:
+			self._file_writer.close()
+			self._file_writer = None
+			self._file_rows = 0
+
+	def write_row(self, row):
+		with self._lock:
+			for field in KB_FIELDNAMES:
+				self._buffer[field].append(row[field])
+			self.rows_written += 1
+
+			# Row groups never straddle two files
+			buffered = len(self._buffer['CHUNK_TEXT'])
+			if buffered >= min(self.rows_per_group, self.rows_per_file - self._file_rows):
+				self._flush()
+
+	def close(self):
+		with self._lock:
+			self._flush()
+			if self._file_writer is not None:
+				self._file_writer.close()
+
+		shutil.rmtree(self.output_file_path, ignore_errors=True)
+		os.replace(self._tmp_path, self.output_file_path)
+
+	def abort(self):
+		with self._lock:
+			if self._file_writer is not None:
+				self._file_writer.close()
+
+		shutil.rmtree(self._tmp_path, ignore_errors=True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
+
+
+def read_knowledge_base_parquet(file_path):
+	import pyarrow.parquet as pq
+
+	for part_file in sorted(os.listdir(file_path)):
+		parquet_file = pq.ParquetFile(os.path.join(file_path, part_file))
+		for batch in parquet_file.iter_batches():
+			yield from batch.to_pylist()
+
+
+# Each output format has the name of the file (or directory) it writes in
+# generated_files, a factory for its writer and a reader for the rows it wrote
+KB_OUTPUT_FORMATS = {
+	'csv': {
+		'file_name': 'knowledge_base.csv',
+		'writer': lambda path, config: KnowledgeBaseCSVWriter(path),
+		'reader': read_knowledge_base_csv,
+	},
+	'parquet': {
+		'file_name': 'knowledge_base_parquet',
+		'writer': lambda path, config: KnowledgeBaseParquetWriter(
+			path,
+			rows_per_group=config.get('parquet_rows_per_group', 10_000),
+			rows_per_file=config.get('parquet_rows_per_file', 100_000),
+			compression=config.get('parquet_compression', 'snappy'),
+		),
+		'reader': read_knowledge_base_parquet,
+	},
+}
+
+
+def get_kb_output_format(kb_config):
+	output_format = kb_config.get('output_format', 'csv')
+
+	if output_format not in KB_OUTPUT_FORMATS:
+		raise ValueError(
+			f'Unknown knowledge base output format: {output_format}. '
+			f'Use one of {", ".join(KB_OUTPUT_FORMATS)}.'
+		)
+
+	return KB_OUTPUT_FORMATS[output_format]
+
+
+# Writes a JSON object one key at a time instead of dumping a dict held in memory. Like
+# the knowledge base writers it only replaces the output once closed without an error.
+class JSONObjectStreamWriter:
+	def __init__(self, output_file_path):
+		self.output_file_path = output_file_path
+		self._tmp_path = f'{output_file_path}.tmp'
+		self._first = True
+		self._lock = Lock()
+
+		if os.path.dirname(output_file_path):
+			os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+
+		self._file = open(self._tmp_path, 'w')  # noqa: SIM115
+		self._file.write('{')
+
+	def write(self, key, value):
+		with self._lock:
+			if not self._first:
+				self._file.write(', ')
+			self._first = False
+			self._file.write(f'{json.dumps(key)}: {json.dumps(value)}')
+
+	def close(self):
+		self._file.write('}')
+		self._file.close()
+		os.replace(self._tmp_path, self.output_file_path)
+
+	def abort(self):
+		self._file.close()
+		os.remove(self._tmp_path)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
@@ -0,0 +1,189 @@
+import heapq
+import json
+import math
+import os
+import re
+import struct
+from array import array
+from collections import Counter
+
+INDEX_VERSION = 1
+TOKEN_PATTERN = re.compile(r'\w+')
+# Words so common they'd match almost every chunk and only slow down scoring
+STOPWORDS = frozenset(
+	'a an and are as at be by for from has have in is it its of on or that the this to was '
+	'were what when where which who why will with'.split()
+)
+
+
+def tokenize(text):
+	return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def _matches_filter(row, search_filter):
+	if not search_filter:
+		return True
+
+	(operator, operand), *_ = search_filter.items()
+
+	if operator == '@and':
+		return all(_matches_filter(row, condition) for condition in operand)
+	if operator == '@or':
+		return any(_matches_filter(row, condition) for condition in operand)
+	if operator == '@not':
+		return not _matches_filter(row, operand)
+
+	(column, value), *_ = operand.items()
+	if operator == '@eq':
+		return row.get(column) == value
+	if operator == '@contains':
+		return value in (row.get(column) or [])
+
+	raise ValueError(f'Unsupported search filter operator: {operator}')
+
+
+# Same shape as the Cortex Search response, callers only use `.results`
+class LocalSearchResponse:
+	def __init__(self, results):
+		self.results = results
+
+
+# A BM25 inverted index over the knowledge base, usable wherever the Cortex Search
+# service is: `.search(query, columns, limit, filter)` returns `.results` with the
+# requested columns of the best matching chunks, and filters use the same @eq,
+# @contains, @and, @or and @not operators.
+# Postings are stored in two flat arrays (chunk ids and term frequencies) with each
+# term pointing at its slice, so the index stays compact and loads without parsing a
+# JSON list per term.
+class LocalSearchIndex:
+	def __init__(self, documents, terms, doc_ids, term_freqs, doc_lengths, k1=1.2, b=0.75):
+		self.documents = documents
+		self.terms = terms
+		self.doc_ids = doc_ids
+		self.term_freqs = term_freqs
+		self.doc_lengths = doc_lengths
+		self.k1 = k1
+		self.b = b
+		self.avg_doc_length = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0
+
+	# The file is a length prefixed JSON header (chunks and term offsets) followed by
+	# the raw postings and document length arrays
+	def save(self, path):
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		header = json.dumps(
+			{
+				'version': INDEX_VERSION,
+				'documents': self.documents,
+				'terms': self.terms,
+				'postings_length': len(self.doc_ids),
+				'doc_count': len(self.doc_lengths),
+			}
+		).encode()
+
+		tmp_path = f'{path}.tmp'
+		with open(tmp_path, 'wb') as f:
+			f.write(struct.pack('<Q', len(header)))
+			f.write(header)
+			self.doc_ids.tofile(f)
+			self.term_freqs.tofile(f)
+			self.doc_lengths.tofile(f)
+		os.replace(tmp_path, path)
+
+	def _scores(self, query):
+		doc_count = len(self.doc_lengths)
+		scores = {}
+
+		for term in set(tokenize(query)):
+			if term not in self.terms:
+				continue
+
+			offset, doc_freq = self.terms[term]
+			idf = math.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+
+			for i in range(offset, offset + doc_freq):
+				doc_id = self.doc_ids[i]
+				term_freq = self.term_freqs[i]
+				length_norm = 1 - self.b + self.b * self.doc_lengths[doc_id] / self.avg_doc_length
+				scores[doc_id] = scores.get(doc_id, 0.0) + idf * term_freq * (self.k1 + 1) / (
+					term_freq + self.k1 * length_norm
+				)
+
+		return scores
+
+	def search(self, query, columns, limit=5, filter=None):
+		scores = self._scores(query)
+		ranked = heapq.nlargest(
+			len(scores) if filter else limit, scores.items(), key=lambda item: item[1]
+		)
+
+		results = []
+		for doc_id, _ in ranked:
+			document = self.documents[doc_id]
+			if not _matches_filter(document, filter):
+				continue
+
+			results.append({column: document.get(column) for column in columns})
+			if len(results) >= limit:
+				break
+
+		return LocalSearchResponse(results)
+
+
+def build_index(rows, **kwargs):
+	documents = []
+	doc_lengths = array('I')
+	postings = {}
+
+	for doc_id, row in enumerate(rows):
+		tokens = tokenize(row['CHUNK_TEXT'])
+		documents.append(row)
+		doc_lengths.append(len(tokens))
+
+		for term, count in Counter(tokens).items():
+			postings.setdefault(term, []).append((doc_id, min(count, 0xFFFF)))
+
+	terms = {}
+	doc_ids = array('I')
+	term_freqs = array('H')
+	for term, term_postings in postings.items():
+		terms[term] = (len(doc_ids), len(term_postings))
+		for doc_id, count in term_postings:
+			doc_ids.append(doc_id)
+			term_freqs.append(count)
+
+	return LocalSearchIndex(documents, terms, doc_ids, term_freqs, doc_lengths, **kwargs)
+
+
+# Reads an index written by LocalSearchIndex.save
+def load_index(path, **kwargs):
+	with open(path, 'rb') as f:
+		(header_length,) = struct.unpack('<Q', f.read(8))
+		header = json.loads(f.read(header_length))
+
+		if header['version'] != INDEX_VERSION:
+			raise ValueError(f'Unsupported local search index version: {header["version"]}')
+
+		doc_ids = array('I')
+		doc_ids.fromfile(f, header['postings_length'])
+		term_freqs = array('H')
+		term_freqs.fromfile(f, header['postings_length'])
+		doc_lengths = array('I')
+		doc_lengths.fromfile(f, header['doc_count'])
+
+	terms = {term: tuple(offsets) for term, offsets in header['terms'].items()}
+	return LocalSearchIndex(header['documents'], terms, doc_ids, term_freqs, doc_lengths, **kwargs)
+
+
+# Loads the index at `index_path`, building it from the knowledge base rows first if it
+# doesn't exist or the knowledge base file has changed since it was built
+def load_or_build_index(kb_path, index_path, read_rows):
+	if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(kb_path):
+		return load_index(index_path)
+
+	print(f'Building local search index from {kb_path}...')
+	index = build_index(read_rows(kb_path))
+	index.save(index_path)
+	print(f'Local search index with {len(index.documents)} chunks saved to {index_path}.')
+	return index
@@ -0,0 +1,215 @@
+import contextvars
+import time
+from contextlib import nullcontext
+from queue import Queue
+from threading import Lock, Thread
+
+# Marks the end of a stream. It's passed along every queue so each stage knows when
+# all of its input has arrived and it can finish up.
+END_OF_STREAM = object()
+
+
+# Raised by Pipeline.run once every stage is done if any of them dropped items. The stats
+# of every stage are in `stats`.
+class PipelineError(Exception):
+	def __init__(self, stats):
+		failed = ', '.join(
+			f'{stage["stage"]} ({stage["errors"]})' for stage in stats if stage['errors']
+		)
+		super().__init__(f'Pipeline stages failed, items were dropped: {failed}')
+		self.stats = stats
+
+
+class StageStats:
+	def __init__(self, name, workers):
+		self.name = name
+		self.workers = workers
+		self.items_in = 0
+		self.items_out = 0
+		self.errors = 0
+		self.busy_seconds = 0.0
+		self.started_at = None
+		self.finished_at = None
+		self._lock = Lock()
+
+	def add(self, items_in=0, items_out=0, errors=0, busy_seconds=0.0):
+		with self._lock:
+			self.items_in += items_in
+			self.items_out += items_out
+			self.errors += errors
+			self.busy_seconds += busy_seconds
+
+	def as_dict(self):
+		elapsed = (self.finished_at or time.monotonic()) - (self.started_at or time.monotonic())
+		return {
+			'stage': self.name,
+			'workers': self.workers,
+			'items_in': self.items_in,
+			'items_out': self.items_out,
+			'errors': self.errors,
+			'elapsed_seconds': round(elapsed, 3),
+			'busy_seconds': round(self.busy_seconds, 3),
+			'items_per_second': round(self.items_in / elapsed, 3) if elapsed else 0.0,
+		}
+
+
+# A chain of stages connected by bounded queues. Each stage runs `fn` on `workers`
+# threads, either per item or on lists of up to `batch_size` items, and passes every
+# item `fn` returns (it returns an iterable or generator, or None for nothing) to the next
+# stage.
+# Full queues block the stage feeding them, so a slow stage holds back everything
+# upstream instead of letting items pile up in memory. Errors in `fn` are counted and
+# logged, and the items that caused them are dropped. The run carries on so every error
+# gets logged, then raises PipelineError, so dropped items never go unnoticed.
+# With a `telemetry` (see utils/telemetry.py) the run gets a span with a child span per
+# stage carrying its stats, and spans started by stage functions nest under the run.
+class Pipeline:
+	def __init__(self, queue_size=64, telemetry=None):
+		self.queue_size = queue_size
+		self.telemetry = telemetry
+		self._stages = []
+
+	def add_stage(self, name, fn, workers=1, batch_size=None):
+		self._stages.append((name, fn, workers, batch_size))
+		return self
+
+	def _take_batch(self, queue, batch_size):
+		items = []
+
+		while len(items) < (batch_size or 1):
+			item = queue.get()
+			if item is END_OF_STREAM:
+				# Leave the marker for the other workers of this stage
+				queue.put(END_OF_STREAM)
+				return items, True
+			items.append(item)
+
+		return items, False
+
+	def _run_worker(self, fn, batch_size, in_queue, out_queue, stats, on_finished):
+		try:
+			while True:
+				items, finished = self._take_batch(in_queue, batch_size)
+
+				if items:
+					started = time.monotonic()
+					produced = 0
+					errors = 0
+
+					# Generator stages only fail once they're iterated, so the items they
+					# already produced go on and the rest count as an error
+					try:
+						for output in fn(items if batch_size else items[0]) or []:
+							if out_queue is not None:
+								out_queue.put(output)
+							produced += 1
+					except Exception as e:
+						errors = len(items)
+						print(f'Error in pipeline stage {stats.name}: {e}')
+
+					stats.add(len(items), produced, errors, time.monotonic() - started)
+
+				if finished:
+					return
+		finally:
+			# Whatever happens the next stage has to hear this worker is done
+			on_finished()
+
+	def _run_source(self, source, out_queue, stats):
+		try:
+			for item in source:
+				out_queue.put(item)
+				stats.add(items_out=1)
+		except Exception as e:
+			stats.add(errors=1)
+			print(f'Error in pipeline source: {e}')
+		finally:
+			out_queue.put(END_OF_STREAM)
+			stats.finished_at = time.monotonic()
+
+	def _add_stage_spans(self, all_stats):
+		# Stage stats are timed on the monotonic clock, spans on the wall clock
+		wall_offset_ns = time.time_ns() - time.monotonic_ns()
+
+		for stats in all_stats:
+			self.telemetry.add_span(
+				f'pipeline.{stats.name}',
+				int(stats.started_at * 1e9) + wall_offset_ns,
+				int((stats.finished_at or time.monotonic()) * 1e9) + wall_offset_ns,
+				status='error' if stats.errors else 'ok',
+				**stats.as_dict(),
+			)
+
+	def run(self, source):
+		run_span = self.telemetry.span('pipeline.run') if self.telemetry else nullcontext()
+
+		with run_span:
+			all_stats = self._run(source)
+
+			if self.telemetry:
+				self._add_stage_spans(all_stats)
+
+			stats = [stage_stats.as_dict() for stage_stats in all_stats]
+			if any(stage_stats['errors'] for stage_stats in stats):
+				raise PipelineError(stats)
+
+		return stats
+
+	def _run(self, source):
+		queues = [Queue(maxsize=self.queue_size) for _ in self._stages]
+		source_stats = StageStats('source', 1)
+		source_stats.started_at = time.monotonic()
+		all_stats = [source_stats]
+		threads = [Thread(target=self._run_source, args=(source, queues[0], source_stats))]
+
+		for index, (name, fn, workers, batch_size) in enumerate(self._stages):
+			in_queue = queues[index]
+			out_queue = queues[index + 1] if index + 1 < len(queues) else None
+			stats = StageStats(name, workers)
+			stats.started_at = time.monotonic()
+			all_stats.append(stats)
+
+			# The last worker of a stage to finish passes the end marker downstream
+			remaining_workers = [workers]
+			remaining_lock = Lock()
+
+			def on_finished(
+				stats=stats,
+				out_queue=out_queue,
+				remaining_workers=remaining_workers,
+				remaining_lock=remaining_lock,
+			):
+				with remaining_lock:
+					remaining_workers[0] -= 1
+					if remaining_workers[0] > 0:
+						return
+
+				stats.finished_at = time.monotonic()
+				if out_queue is not None:
+					out_queue.put(END_OF_STREAM)
+
+			# Each worker runs in a copy of the caller's context so it sees the run span
+			worker_args = (
+				self._run_worker,
+				fn,
+				batch_size,
+				in_queue,
+				out_queue,
+				stats,
+				on_finished,
+			)
+			threads.extend(
+				Thread(
+					target=contextvars.copy_context().run,
+					args=worker_args,
+					name=f'{name}-{worker}',
+				)
+				for worker in range(workers)
+			)
+
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		return all_stats
@@ -0,0 +1,138 @@
+import math
+
+from utils.chunking import CHARS_PER_TOKEN
+
+# Default per section limits. They keep a long transcript from crowding the knowledge
+# base out of the prompt, which the total budget alone would do as it cuts sections
+# strictly in priority order.
+SECTION_MAX_TOKENS = {
+	'history': 300,
+	'tags': 200,
+	'transcript': 4000,
+	'knowledge_base': 2000,
+	'summary': 600,
+}
+
+
+def count_tokens(text):
+	return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+# One part of a prompt, made of items that can be dropped one at a time. `render` turns
+# the kept items (always in their original order) into the section's text, and
+# `drop_order` lists item indexes from first to last to drop. Item sizes are measured
+# once, with `separator_tokens` for whatever render puts between items, so fitting a
+# long transcript doesn't re-render it for every dropped caption.
+# Sections with `required` set are never cut down.
+class PromptSection:
+	def __init__(
+		self,
+		name,
+		items,
+		render,
+		drop_order=None,
+		item_text=str,
+		separator_tokens=1,
+		required=False,
+	):
+		self.name = name
+		self.items = list(items)
+		self.render = render
+		self.drop_order = list(range(len(self.items)) if drop_order is None else drop_order)
+		self.required = required
+		self.kept = [True] * len(self.items)
+		self.dropped = 0
+
+		self.overhead_tokens = count_tokens(render([]))
+		self.item_tokens = [count_tokens(item_text(item)) + separator_tokens for item in self.items]
+		self.tokens = self.overhead_tokens + sum(self.item_tokens)
+
+	def kept_items(self):
+		return [item for item, kept in zip(self.items, self.kept, strict=True) if kept]
+
+	# Drops items until the section fits in `max_tokens`, returning how many tokens it
+	# freed. An emptied section still costs its overhead (tags and the like).
+	def shrink_to(self, max_tokens):
+		freed = 0
+
+		while self.tokens > max_tokens and self.dropped < len(self.drop_order):
+			index = self.drop_order[self.dropped]
+			self.kept[index] = False
+			self.dropped += 1
+			self.tokens -= self.item_tokens[index]
+			freed += self.item_tokens[index]
+
+		return freed
+
+	def text(self):
+		return self.render(self.kept_items())
+
+
+# Fits prompt sections into a token budget. Each section is first cut to its own limit
+# in `section_max_tokens` (if it has one), then, while the total is still over
+# `max_tokens`, sections are cut starting from the lowest priority one. `sections` go
+# from highest to lowest priority and `reserved_tokens` covers anything sent alongside
+# them, like the system prompt. Returns the text of every section and a report of the
+# tokens and items each ended up with.
+class PromptBudget:
+	def __init__(self, max_tokens=None, section_max_tokens=None):
+		self.max_tokens = max_tokens
+		self.section_max_tokens = section_max_tokens or {}
+
+	def fit(self, sections, reserved_tokens=0):
+		for section in sections:
+			max_tokens = self.section_max_tokens.get(section.name)
+			if max_tokens is not None and not section.required:
+				section.shrink_to(max_tokens)
+
+		total = reserved_tokens + sum(section.tokens for section in sections)
+		if self.max_tokens is not None:
+			for section in reversed(sections):
+				if total <= self.max_tokens:
+					break
+				if not section.required:
+					total -= section.shrink_to(section.tokens - (total - self.max_tokens))
+
+		texts = {section.name: section.text() for section in sections}
+		report = {
+			'sections': {
+				section.name: {
+					'tokens': count_tokens(texts[section.name]),
+					'items': len(section.items) - section.dropped,
+					'dropped': section.dropped,
+				}
+				for section in sections
+			},
+			'reserved_tokens': reserved_tokens,
+			'max_tokens': self.max_tokens,
+		}
+		report['total_tokens'] = reserved_tokens + sum(
+			section['tokens'] for section in report['sections'].values()
+		)
+		report['over_budget'] = (
+			self.max_tokens is not None and report['total_tokens'] > self.max_tokens
+		)
+
+		return texts, report
+
+
+# Indexes of the captions furthest from `timestamp` first, so the transcript shrinks
+# towards the moment the user is asking about
+def captions_by_distance(captions, timestamp):
+	def distance(index):
+		caption = captions[index]
+		if caption['start'] <= timestamp <= caption['end']:
+			return 0
+		return min(abs(caption['start'] - timestamp), abs(caption['end'] - timestamp))
+
+	return sorted(range(len(captions)), key=distance, reverse=True)
+
+
+def create_prompt_budget(budget_config):
+	return PromptBudget(
+		max_tokens=budget_config.get('max_tokens', 8000),
+		section_max_tokens={
+			name: budget_config.get(f'{name}_max_tokens', max_tokens)
+			for name, max_tokens in SECTION_MAX_TOKENS.items()
+		},
+	)
@@ -0,0 +1,56 @@
+import time
+from threading import Lock
+
+
+# Classic token bucket: holds up to `capacity` tokens and refills at `rate` tokens
+# per second. Callers take tokens before doing work and wait when there aren't enough,
+# which allows short bursts while keeping the long run average at `rate`.
+class TokenBucket:
+	def __init__(self, rate, capacity=None):
+		if rate <= 0:
+			raise ValueError('Token bucket rate must be greater than 0.')
+
+		self.rate = rate
+		self.capacity = capacity if capacity is not None else max(rate, 1)
+		self._tokens = self.capacity
+		self._updated_at = time.monotonic()
+		self._lock = Lock()
+
+	def _refill(self):
+		now = time.monotonic()
+		self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+		self._updated_at = now
+
+	# Takes `tokens` if they're available right away. Otherwise returns how many seconds
+	# until they would be, without taking anything.
+	def _try_take(self, tokens):
+		with self._lock:
+			self._refill()
+
+			if self._tokens >= tokens:
+				self._tokens -= tokens
+				return 0.0
+
+			return (tokens - self._tokens) / self.rate
+
+	def try_acquire(self, tokens=1):
+		return self._try_take(tokens) == 0.0
+
+	def acquire(self, tokens=1, timeout=None):
+		if tokens > self.capacity:
+			raise ValueError(f'Cannot acquire {tokens} tokens from a bucket of {self.capacity}.')
+
+		deadline = None if timeout is None else time.monotonic() + timeout
+
+		while True:
+			wait_seconds = self._try_take(tokens)
+			if wait_seconds == 0.0:
+				return True
+
+			if deadline is not None:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return False
+				wait_seconds = min(wait_seconds, remaining)
+
+			time.sleep(wait_seconds)
@@ -0,0 +1,63 @@
+from utils.local_search import tokenize
+
+
+# Reorders search results by a mix of how many of the query's terms each chunk contains
+# and the rank the search gave it, then keeps only the ones worth sending: scores below
+# `min_score`, or below `relative_score` times the best score, are cut. At least
+# `min_results` and at most `max_results` results are kept, so a clear winner can be
+# sent alone while a question with several good matches gets all of them.
+# It only looks at the text it's given, so it's cheap enough to run on every turn.
+class LexicalReranker:
+	def __init__(
+		self, lexical_weight=0.5, min_score=0.2, relative_score=0.5, min_results=1, max_results=5
+	):
+		self.lexical_weight = lexical_weight
+		self.min_score = min_score
+		self.relative_score = relative_score
+		self.min_results = min_results
+		self.max_results = max_results
+
+	def score(self, query_terms, result, rank):
+		overlap = 0.0
+		if query_terms:
+			chunk_terms = set(tokenize(result['CHUNK_TEXT']))
+			overlap = len(query_terms & chunk_terms) / len(query_terms)
+
+		retrieval_score = 1 / (1 + rank)
+		return self.lexical_weight * overlap + (1 - self.lexical_weight) * retrieval_score
+
+	# `results` are in the order the search ranked them. Returns the kept results, best
+	# first, and their scores.
+	def rerank(self, query, results):
+		query_terms = set(tokenize(query))
+		scored = sorted(
+			(
+				(self.score(query_terms, result, rank), rank, result)
+				for rank, result in enumerate(results)
+			),
+			key=lambda item: (-item[0], item[1]),
+		)
+		if not scored:
+			return [], []
+
+		cutoff = max(self.min_score, scored[0][0] * self.relative_score)
+		kept = [
+			item
+			for index, item in enumerate(scored[: self.max_results])
+			if index < self.min_results or item[0] >= cutoff
+		]
+
+		return [result for _, _, result in kept], [round(score, 3) for score, _, _ in kept]
+
+
+def create_reranker(search_config):
+	if not search_config.get('rerank', True):
+		return None
+
+	return LexicalReranker(
+		lexical_weight=search_config.get('rerank_lexical_weight', 0.5),
+		min_score=search_config.get('rerank_min_score', 0.2),
+		relative_score=search_config.get('rerank_relative_score', 0.5),
+		min_results=search_config.get('rerank_min_results', 1),
+		max_results=search_config.get('max_results', 5),
+	)
@@ -0,0 +1,261 @@
+import json
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict, deque
+from threading import Lock
+
+from utils.sqlite import create_sqlite_dir, sqlite_connection
+
+SESSIONS_FILE_PATH = os.path.join(
+	os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+	'generated_files',
+	'sessions.sqlite',
+)
+# Session IDs come from a browser cookie, anything else is replaced with a new one
+SESSION_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+# Messages are stored as compact JSON records, [role, content] with the role cut down to
+# one letter
+ROLE_CODES = {'user': 'u', 'assistant': 'a'}
+ROLES = {code: role for role, code in ROLE_CODES.items()}
+
+
+def new_session_id():
+	return uuid.uuid4().hex
+
+
+def is_session_id(value):
+	return bool(value) and SESSION_ID_PATTERN.fullmatch(value) is not None
+
+
+def encode_message(message):
+	role = ROLE_CODES.get(message['role'], message['role'])
+	return json.dumps([role, message['content']], separators=(',', ':'))
+
+
+def decode_message(record):
+	role, content = json.loads(record)
+	return {'role': ROLES.get(role, role), 'content': content}
+
+
+# ----------------
+# STORES
+# ----------------
+# Stores keep each chat session's messages as an append-only list, behind the same
+# append/messages/clear methods. A session keeps only its last `max_messages` messages
+# and is forgotten `ttl_seconds` after its last one.
+
+
+# Per process, like st.session_state, but a chat survives page reloads
+class MemorySessionStore:
+	def __init__(self, max_messages=50, ttl_seconds=None, max_sessions=1000):
+		self.max_messages = max_messages
+		self.ttl_seconds = ttl_seconds
+		self.max_sessions = max_sessions
+		self._sessions = OrderedDict()
+		self._lock = Lock()
+
+	def _expired(self, updated_at):
+		return self.ttl_seconds is not None and updated_at + self.ttl_seconds <= time.time()
+
+	def append(self, session_id, messages):
+		with self._lock:
+			records, _ = self._sessions.get(session_id, (None, None))
+			if records is None:
+				records = deque(maxlen=self.max_messages)
+
+			records.extend(encode_message(message) for message in messages)
+			self._sessions[session_id] = (records, time.time())
+			self._sessions.move_to_end(session_id)
+
+			while len(self._sessions) > self.max_sessions:
+				self._sessions.popitem(last=False)
+
+	def messages(self, session_id):
+		with self._lock:
+			entry = self._sessions.get(session_id)
+			if entry is None:
+				return []
+
+			records, updated_at = entry
+			if self._expired(updated_at):
+				del self._sessions[session_id]
+				return []
+
+			return [decode_message(record) for record in records]
+
+	def clear(self, session_id):
+		with self._lock:
+			self._sessions.pop(session_id, None)
+
+	def __len__(self):
+		return len(self._sessions)
+
+
+# SQLite lets every Streamlit worker on the box (and a restarted one) pick up the same
+# chats. Each message is a row, so appending never rewrites the rest of the chat.
+class SQLiteSessionStore:
+	def __init__(
+		self,
+		path,
+		max_messages=50,
+		ttl_seconds=None,
+		table='session_messages',
+		cleanup_interval_seconds=60,
+	):
+		self.path = path
+		self.max_messages = max_messages
+		self.ttl_seconds = ttl_seconds
+		self.table = table
+		self.cleanup_interval_seconds = cleanup_interval_seconds
+		self._last_cleanup = 0.0
+		self._lock = Lock()
+
+		create_sqlite_dir(path)
+
+		with sqlite_connection(self.path) as connection:
+			connection.execute(
+				f"""
+				CREATE TABLE IF NOT EXISTS {self.table} (
+					id INTEGER PRIMARY KEY AUTOINCREMENT,
+					session_id TEXT NOT NULL,
+					record TEXT NOT NULL,
+					created_at REAL NOT NULL
+				)
+				"""
+			)
+			connection.execute(
+				f'CREATE INDEX IF NOT EXISTS {self.table}_session ON {self.table} (session_id, id)'
+			)
+
+	# Drops every session whose last message is older than the TTL. It has to look at the
+	# whole table, so it runs at most once every `cleanup_interval_seconds`.
+	def _remove_expired(self, connection, now):
+		if self.ttl_seconds is None or now - self._last_cleanup < self.cleanup_interval_seconds:
+			return
+
+		self._last_cleanup = now
+		connection.execute(
+			f"""
+			DELETE FROM {self.table} WHERE session_id IN (
+				SELECT session_id FROM {self.table} GROUP BY session_id HAVING MAX(created_at) <= ?
+			)
+			""",
+			(now - self.ttl_seconds,),
+		)
+
+	def append(self, session_id, messages):
+		now = time.time()
+
+		with self._lock, sqlite_connection(self.path) as connection:
+			connection.executemany(
+				f'INSERT INTO {self.table} (session_id, record, created_at) VALUES (?, ?, ?)',
+				[(session_id, encode_message(message), now) for message in messages],
+			)
+			connection.execute(
+				f"""
+				DELETE FROM {self.table} WHERE session_id = ? AND id <= (
+					SELECT id FROM {self.table} WHERE session_id = ?
+					ORDER BY id DESC LIMIT 1 OFFSET ?
+				)
+				""",
+				(session_id, session_id, self.max_messages),
+			)
+			self._remove_expired(connection, now)
+
+	def messages(self, session_id):
+		with sqlite_connection(self.path) as connection:
+			rows = connection.execute(
+				f'SELECT record, created_at FROM {self.table} WHERE session_id = ? ORDER BY id',
+				(session_id,),
+			).fetchall()
+
+		if not rows or (
+			self.ttl_seconds is not None and rows[-1][1] + self.ttl_seconds <= time.time()
+		):
+			return []
+
+		return [decode_message(record) for record, _ in rows]
+
+	def clear(self, session_id):
+		with self._lock, sqlite_connection(self.path) as connection:
+			connection.execute(f'DELETE FROM {self.table} WHERE session_id = ?', (session_id,))
+
+	def __len__(self):
+		with sqlite_connection(self.path) as connection:
+			return connection.execute(
+				f'SELECT COUNT(DISTINCT session_id) FROM {self.table}'
+			).fetchone()[0]
+
+
+# Shares chats between replicas on different machines. Each session is a Redis list,
+# trimmed to the last `max_messages` records and expiring `ttl_seconds` after the last
+# append. Any server speaking the Redis protocol (Valkey, KeyDB, ...) works. The redis
+# package is optional.
+class RedisSessionStore:
+	def __init__(
+		self, url, max_messages=50, ttl_seconds=None, key_prefix='professor-prompt:session:'
+	):
+		try:
+			import redis
+		except ImportError as e:
+			raise ImportError('The redis session store requires redis: pip install redis') from e
+
+		self.client = redis.Redis.from_url(url, decode_responses=True)
+		self.max_messages = max_messages
+		self.ttl_seconds = ttl_seconds
+		self.key_prefix = key_prefix
+
+	def _key(self, session_id):
+		return f'{self.key_prefix}{session_id}'
+
+	def append(self, session_id, messages):
+		key = self._key(session_id)
+
+		# One round trip, applied atomically
+		pipeline = self.client.pipeline(transaction=True)
+		pipeline.rpush(key, *(encode_message(message) for message in messages))
+		pipeline.ltrim(key, -self.max_messages, -1)
+		if self.ttl_seconds is not None:
+			pipeline.expire(key, int(self.ttl_seconds))
+		pipeline.execute()
+
+	def messages(self, session_id):
+		return [
+			decode_message(record) for record in self.client.lrange(self._key(session_id), 0, -1)
+		]
+
+	def clear(self, session_id):
+		self.client.delete(self._key(session_id))
+
+	def __len__(self):
+		return sum(1 for _ in self.client.scan_iter(match=f'{self.key_prefix}*'))
+
+
+SESSION_STORES = {
+	'memory': lambda config: MemorySessionStore(
+		max_messages=config.get('max_messages', 50),
+		ttl_seconds=config.get('ttl_seconds', 604800),
+		max_sessions=config.get('max_sessions', 1000),
+	),
+	'sqlite': lambda config: SQLiteSessionStore(
+		config.get('path', SESSIONS_FILE_PATH),
+		max_messages=config.get('max_messages', 50),
+		ttl_seconds=config.get('ttl_seconds', 604800),
+	),
+	'redis': lambda config: RedisSessionStore(
+		config.get('redis_url', 'redis://localhost:6379/0'),
+		max_messages=config.get('max_messages', 50),
+		ttl_seconds=config.get('ttl_seconds', 604800),
+	),
+}
+
+
+def create_session_store(sessions_config):
+	backend = sessions_config.get('backend', 'memory')
+	if backend not in SESSION_STORES:
+		raise ValueError(f'Unknown session store backend: {backend}')
+
+	return SESSION_STORES[backend](sessions_config)
@@ -1,25 +1,88 @@
-import csv
+import contextvars
 import json
+import os
+import time
 from concurrent.futures import ThreadPoolExecutor
-from queue import Queue
-from threading import Event, Thread
+from contextlib import ExitStack
 
+import requests
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from snowflake.connector import connect
 from snowflake.core import Root
 
+from utils.admission import SEARCH_LANE, create_admission_controller, is_overload_error
+from utils.cache import AnswerCache, TTLCache, create_cache_backend
+from utils.connection_pool import ConnectionPool
+from utils.kb_checkpoint import KBCheckpoint, hash_input
+from utils.kb_writers import (
+	KnowledgeBaseCSVWriter,
+	KnowledgeBaseParquetWriter,
+	get_kb_output_format,
+)
+from utils.local_search import load_or_build_index
+from utils.pipeline import Pipeline
+from utils.prompt_budget import (
+	PromptSection,
+	captions_by_distance,
+	count_tokens,
+	create_prompt_budget,
+)
+from utils.rerank import create_reranker
+from utils.stand_in import StandInConnection, StandInSearchService
 from utils.system_prompts import (
 	COACH_SYSTEM_PROMPT,
+	KEYWORD_BATCH_SELECTOR_SYSTEM_PROMPT,
 	KEYWORD_EXTRACTOR_SYSTEM_PROMPT,
 	KEYWORD_SELECTOR_SYSTEM_PROMPT,
 	KNOWLEDGE_BASE_TRANSFORM_PROMPT,
 	QUERY_ENHANCER_SYSTEM_PROMPT,
 )
+from utils.telemetry import create_telemetry, current_span, record_usage
 
 MODEL_NAME = 'claude-3-5-sonnet'
 COACH_MODEL_NAME = 'coach_fine_tuned'
 LOG_TOKENS = False
+# Sent instead of an answer when Cortex is too busy to take the question, see utils/admission.py
+COACH_BUSY_MESSAGE = (
+	'Professor Prompt is helping a lot of students right now. Please ask again in a moment.'
+)
+# Uses qmark (server side) binding, see SnowflakeConnector._connect
+CORTEX_COMPLETE_QUERY = (
+	'SELECT SNOWFLAKE.CORTEX.COMPLETE(?, PARSE_JSON(?)::ARRAY, PARSE_JSON(?)::OBJECT) AS response'
+)
+# Runs one COMPLETE per row of an inline VALUES list. Params are the model, the shared
+# system prompt, the options and then a (row_id, prompt) pair per row.
+CORTEX_BATCH_COMPLETE_QUERY = """
+	SELECT
+		column1 AS row_id,
+		SNOWFLAKE.CORTEX.COMPLETE(
+			?,
+			ARRAY_CONSTRUCT(
+				OBJECT_CONSTRUCT('role', 'system', 'content', ?),
+				OBJECT_CONSTRUCT('role', 'user', 'content', column2)
+			),
+			PARSE_JSON(?)::OBJECT
+		) AS response
+	FROM VALUES {values}
+"""
+# Sections are filled in by generate_coach_prompt, see PromptBudget
+COACH_PROMPT_TEMPLATE = """
+		{history}
+		{tags}
+		{knowledge_base}
+		{summary}
+		{transcript}
+		{question}
+		"""
+# Matches the target_lag of the Cortex Search service in terraform/main.tf, there's
+# no point asking the service again before it could have refreshed.
+SEARCH_CACHE_TTL_SECONDS = 120
+GENERATED_FILES_PATH = os.path.join(
+	os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'generated_files'
+)
+CACHE_FILE_PATH = os.path.join(GENERATED_FILES_PATH, 'cache.sqlite')
+LOCAL_SEARCH_INDEX_PATH = os.path.join(GENERATED_FILES_PATH, 'local_search.index')
 
 
 class SnowflakeConnector:
@@ -43,33 +106,165 @@ class SnowflakeConnector:
 				'Failed to load private key. Ensure it is in the correct PEM format.'
 			) from e
 
-	def __init__(self, streamlit_secrets):
-		self.connection = connect(
-			account=streamlit_secrets['snowflake']['account'],
-			user=streamlit_secrets['snowflake']['user'],
-			private_key=self._load_private_key(streamlit_secrets['snowflake']['private_key']),
-			warehouse=streamlit_secrets['snowflake']['warehouse'],
-			database=streamlit_secrets['snowflake']['database'],
-			schema=streamlit_secrets['snowflake']['schema'],
+	def _connect(self):
+		if self.stand_in_url:
+			return StandInConnection(self.stand_in_url)
+
+		return connect(
+			account=self.snowflake_config['account'],
+			user=self.snowflake_config['user'],
+			private_key=self._private_key,
+			warehouse=self.snowflake_config['warehouse'],
+			database=self.snowflake_config['database'],
+			schema=self.snowflake_config['schema'],
 			client_session_keep_alive=True,
+			# Bind parameters server side so statement text stays constant between calls
+			paramstyle='qmark',
+		)
+
+	def __init__(self, streamlit_secrets):
+		self.snowflake_config = streamlit_secrets['snowflake']
+
+		# Spans and metrics for every Cortex call, chat turn and KB build stage, exported
+		# as configured in [telemetry] (see utils/telemetry.py)
+		self.telemetry = create_telemetry(streamlit_secrets.get('telemetry', {}))
+
+		# Every COMPLETE, streaming and search call waits its turn here, within per model
+		# concurrency and rate limits, and is retried with backoff when Cortex throttles it
+		self.admission = create_admission_controller(
+			streamlit_secrets.get('admission', {}), self.telemetry
 		)
 
-		self.root = Root(self.connection)
+		# With a stand-in (see scripts/stand_in_server.py) COMPLETE, streaming and search
+		# calls all go to that local server instead, and no Snowflake account is needed
+		self.stand_in_url = self.snowflake_config.get('stand_in_url')
+		self._private_key = (
+			None
+			if self.stand_in_url
+			else self._load_private_key(self.snowflake_config['private_key'])
+		)
 
-		self.cortex_search = (
-			self.root.databases[streamlit_secrets['snowflake']['database']]
-			.schemas[streamlit_secrets['snowflake']['schema']]
-			.cortex_search_services[streamlit_secrets['snowflake']['cortex_search_name']]
+		# This connection backs the Cortex Search client and the REST API session token.
+		# Cortex COMPLETE queries check a connection out of the pool below instead, so
+		# concurrent users (and the KB build threads) don't serialize on one session.
+		self.connection = self._connect()
+
+		pool_config = streamlit_secrets.get('pool', {})
+		self.pool = ConnectionPool(
+			self._connect,
+			min_size=pool_config.get('min_size', 1),
+			max_size=pool_config.get('max_size', 10),
+			checkout_timeout=pool_config.get('checkout_timeout_seconds', 60),
+			health_check_interval=pool_config.get('health_check_interval_seconds', 300),
+		)
+		self.telemetry.watch_stats(
+			'connection_pool', self.pool.stats, 'Snowflake connection pool for COMPLETE calls.'
 		)
 
+		self.root = None if self.stand_in_url else Root(self.connection)
+		self.rest_url = self.stand_in_url or f'https://{self.connection.host}'
+
+		# Stream coach responses from the Cortex REST API instead of waiting on the full
+		# COMPLETE result. Falls back to the SQL function if the REST call fails.
+		self.stream_responses = streamlit_secrets['snowflake'].get('stream_responses', True)
+
+		# Retrieval goes to the Cortex Search service, or to a local BM25 index built from
+		# the generated knowledge base (see utils/local_search.py) with engine = "local".
+		# With local_fallback the local index also answers when the service errors.
+		search_config = streamlit_secrets.get('search', {})
+		self.local_search = None
+		if search_config.get('engine', 'cortex') == 'local' or search_config.get(
+			'local_fallback', False
+		):
+			kb_output_format = get_kb_output_format(streamlit_secrets.get('knowledge_base', {}))
+			self.local_search = load_or_build_index(
+				os.path.join(GENERATED_FILES_PATH, kb_output_format['file_name']),
+				search_config.get('local_index_path', LOCAL_SEARCH_INDEX_PATH),
+				kb_output_format['reader'],
+			)
+
+		# Excerpts can be limited to chunks sharing a tag with the video and reranked
+		# locally (see utils/rerank.py). With retrieve_limit above max_results more
+		# chunks are fetched than sent, and the reranker picks which to keep.
+		self.tag_filter = search_config.get('tag_filter', True)
+		self.reranker = create_reranker(search_config)
+		self.max_results = search_config.get('max_results', 5)
+		self.retrieve_limit = search_config.get('retrieve_limit', self.max_results)
+
+		if search_config.get('engine', 'cortex') == 'local':
+			self.cortex_search = self.local_search
+		elif self.stand_in_url:
+			self.cortex_search = StandInSearchService(
+				self.stand_in_url,
+				streamlit_secrets['snowflake']['database'],
+				streamlit_secrets['snowflake']['schema'],
+				streamlit_secrets['snowflake']['cortex_search_name'],
+			)
+		else:
+			self.cortex_search = (
+				self.root.databases[streamlit_secrets['snowflake']['database']]
+				.schemas[streamlit_secrets['snowflake']['schema']]
+				.cortex_search_services[streamlit_secrets['snowflake']['cortex_search_name']]
+			)
+
+		# Enhancer and search calls for the coach run concurrently on this pool, with
+		# per stage timeouts so one slow call can't stall the whole turn. By default it has
+		# a thread for every enhancer call that can hold a pooled connection and be admitted
+		# at once, plus one for every admitted search, so no thread just sits waiting.
+		pipeline_config = streamlit_secrets.get('pipeline', {})
+		self.speculative_search = pipeline_config.get('speculative_search', True)
+		self.enhancer_timeout = pipeline_config.get('enhancer_timeout_seconds', 5)
+		self.search_timeout = pipeline_config.get('search_timeout_seconds', 5)
+		self.pipeline_executor = ThreadPoolExecutor(
+			max_workers=pipeline_config.get(
+				'max_workers',
+				min(self.pool.max_size, self.admission.max_concurrency(MODEL_NAME))
+				+ self.admission.max_concurrency(SEARCH_LANE),
+			),
+			thread_name_prefix='coach-pipeline',
+		)
+
+		# How much of the transcript goes into the coach prompt, see utils/transcript_index.py
+		self.transcript_config = streamlit_secrets.get('transcript', {})
+
+		# Token limits for the coach prompt as a whole and for each of its sections, see
+		# utils/prompt_budget.py
+		self.prompt_budget = create_prompt_budget(streamlit_secrets.get('prompt_budget', {}))
+
+		# Answers are cached per video, question and timestamp segment so repeat
+		# questions skip the enhancer, search and completion calls entirely.
+		cache_config = streamlit_secrets.get('cache', {})
+		self.answer_cache = AnswerCache(
+			create_cache_backend(cache_config, CACHE_FILE_PATH, 'answer'),
+			ttl_seconds=cache_config.get('answer_ttl_seconds', 3600),
+			segment_seconds=cache_config.get('segment_seconds', 30),
+		)
+
+		# Stage caches for when the full answer isn't cached. Different phrasings
+		# often enhance to the same search query, so the search cache still hits.
+		self.enhancer_cache = TTLCache(
+			create_cache_backend(cache_config, CACHE_FILE_PATH, 'enhancer'),
+			ttl_seconds=cache_config.get('enhancer_ttl_seconds', 3600),
+			namespace='enhancer',
+		)
+		self.search_cache = TTLCache(
+			create_cache_backend(cache_config, CACHE_FILE_PATH, 'search'),
+			ttl_seconds=cache_config.get('search_ttl_seconds', SEARCH_CACHE_TTL_SECONDS),
+			namespace='search',
+		)
+
+		# Hits, misses, hit rate and size of each cache, as cache_* metrics
+		for name, cache in (
+			('answer', self.answer_cache),
+			('enhancer', self.enhancer_cache),
+			('search', self.search_cache),
+		):
+			self.telemetry.watch_stats('cache', cache.stats, 'Coach caches by cache.', cache=name)
+
 	# ----------------
 	# UTILS
 	# ----------------
 
-	def _clean_prompt(self, prompt):
-		prompt = prompt.replace("'", "\\'")
-		return prompt
-
 	def _generate_chat_history(self, chat_history):
 		chat_history_str = ''
 
@@ -80,38 +275,193 @@ class SnowflakeConnector:
 
 		return chat_history_str
 
-	def _do_simple_cortex_query(self, system_prompt, prompt):
-		cursor = self.connection.cursor()
+	# Every COMPLETE call goes through this one statement. The messages and options are
+	# bound as JSON strings and parsed server side, so the statement text never changes
+	# and no prompt text has to be escaped into the SQL. Binding the message list directly
+	# doesn't work (it's sent as a VARCHAR, not an ARRAY), hence PARSE_JSON.
+	def _cortex_complete(self, messages, options=None, model=MODEL_NAME):
+		with self.telemetry.span('cortex.complete', model=model) as span:
+
+			def run_query():
+				with self.pool.connection() as connection:
+					cursor = connection.cursor()
+					cursor.execute(
+						CORTEX_COMPLETE_QUERY,
+						[model, json.dumps(messages), json.dumps(options or {'temperature': 0})],
+					)
+					span.set_attribute('query_id', getattr(cursor, 'sfqid', None))
+					response = cursor.fetchall()[0][0]
+					cursor.close()
+				return response
+
+			# Admitted before checking out a connection, so queued calls don't hold one
+			response = self.admission.run(
+				model, run_query, tokens=count_tokens(json.dumps(messages)), span=span
+			)
+			result = json.loads(response)
+			record_usage(span, result)
 
-		cmd = f"""
-		SELECT SNOWFLAKE.CORTEX.COMPLETE(
-			'{MODEL_NAME}',
-			[
-				{{ 'role': 'system', 'content': '{self._clean_prompt(system_prompt)}' }},
-				{{ 'role': 'user', 'content': '{self._clean_prompt(prompt)}' }}
-			], 
-			{{
-				'temperature': 0
-			}}
-		) as response;
-		"""
+		return result
 
-		cursor.execute(cmd)
+	# Same as _cortex_complete but for many prompts sharing a system prompt, in a single
+	# query. Yields (index, result) pairs as rows come back, in no particular order.
+	def _cortex_complete_batch(self, system_prompt, prompts, options=None, model=MODEL_NAME):
+		params = [model, system_prompt, json.dumps(options or {'temperature': 0})]
+		for index, prompt in enumerate(prompts):
+			params.extend([index, prompt])
 
-		response = cursor.fetchall()[0][0]
-		result = json.loads(response)
+		query = CORTEX_BATCH_COMPLETE_QUERY.format(values=', '.join(['(?, ?)'] * len(prompts)))
 
-		cursor.close()
-		return result
+		# Not made current, this is a generator (see Telemetry.start_span)
+		span = self.telemetry.start_span('cortex.complete_batch', model=model, rows=len(prompts))
+		prompt_tokens = completion_tokens = 0
+
+		# The connection stays checked out (and the call admitted) while rows are read
+		def run_query():
+			with ExitStack() as stack:
+				connection = stack.enter_context(self.pool.connection())
+				cursor = connection.cursor()
+				cursor.execute(query, params)
+				return cursor, stack.pop_all()
+
+		tokens = count_tokens(system_prompt) * len(prompts) + sum(map(count_tokens, prompts))
 
-	def _query_cortex_search(self, prompt):
-		resp = self.cortex_search.search(
-			query=prompt,
-			columns=['CHUNK_TEXT', 'TAGS', 'REFERENCE_URL'],
-			# filter={'@eq': {'<column>': '<value>'}},
-			limit=5,
+		try:
+			with self.admission.admitted(model, run_query, tokens=tokens, span=span) as started:
+				cursor, connection_context = started
+
+				with connection_context:
+					span.set_attribute('query_id', getattr(cursor, 'sfqid', None))
+
+					for row_id, response in cursor:
+						result = json.loads(response)
+						usage = result.get('usage') or {}
+						prompt_tokens += usage.get('prompt_tokens', 0)
+						completion_tokens += usage.get('completion_tokens', 0)
+						yield row_id, result
+
+					cursor.close()
+		except BaseException as e:
+			span.record_error(e)
+			raise
+		finally:
+			span.set_attributes(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+			self.telemetry.end_span(span)
+
+	def _do_simple_cortex_query(self, system_prompt, prompt):
+		return self._cortex_complete(
+			[
+				{'role': 'system', 'content': system_prompt},
+				{'role': 'user', 'content': prompt},
+			]
 		)
-		return resp
+
+	def _query_cortex_search(self, prompt, columns=None, limit=5, filter=None):
+		search_args = {
+			'query': prompt,
+			'columns': columns or ['CHUNK_TEXT', 'TAGS', 'REFERENCE_URL'],
+			'limit': limit,
+		}
+		# e.g. {'@eq': {'<column>': '<value>'}}
+		if filter:
+			search_args['filter'] = filter
+
+		engine = 'local' if self.cortex_search is self.local_search else 'cortex'
+		with self.telemetry.span('cortex.search', engine=engine, limit=limit) as span:
+			try:
+				if engine == 'local':
+					response = self.cortex_search.search(**search_args)
+				else:
+					response = self.admission.run(
+						SEARCH_LANE, lambda: self.cortex_search.search(**search_args), span=span
+					)
+			except Exception as e:
+				if self.local_search is None or self.cortex_search is self.local_search:
+					raise
+
+				print(f'Warning: Cortex Search failed, using the local index instead. {e}')
+				span.add_event('local_fallback', error=f'{type(e).__name__}: {e}')
+				response = self.local_search.search(**search_args)
+
+			span.set_attribute('results', len(response.results))
+			return response
+
+	def _enhance_query(self, user_question):
+		with self.telemetry.span('coach.enhance') as span:
+			enhanced_prompt = self.enhancer_cache.get(user_question)
+			span.set_attribute('cache_hit', enhanced_prompt is not None)
+
+			if enhanced_prompt is None:
+				response = self._do_simple_cortex_query(QUERY_ENHANCER_SYSTEM_PROMPT, user_question)
+				enhanced_prompt = self._safe_return_cortex_response(response)
+
+				if enhanced_prompt:
+					self.enhancer_cache.set(user_question, enhanced_prompt)
+
+		return enhanced_prompt
+
+	# With a `filter` that matches nothing (a knowledge base built for other tags, say)
+	# the search is retried without it rather than answering with no excerpts at all,
+	# unless it's a `strict_filter`
+	def _search_knowledge_base(
+		self, query, columns=None, limit=5, filter=None, strict_filter=False
+	):
+		with self.telemetry.span('coach.search') as span:
+			columns = columns or ['CHUNK_TEXT', 'TAGS', 'REFERENCE_URL']
+			cache_key = json.dumps([query, columns, limit, filter, strict_filter])
+			results = self.search_cache.get(cache_key)
+			span.set_attribute('cache_hit', results is not None)
+
+			if results is None:
+				results = self._query_cortex_search(query, columns, limit, filter).results
+				if not results and filter and not strict_filter:
+					span.add_event('unfiltered_retry')
+					results = self._query_cortex_search(query, columns, limit).results
+				self.search_cache.set(cache_key, results)
+
+		return results
+
+	# Only chunks tagged with at least one of the video's tags. TAGS is an ARRAY
+	# attribute of the search service, see terraform/main.tf.
+	def _tag_filter(self, video_tags):
+		if not self.tag_filter or not video_tags:
+			return None
+
+		return {'@or': [{'@contains': {'TAGS': tag}} for tag in video_tags]}
+
+	# Runs a coach stage on the pipeline pool, inside the current span so its spans
+	# belong to the turn
+	def _submit_stage(self, fn, *args, **kwargs):
+		return self.pipeline_executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+	def _wait_for_stage(self, future, timeout, stage_name, default):
+		if future is None:
+			return default
+
+		try:
+			return future.result(timeout=timeout)
+		except TimeoutError:
+			# Stages still queued behind busy workers never start. One already running
+			# can't be stopped and finishes in the background.
+			future.cancel()
+			print(f'Warning: {stage_name} took longer than {timeout}s, continuing without it.')
+		except Exception as e:
+			print(f'Error: {stage_name} failed, continuing without it. {e}')
+
+		return default
+
+	# Interleave both result lists, best first, without repeating a chunk
+	def _merge_search_results(self, *result_lists, limit=5):
+		merged = []
+		seen_chunks = set()
+
+		for rank in range(max((len(results) for results in result_lists), default=0)):
+			for results in result_lists:
+				if rank < len(results) and results[rank]['CHUNK_TEXT'] not in seen_chunks:
+					seen_chunks.add(results[rank]['CHUNK_TEXT'])
+					merged.append(results[rank])
+
+		return merged[:limit]
 
 	def _log_token_usage(self, result):
 		if LOG_TOKENS:
@@ -125,6 +475,12 @@ class SnowflakeConnector:
 		except KeyError:
 			print('Error: Cortex response does not contain expected data.')
 			print(response)
+
+			self.telemetry.counter('cortex_malformed_responses_total').inc()
+			span = current_span()
+			if span is not None:
+				span.add_event('malformed_response', response=json.dumps(response)[:1000])
+
 			return ''
 
 	# ----------------
@@ -134,80 +490,342 @@ class SnowflakeConnector:
 	def generate_coach_prompt(
 		self,
 		video_tags,
-		video_transcript,
+		transcript_index,
 		user_timestamp,
 		user_question,
 		chat_history,
+		search_filter=None,
 	):
+		# A video's own search filter (see utils/video_registry.py) is a hard scope, the
+		# tag filter is only a preference and falls back to searching everything
+		strict_filter = search_filter is not None
+		search_filter = search_filter or self._tag_filter(video_tags)
+
+		def submit_search(query):
+			return self._submit_stage(
+				self._search_knowledge_base,
+				query,
+				limit=self.retrieve_limit,
+				filter=search_filter,
+				strict_filter=strict_filter,
+			)
+
+		# Start the enhancer and, speculatively, a search on the raw question right away.
+		# Everything below that doesn't need their results runs while they're in flight.
+		enhance_future = self._submit_stage(self._enhance_query, user_question)
+		raw_search_future = submit_search(user_question) if self.speculative_search else None
+
 		# We only include the user messages in the chat history because
 		# we've found that when the LLM sees images or references in the history,
 		# it tries to make up it's own. We cannot find anyway around this except
 		# to not include assistant messages in the provided chat history.
 		chat_history = [msg for msg in chat_history if msg['role'] == 'user'][-3:]
-		chart_history_str = self._generate_chat_history(chat_history)
 
-		video_tags_str = json.dumps(video_tags)
-		video_transcript_str = json.dumps(video_transcript)
-		response = self._do_simple_cortex_query(QUERY_ENHANCER_SYSTEM_PROMPT, user_question)
-		enhanced_prompt = self._safe_return_cortex_response(response)
-		rag_response = self._query_cortex_search(enhanced_prompt)
+		transcript_captions, transcript_summary = transcript_index.for_prompt(
+			user_timestamp, self.transcript_config
+		)
+
+		# A slow or failed enhancer degrades to searching with the raw question only
+		enhanced_prompt = self._wait_for_stage(
+			enhance_future, self.enhancer_timeout, 'Query enhancer', None
+		)
+		enhanced_search_future = submit_search(enhanced_prompt) if enhanced_prompt else None
+		if enhanced_search_future is None and raw_search_future is None:
+			raw_search_future = submit_search(user_question)
+
+		rag_results = self._merge_search_results(
+			self._wait_for_stage(
+				enhanced_search_future, self.search_timeout, 'Enhanced query search', []
+			),
+			self._wait_for_stage(raw_search_future, self.search_timeout, 'Raw query search', []),
+			limit=self.retrieve_limit if self.reranker else self.max_results,
+		)
+
+		# Weak excerpts only make the prompt longer, keep the ones that match the question
+		span = current_span()
+		if self.reranker:
+			retrieved = len(rag_results)
+			rag_results, rerank_scores = self.reranker.rerank(
+				f'{user_question} {enhanced_prompt or ""}', rag_results
+			)
+			if span is not None:
+				span.set_attribute('search.retrieved', retrieved)
+				span.set_attribute('search.scores', rerank_scores)
 
 		# print('\n' + enhanced_prompt)
 		# print(
 		# 	chr(10).join(
-		# 		[f"<excerpt>{chunk['CHUNK_TEXT']}</excerpt>" for chunk in rag_response.results]
+		# 		[f"<excerpt>{chunk['CHUNK_TEXT']}</excerpt>" for chunk in rag_results]
 		# 	)
 		# )
 
-		# chr(10) == \n cause f-strings get mad about backslashes
-		coach_prompt = f"""
-		<previous-user-questions>{chart_history_str}</previous-user-questions>
-		<video-tags>{video_tags_str}</video-tags>
-		<external-knowledge-base>
-		{chr(10).join([f"<excerpt>{chunk['CHUNK_TEXT']}</excerpt>" for chunk in rag_response.results])}
-		</external-knowledge-base>
-		<video-transcript>{video_transcript_str}</video-transcript>
-		<user-timestamp>{user_timestamp}</user-timestamp>
-		<user-question>{user_question}</user-question>
-		"""
+		# Highest priority first, following the priority order in COACH_SYSTEM_PROMPT:
+		# video metadata, then the transcript, then the knowledge base. When the prompt is
+		# over budget the oldest questions go first, then the oldest parts of the summary,
+		# then the lowest ranked excerpts and finally the captions furthest from the
+		# user's timestamp. The question itself is always sent.
+		knowledge_base_section = PromptSection(
+			'knowledge_base',
+			rag_results,
+			lambda items: '<external-knowledge-base>\n\t\t'
+			+ '\n'.join(f"<excerpt>{chunk['CHUNK_TEXT']}</excerpt>" for chunk in items)
+			+ '\n\t\t</external-knowledge-base>',
+			drop_order=reversed(range(len(rag_results))),
+			item_text=lambda chunk: f"<excerpt>{chunk['CHUNK_TEXT']}</excerpt>",
+		)
+		sections = [
+			PromptSection(
+				'question',
+				[user_question],
+				lambda items: f'<user-timestamp>{user_timestamp}</user-timestamp>\n\t\t'
+				f'<user-question>{"".join(items)}</user-question>',
+				required=True,
+			),
+			PromptSection(
+				'tags',
+				video_tags,
+				lambda items: f'<video-tags>{json.dumps(items)}</video-tags>',
+				drop_order=reversed(range(len(video_tags))),
+				item_text=json.dumps,
+			),
+			PromptSection(
+				'transcript',
+				transcript_captions,
+				lambda items: f'<video-transcript>{json.dumps(items)}</video-transcript>',
+				drop_order=captions_by_distance(transcript_captions, user_timestamp),
+				item_text=json.dumps,
+			),
+			knowledge_base_section,
+			PromptSection(
+				'summary',
+				transcript_summary,
+				lambda items: f'<earlier-transcript-summary>{json.dumps(items)}</earlier-transcript-summary>'
+				if items
+				else '',
+				item_text=json.dumps,
+			),
+			PromptSection(
+				'history',
+				chat_history,
+				lambda items: f'<previous-user-questions>{self._generate_chat_history(items)}</previous-user-questions>',
+				item_text=lambda message: self._generate_chat_history([message]),
+				separator_tokens=0,
+			),
+		]
+		reserved_tokens = count_tokens(COACH_SYSTEM_PROMPT) + count_tokens(
+			COACH_PROMPT_TEMPLATE.format(**{section.name: '' for section in sections})
+		)
+		section_texts, budget_report = self.prompt_budget.fit(sections, reserved_tokens)
+		coach_prompt = COACH_PROMPT_TEMPLATE.format(**section_texts)
+
+		if span is not None:
+			span.set_attribute('prompt.total_tokens', budget_report['total_tokens'])
+			for name, section_report in budget_report['sections'].items():
+				span.set_attribute(f'prompt.{name}.tokens', section_report['tokens'])
+				span.set_attribute(f'prompt.{name}.dropped', section_report['dropped'])
+		if budget_report['over_budget']:
+			print(
+				f'Warning: coach prompt is {budget_report["total_tokens"]} tokens even with '
+				f'everything optional dropped, over the budget of {budget_report["max_tokens"]}.'
+			)
 
-		reference_urls = set([chunk['REFERENCE_URL'] for chunk in rag_response.results])
-		return self._clean_prompt(coach_prompt), reference_urls
+		# Only the excerpts that made it into the prompt get referenced
+		reference_urls = set(
+			chunk['REFERENCE_URL'] for chunk in knowledge_base_section.kept_items()
+		)
+		return coach_prompt, reference_urls
 
-	def query_cortex_chat(self, prompt):
-		cursor = self.connection.cursor()
-
-		# Build query for LLM
-		# Getting the chat history into the prompt was all kinds of hard.
-		# We should be using bind variables but there seems to be no way to get
-		# a list of dictionaries into a bind variable without errors. Provide the
-		# entire list and you get an error about the "replace method" not found on the dict object.
-		# give it a JSON dumps and it gets mad about the param being a VARCHAR not and ARRAY.
-		# If you try to json dump right into the query the double quotes cause syntax errors.
-		# So we're just going to build the query string manually with a helper function.
-		cmd = f"""
-			SELECT SNOWFLAKE.CORTEX.COMPLETE(
-				'{MODEL_NAME}',
-				[
-					{{ 'role': 'system', 'content': '{self._clean_prompt(COACH_SYSTEM_PROMPT)}' }},
-					{{ 'role': 'user', 'content': '{prompt}' }}
-				], 
-				{{
-					'temperature': 0
-				}}
-			) as response;
-		"""
+	# Answers that Cortex was too busy to give don't fail the turn, the user is asked to
+	# try again instead
+	def _coach_busy_response(self, error):
+		print(f'Warning: Cortex is overloaded, asking the user to retry. {error}')
+
+		span = current_span()
+		if span is not None:
+			span.add_event('overloaded', error=f'{type(error).__name__}: {error}')
 
-		# print(cmd)
-		cursor.execute(cmd)
+		return COACH_BUSY_MESSAGE
+
+	def query_cortex_chat(self, prompt):
+		try:
+			result = self._do_simple_cortex_query(COACH_SYSTEM_PROMPT, prompt)
+		except Exception as e:
+			if not is_overload_error(e):
+				raise
+			return self._coach_busy_response(e)
 
-		response = cursor.fetchall()[0][0]
-		result = json.loads(response)
 		self._log_token_usage(result)
 
-		cursor.close()
 		return self._safe_return_cortex_response(result)
 
+	# https://docs.snowflake.com/en/user-guide/snowflake-cortex/cortex-llm-rest-api
+	# The REST API streams server-sent events, each with a delta of the response.
+	# We authenticate with the session token of our existing connection.
+	def _stream_cortex_complete(self, system_prompt, prompt):
+		# Not made current, this is a generator (see Telemetry.start_span)
+		span = self.telemetry.start_span('cortex.complete_stream', model=MODEL_NAME)
+		started = time.monotonic()
+
+		try:
+			yield from self._stream_cortex_events(system_prompt, prompt, span, started)
+		except BaseException as e:
+			span.record_error(e)
+			raise
+		finally:
+			self.telemetry.end_span(span)
+
+	def _stream_cortex_events(self, system_prompt, prompt, span, started):
+		def start_stream():
+			response = requests.post(
+				f'{self.rest_url}/api/v2/cortex/inference:complete',
+				headers={
+					'Authorization': f'Snowflake Token="{self.connection.rest.token}"',
+					'Content-Type': 'application/json',
+					'Accept': 'application/json, text/event-stream',
+				},
+				json={
+					'model': MODEL_NAME,
+					'messages': [
+						{'role': 'system', 'content': system_prompt},
+						{'role': 'user', 'content': prompt},
+					],
+					'temperature': 0,
+					'stream': True,
+				},
+				stream=True,
+				timeout=60,
+			)
+			try:
+				response.raise_for_status()
+			except requests.HTTPError:
+				response.close()
+				raise
+			return response
+
+		tokens = count_tokens(system_prompt) + count_tokens(prompt)
+
+		# The call stays admitted until the stream is read to the end
+		with (
+			self.admission.admitted(MODEL_NAME, start_stream, tokens=tokens, span=span) as response,
+			response,
+		):
+			for line in response.iter_lines(decode_unicode=True):
+				if not line or not line.startswith('data:'):
+					continue
+
+				data = line[len('data:') :].strip()
+				if data == '[DONE]':
+					break
+
+				event = json.loads(data)
+				if 'id' in event:
+					span.set_attribute('query_id', event['id'])
+				if 'usage' in event:
+					self._log_token_usage(event)
+					record_usage(span, event)
+
+				for choice in event.get('choices', []):
+					content = choice.get('delta', {}).get('content')
+					if content:
+						if 'time_to_first_token_seconds' not in span.attributes:
+							span.set_attribute(
+								'time_to_first_token_seconds', round(time.monotonic() - started, 6)
+							)
+						yield content
+
+	def stream_cortex_chat(self, prompt):
+		if not self.stream_responses:
+			yield self.query_cortex_chat(prompt)
+			return
+
+		streamed_any = False
+		try:
+			for chunk in self._stream_cortex_complete(COACH_SYSTEM_PROMPT, prompt):
+				streamed_any = True
+				yield chunk
+
+		except Exception as e:
+			# Once the user has seen part of an answer we can't start over
+			if streamed_any:
+				raise
+
+			# Falling back would only send Cortex another call it can't take
+			if is_overload_error(e):
+				yield self._coach_busy_response(e)
+				return
+
+			if not isinstance(e, requests.RequestException):
+				raise
+
+			print(f'Error: Cortex streaming failed, falling back to COMPLETE. {e}')
+			with self.telemetry.span('coach.stream_fallback', error=f'{type(e).__name__}: {e}'):
+				response = self.query_cortex_chat(prompt)
+			yield response
+
+	# Answers a coach question as a generator of response chunks, so the first tokens can
+	# be shown while the rest of the answer is still being generated. Repeat questions are
+	# answered from the answer cache. The turn's span stays open until the generator is done.
+	def stream_coach_answer(
+		self,
+		video_id,
+		video_tags,
+		transcript_index,
+		user_timestamp,
+		user_question,
+		chat_history,
+		search_filter=None,
+	):
+		turn_span = self.telemetry.start_span('coach.turn', video_id=video_id, streamed=True)
+
+		with self.telemetry.use_span(turn_span, end_on_exit=False):
+			cache_key = self.answer_cache.make_key(video_id, user_timestamp, user_question)
+			cached_answer = self.answer_cache.get(cache_key)
+			turn_span.set_attribute('cache_hit', cached_answer is not None)
+
+			if cached_answer is not None:
+				self.telemetry.end_span(turn_span)
+				return iter([cached_answer['response']]), cached_answer['reference_urls']
+
+			try:
+				with self.telemetry.span('coach.prompt'):
+					formatted_prompt, reference_urls = self.generate_coach_prompt(
+						video_tags,
+						transcript_index,
+						user_timestamp,
+						user_question,
+						chat_history,
+						search_filter,
+					)
+			except BaseException:
+				self.telemetry.end_span(turn_span)
+				raise
+
+		def stream_response():
+			chunks = []
+			chunk_stream = self.stream_cortex_chat(formatted_prompt)
+
+			try:
+				# The turn span is only current while a chunk is being produced, never
+				# across a yield, so the caller's spans don't end up inside it
+				while True:
+					with self.telemetry.use_span(turn_span, end_on_exit=False):
+						chunk = next(chunk_stream, None)
+					if chunk is None:
+						break
+
+					chunks.append(chunk)
+					yield chunk
+			finally:
+				self.telemetry.end_span(turn_span)
+
+			response = ''.join(chunks)
+			if response and response != COACH_BUSY_MESSAGE:
+				self.answer_cache.set(
+					cache_key, {'response': response, 'reference_urls': sorted(reference_urls)}
+				)
+
+		return stream_response(), reference_urls
+
 	# ----------------
 	# KNOWLEDGE BASE
 	# ----------------
@@ -232,81 +850,166 @@ class SnowflakeConnector:
 
 		return self._safe_return_cortex_response(result)
 
-	def write_knowledge_base_csv(self, knowledge_base_entries: list, output_file_path: str):
-		csv_row_queue = Queue()
-		stop_write_request = Event()
-		csv_file = open(output_file_path, 'w', newline='')  # noqa: SIM115
+	# Tags several pages in one COMPLETE call. `page_summaries` maps page hashes to
+	# summaries and the result maps page hashes to lists of tags. Pages missing from
+	# the response, or the whole batch if the response isn't valid JSON, are left out
+	# so the caller can fall back to tagging them one by one.
+	def tag_pages_with_cortex(self, available_tags: list, page_summaries: dict):
+		summaries = '\n'.join(
+			f'<wikipedia-summary id="{page_hash}">\n{summary}\n</wikipedia-summary>'
+			for page_hash, summary in page_summaries.items()
+		)
+		prompt = f"""
+			<available-keywords>
+			{','.join(available_tags)}
+			</available-keywords>
 
-		# Clear the CSV file before writing to it
-		csv_file.truncate(0)
+			{summaries}
+		"""
+		result = self._do_simple_cortex_query(KEYWORD_BATCH_SELECTOR_SYSTEM_PROMPT, prompt)
+		self._log_token_usage(result)
 
-		writer = csv.DictWriter(
-			csv_file,
-			fieldnames=['SOURCE', 'SOURCE_ID', 'CHUNK_TEXT', 'TAGS', 'REFERENCE_URL'],
-		)
-		writer.writeheader()
-
-		def write_csv():
-			while True:
-				if not stop_write_request.is_set():
-					row = csv_row_queue.get()
-					print(
-						f'Writing transformed data to {output_file_path} with reference URL: {row["REFERENCE_URL"]}'
-					)
-					writer.writerow(row)
+		# Models like to wrap JSON in a markdown code block even when asked not to
+		response = self._safe_return_cortex_response(result).strip()
+		response = response.removeprefix('```json').removeprefix('```').removesuffix('```')
 
-				else:
-					print('Queue is empty, ending write loop.')
-					break
+		try:
+			tags_by_page = json.loads(response)
+		except ValueError:
+			print('Error: Cortex did not return valid JSON when tagging pages.')
+			return {}
+
+		if not isinstance(tags_by_page, dict):
+			return {}
+
+		# Only keep tags we offered, ignoring any whitespace around them as tag_page does
+		available_tags = {tag.strip() for tag in available_tags}
+		return {
+			page_hash: [
+				tag.strip()
+				for tag in tags
+				if isinstance(tag, str) and tag.strip() in available_tags
+			]
+			for page_hash, tags in tags_by_page.items()
+			if page_hash in page_summaries and isinstance(tags, list)
+		}
 
-		csv_writer_thread = Thread(target=write_csv)
-		csv_writer_thread.daemon = True
-		csv_writer_thread.start()
-
-		with ThreadPoolExecutor(max_workers=10) as executor:
-			for index, entry in enumerate(knowledge_base_entries):
-				executor.submit(
-					self.prepare_kb_entry,
-					csv_row_queue,
-					entry,
-					f'Processing entry {index + 1} of {len(knowledge_base_entries)}',
-				)
+	# Transforms a list of entries with as few Cortex calls as possible: entries without a
+	# prompt, or already transformed according to the checkpoint, are returned as is and
+	# the rest go out in a single COMPLETE (batched if there's more than one).
+	# A failed transform keeps the original text so no row is ever dropped.
+	def transform_kb_entries(self, knowledge_base_entries: list, checkpoint: KBCheckpoint = None):
+		rows = []
+		pending_entries = []
 
-		stop_write_request.set()
-		csv_writer_thread.join()
-		csv_file.close()
+		for entry in knowledge_base_entries:
+			if not entry.get('prompt'):
+				rows.append(self._kb_row(entry, entry['CHUNK_TEXT']))
+				continue
 
-		print('Data writing complete.')
+			checkpointed_chunk_text = self._checkpointed_kb_transform(entry, checkpoint)
+			if checkpointed_chunk_text is not None:
+				rows.append(self._kb_row(entry, checkpointed_chunk_text))
+			else:
+				pending_entries.append(entry)
 
-	def prepare_kb_entry(self, queue: Queue, knowledge_base_entry: dict, hello_log: str):
-		print(hello_log)
+		if not pending_entries:
+			return rows
 
-		transformed_chunk_text = knowledge_base_entry['CHUNK_TEXT']
+		prompts = [self._kb_transform_prompt(entry) for entry in pending_entries]
+		transformed_chunk_texts = {}
 
-		if knowledge_base_entry.get('prompt'):
-			prompt = (
-				knowledge_base_entry['prompt']
-				+ ' <original-text>'
-				+ knowledge_base_entry['CHUNK_TEXT']
-				+ '</original-text>'
+		try:
+			if len(pending_entries) == 1:
+				result = self._do_simple_cortex_query(KNOWLEDGE_BASE_TRANSFORM_PROMPT, prompts[0])
+				transformed_chunk_texts[0] = self._safe_return_cortex_response(result)
+			else:
+				for index, result in self._cortex_complete_batch(
+					KNOWLEDGE_BASE_TRANSFORM_PROMPT, prompts
+				):
+					transformed_chunk_texts[index] = self._safe_return_cortex_response(result)
+
+		except Exception as e:
+			print(f'Error transforming {len(pending_entries)} entries, keeping original text. {e}')
+
+		for index, entry in enumerate(pending_entries):
+			transformed_chunk_text = transformed_chunk_texts.get(index)
+
+			# Only successful transforms are checkpointed so failures are retried next run
+			if transformed_chunk_text:
+				self._record_kb_transform(entry, transformed_chunk_text, checkpoint)
+			else:
+				transformed_chunk_text = entry['CHUNK_TEXT']
+
+			rows.append(self._kb_row(entry, transformed_chunk_text))
+
+		return rows
+
+	# Adds the transform and write stages for knowledge base entries to a pipeline.
+	# With a `batch_size` each transform call handles that many entries in one query,
+	# otherwise every entry gets its own. There's one transform worker per pooled
+	# connection, more would just wait on checkouts. `kb_writer` is any of the writers
+	# in utils/kb_writers.py.
+	def add_kb_stages(
+		self,
+		pipeline: Pipeline,
+		kb_writer: KnowledgeBaseCSVWriter | KnowledgeBaseParquetWriter,
+		batch_size: int = 0,
+		checkpoint: KBCheckpoint = None,
+	):
+		def write_row(row):
+			kb_writer.write_row(row)
+			print(
+				f'Writing transformed data to {kb_writer.output_file_path} with reference URL: {row["REFERENCE_URL"]}'
 			)
-			# print(f'Generated prompt: {prompt}')
 
-			result = self._do_simple_cortex_query(KNOWLEDGE_BASE_TRANSFORM_PROMPT, prompt)
-			transformed_chunk_text = result['choices'][0]['messages']
-			# print(f'Transformed CHUNK_TEXT: {transformed_chunk_text}')
+		return pipeline.add_stage(
+			'transform',
+			lambda entries: self.transform_kb_entries(entries, checkpoint),
+			workers=self.pool.max_size,
+			batch_size=batch_size or 1,
+		).add_stage('write', write_row)
+
+	def _kb_transform_prompt(self, knowledge_base_entry: dict):
+		return (
+			knowledge_base_entry['prompt']
+			+ ' <original-text>'
+			+ knowledge_base_entry['CHUNK_TEXT']
+			+ '</original-text>'
+		)
+
+	def _checkpointed_kb_transform(self, knowledge_base_entry: dict, checkpoint: KBCheckpoint):
+		if checkpoint is None or not knowledge_base_entry.get('CHECKPOINT_KEY'):
+			return None
 
-		transformed_entry = {
+		record = checkpoint.get('transform', knowledge_base_entry['CHECKPOINT_KEY'])
+		if record and record['input_hash'] == hash_input(
+			self._kb_transform_prompt(knowledge_base_entry)
+		):
+			return record['CHUNK_TEXT']
+
+		return None
+
+	def _record_kb_transform(
+		self, knowledge_base_entry: dict, chunk_text: str, checkpoint: KBCheckpoint
+	):
+		if checkpoint is None or not knowledge_base_entry.get('CHECKPOINT_KEY'):
+			return
+
+		checkpoint.record(
+			'transform',
+			knowledge_base_entry['CHECKPOINT_KEY'],
+			{
+				'input_hash': hash_input(self._kb_transform_prompt(knowledge_base_entry)),
+				'CHUNK_TEXT': chunk_text,
+			},
+		)
+
+	def _kb_row(self, knowledge_base_entry: dict, chunk_text: str):
+		return {
 			'SOURCE': knowledge_base_entry['SOURCE'],
 			'SOURCE_ID': knowledge_base_entry['SOURCE_ID'],
-			'CHUNK_TEXT': transformed_chunk_text,
+			'CHUNK_TEXT': chunk_text,
 			'TAGS': knowledge_base_entry['TAGS'],
 			'REFERENCE_URL': knowledge_base_entry['REFERENCE_URL'],
 		}
-
-		# print(f"\nProcessed entry: {knowledge_base_entry['SOURCE_ID']}")
-		# print(f"Processed CHUNK_TEXT: {transformed_entry['CHUNK_TEXT'][:120]}...")
-		# print(f"Tags: {transformed_entry['TAGS']}")
-		# print(f"Processed Reference URL: {transformed_entry['REFERENCE_URL']}")
-
-		queue.put(transformed_entry)
@@ -0,0 +1,21 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+
+
+# Opens a fresh connection for one transaction, committed when the block exits cleanly.
+# A connection per call keeps SQLite safe to use across threads and processes, and the
+# timeout makes writers wait on each other instead of failing.
+@contextmanager
+def sqlite_connection(path, timeout=10):
+	connection = sqlite3.connect(path, timeout=timeout)
+	try:
+		with connection:
+			yield connection
+	finally:
+		connection.close()
+
+
+def create_sqlite_dir(path):
+	if os.path.dirname(path):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
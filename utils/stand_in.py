@@ -0,0 +1,369 @@
+import hashlib
+import json
+import math
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+import requests
+
+from utils.local_search import LocalSearchResponse
+
+COMPLETE_PATH = '/api/v2/cortex/inference:complete'
+# Not a Snowflake endpoint, it stands in for the batched COMPLETE query
+COMPLETE_BATCH_PATH = '/stand-in/complete-batch'
+SEARCH_PATH_SUFFIX = ':query'
+STATS_PATH = '/stand-in/stats'
+
+
+# ----------------
+# CLIENT
+# ----------------
+# SnowflakeConnector talks to the stand-in through these when `stand_in_url` is set.
+# The connection speaks just enough DB-API for the COMPLETE statements we run (and the
+# pool's health check), turning each into a request to the stand-in server.
+class StandInCursor:
+	def __init__(self, connection):
+		self.connection = connection
+		self._rows = []
+
+	def _post(self, path, body):
+		response = self.connection.session.post(
+			f'{self.connection.base_url}{path}', json=body, timeout=self.connection.timeout
+		)
+		response.raise_for_status()
+		return response.json()
+
+	def execute(self, query, params=None):
+		params = params or []
+
+		if query.strip() == 'SELECT 1':
+			self._rows = [(1,)]
+		elif 'FROM VALUES' in query:
+			model, system_prompt, options, *rows = params
+			result = self._post(
+				COMPLETE_BATCH_PATH,
+				{
+					'model': model,
+					'system_prompt': system_prompt,
+					'options': json.loads(options),
+					'rows': [rows[i : i + 2] for i in range(0, len(rows), 2)],
+				},
+			)
+			self._rows = [(row_id, json.dumps(response)) for row_id, response in result['rows']]
+		elif 'SNOWFLAKE.CORTEX.COMPLETE' in query:
+			model, messages, options = params
+			result = self._post(
+				COMPLETE_PATH,
+				{'model': model, 'messages': json.loads(messages), **json.loads(options)},
+			)
+			self._rows = [(json.dumps(result),)]
+		else:
+			raise NotImplementedError(f'The Cortex stand-in can not run this query: {query}')
+
+		return self
+
+	def fetchall(self):
+		return self._rows
+
+	def __iter__(self):
+		return iter(self._rows)
+
+	def close(self):
+		self._rows = []
+
+
+class StandInConnection:
+	def __init__(self, base_url, timeout=60):
+		self.base_url = base_url.rstrip('/')
+		self.host = urlparse(self.base_url).netloc
+		self.rest = SimpleNamespace(token='stand-in')
+		self.timeout = timeout
+		self.session = requests.Session()
+		self._closed = False
+
+	def cursor(self):
+		return StandInCursor(self)
+
+	def is_closed(self):
+		return self._closed
+
+	def close(self):
+		self._closed = True
+		self.session.close()
+
+
+# Same `.search(...)` surface and `.results` as the Cortex Search service, over the
+# service's REST shape
+class StandInSearchService:
+	def __init__(self, base_url, database, schema, name, timeout=30):
+		self.url = (
+			f'{base_url.rstrip("/")}/api/v2/databases/{database}/schemas/{schema}'
+			f'/cortex-search-services/{name}{SEARCH_PATH_SUFFIX}'
+		)
+		self.timeout = timeout
+		self.session = requests.Session()
+
+	def search(self, query, columns, limit=5, filter=None):
+		body = {'query': query, 'columns': columns, 'limit': limit}
+		if filter:
+			body['filter'] = filter
+
+		response = self.session.post(self.url, json=body, timeout=self.timeout)
+		response.raise_for_status()
+		return LocalSearchResponse(response.json()['results'])
+
+
+# ----------------
+# SERVER
+# ----------------
+# Latencies are log-normal, which is what service latencies usually look like: most
+# calls land near `median_ms` and `sigma` stretches the tail.
+class LatencyModel:
+	def __init__(self, median_ms, sigma=0.0):
+		self.median_ms = median_ms
+		self.sigma = sigma
+
+	def sample(self, rng):
+		return self.median_ms * math.exp(self.sigma * rng.gauss(0, 1)) / 1000
+
+
+def _estimate_tokens(text):
+	return math.ceil(len(text) / 4)
+
+
+# Fakes Cortex COMPLETE (SQL and REST shapes, streamed or not) and Cortex Search.
+# Answers are deterministic: the first `responses` rule whose `match` appears in the
+# system prompt wins, otherwise the answer echoes the start of the user prompt tagged
+# with a hash of the messages. Latency, errors and throttling are drawn from a random
+# generator seeded by `seed` and the request itself, so the same requests see the same
+# latencies and failures from run to run regardless of thread scheduling.
+class CortexStandIn:
+	def __init__(
+		self,
+		complete_latency=None,
+		token_latency=None,
+		search_latency=None,
+		error_rate=0.0,
+		throttle_rate=0.0,
+		max_concurrency=0,
+		responses=(),
+		search_index=None,
+		seed=0,
+	):
+		self.complete_latency = complete_latency or LatencyModel(800, 0.4)
+		self.token_latency = token_latency or LatencyModel(15)
+		self.search_latency = search_latency or LatencyModel(120, 0.3)
+		self.error_rate = error_rate
+		self.throttle_rate = throttle_rate
+		self.max_concurrency = max_concurrency
+		self.responses = list(responses)
+		self.search_index = search_index
+		self.seed = seed
+		self.stats = {}
+		self._seen_requests = {}
+		self._in_flight = 0
+		self._lock = Lock()
+
+	def request_rng(self, body):
+		request_hash = hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()
+
+		with self._lock:
+			occurrence = self._seen_requests.get(request_hash, 0)
+			self._seen_requests[request_hash] = occurrence + 1
+
+		return random.Random(f'{self.seed}:{request_hash}:{occurrence}')
+
+	def _count(self, endpoint, outcome):
+		with self._lock:
+			endpoint_stats = self.stats.setdefault(endpoint, {})
+			endpoint_stats[outcome] = endpoint_stats.get(outcome, 0) + 1
+
+	# Returns an (HTTP status, message) to fail the request with, or None to serve it
+	def admit(self, endpoint, rng):
+		with self._lock:
+			if self.max_concurrency and self._in_flight >= self.max_concurrency:
+				throttled = True
+			else:
+				throttled = False
+				self._in_flight += 1
+
+		if not throttled and rng.random() < self.throttle_rate:
+			self.release()
+			throttled = True
+
+		if throttled:
+			self._count(endpoint, 'throttled')
+			return 429, 'Too many requests, please retry later.'
+
+		if rng.random() < self.error_rate:
+			self.release()
+			self._count(endpoint, 'errors')
+			return 500, 'Injected stand-in error.'
+
+		self._count(endpoint, 'requests')
+		return None
+
+	def release(self):
+		with self._lock:
+			self._in_flight -= 1
+
+	def answer(self, messages):
+		system_prompt = next((m['content'] for m in messages if m['role'] == 'system'), '')
+		user_prompt = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), '')
+
+		for rule in self.responses:
+			if rule['match'] in system_prompt:
+				return rule['response']
+
+		digest = hashlib.sha256(json.dumps(messages).encode()).hexdigest()[:8]
+		return f'[stand-in {digest}] ' + ' '.join(user_prompt.split()[:40])
+
+	def complete_result(self, model, messages):
+		answer = self.answer(messages)
+		prompt_tokens = sum(_estimate_tokens(message['content']) for message in messages)
+		completion_tokens = _estimate_tokens(answer)
+
+		return {
+			'choices': [{'messages': answer}],
+			'created': int(time.time()),
+			'model': model,
+			'usage': {
+				'completion_tokens': completion_tokens,
+				'prompt_tokens': prompt_tokens,
+				'total_tokens': prompt_tokens + completion_tokens,
+			},
+		}
+
+	def search(self, query, columns, limit=5, filter=None):
+		if self.search_index is not None:
+			return self.search_index.search(query, columns, limit, filter).results
+
+		# Without a knowledge base, made up chunks that are stable for each query
+		digest = hashlib.sha256(query.encode()).hexdigest()[:8]
+		results = []
+		for rank in range(limit):
+			chunk = {
+				'CHUNK_TEXT': f'Stand-in excerpt {rank} for "{query}"',
+				'TAGS': ['stand-in'],
+				'REFERENCE_URL': f'https://example.com/stand-in/{digest}/{rank}',
+			}
+			results.append({column: chunk.get(column) for column in columns})
+
+		return results
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	@property
+	def stand_in(self):
+		return self.server.stand_in
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			super().log_message(format, *args)
+
+	def _send_json(self, status, body, headers=None):
+		data = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(data)
+
+	def _send_failure(self, status, message):
+		headers = {'Retry-After': '1'} if status == 429 else None
+		self._send_json(status, {'message': message}, headers)
+
+	def _stream_complete(self, result, rng):
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/event-stream')
+		self.send_header('Connection', 'close')
+		self.end_headers()
+		self.close_connection = True
+
+		words = result['choices'][0]['messages'].split(' ')
+		for index, word in enumerate(words):
+			event = {
+				'model': result['model'],
+				'choices': [{'delta': {'content': word if index == 0 else f' {word}'}}],
+			}
+			if index == len(words) - 1:
+				event['usage'] = result['usage']
+
+			self.wfile.write(f'data: {json.dumps(event)}\n\n'.encode())
+			self.wfile.flush()
+			time.sleep(self.stand_in.token_latency.sample(rng))
+
+	def do_GET(self):
+		if self.path == STATS_PATH:
+			self._send_json(200, self.stand_in.stats)
+		else:
+			self._send_failure(404, f'Unknown stand-in path: {self.path}')
+
+	def do_POST(self):
+		body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or '{}')
+
+		if self.path == COMPLETE_PATH:
+			endpoint, latency = 'complete', self.stand_in.complete_latency
+		elif self.path == COMPLETE_BATCH_PATH:
+			endpoint, latency = 'complete_batch', self.stand_in.complete_latency
+		elif self.path.endswith(SEARCH_PATH_SUFFIX):
+			endpoint, latency = 'search', self.stand_in.search_latency
+		else:
+			self._send_failure(404, f'Unknown stand-in path: {self.path}')
+			return
+
+		rng = self.stand_in.request_rng({'path': self.path, **body})
+		failure = self.stand_in.admit(endpoint, rng)
+		if failure:
+			self._send_failure(*failure)
+			return
+
+		try:
+			time.sleep(latency.sample(rng))
+
+			if endpoint == 'complete':
+				result = self.stand_in.complete_result(body['model'], body['messages'])
+				if body.get('stream'):
+					self._stream_complete(result, rng)
+				else:
+					self._send_json(200, result)
+
+			elif endpoint == 'complete_batch':
+				rows = [
+					[
+						row_id,
+						self.stand_in.complete_result(
+							body['model'],
+							[
+								{'role': 'system', 'content': body['system_prompt']},
+								{'role': 'user', 'content': prompt},
+							],
+						),
+					]
+					for row_id, prompt in body['rows']
+				]
+				self._send_json(200, {'rows': rows})
+
+			else:
+				results = self.stand_in.search(
+					body['query'], body['columns'], body.get('limit', 5), body.get('filter')
+				)
+				self._send_json(200, {'results': results, 'request_id': 'stand-in'})
+		finally:
+			self.stand_in.release()
+
+
+def create_stand_in_server(stand_in, host='127.0.0.1', port=8765, verbose=False):
+	server = ThreadingHTTPServer((host, port), StandInRequestHandler)
+	server.daemon_threads = True
+	server.stand_in = stand_in
+	server.verbose = verbose
+	return server
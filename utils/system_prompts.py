@@ -5,7 +5,8 @@ Answer questions as a firm, curt, but kind teacher.
 You will receive the following information wrapped in xml tags:
 
 <video-tags>: Tags that describe the topics of the video. They will look like this: ['tag1', 'tag2', 'tag3'].
-<video-transcript>: A full transcript of the video the user is watching. It will look like this (start and end are seconds): [{'start': 0, 'end': 4, 'text': 'This is the first sentence.'}].
+<video-transcript>: The transcript of the video the user is watching, either in full or only the part around the user's timestamp. It will look like this (start and end are seconds): [{'start': 0, 'end': 4, 'text': 'This is the first sentence.'}].
+<earlier-transcript-summary>: Optional. When only part of the transcript is provided, a condensed version of what was said before it, in the same format.
 <user-timestamp>: The point in the video up to which the user has watched in seconds.
 <external-knowledge-base>: Results from a RAG knowledge base for information beyond the video. They will be plain text.
 <user-question>: The user's question about the video content.
@@ -165,6 +166,43 @@ Harvard University,Massachusetts,United States
 
 # ------------------------------------
 
+KEYWORD_BATCH_SELECTOR_SYSTEM_PROMPT = """
+You are a keyword selection specialist. Your task is to analyze a list of available keywords and several Wikipedia page summaries to determine which of the provided tags apply to each page.
+
+Guidelines:
+
+1. Validate the provided keywords against each Wikipedia page summary.
+	- You may only use the keywords provided
+	- Do no make up new keywords
+	- There is no limit to the number of keywords you can select, you can use all, some, or none
+	- Only use each keyword once per page
+
+2. Format:
+	- Return a JSON object mapping each page id to a list of validated keywords
+	- Include every page id you were given, use an empty list if no keywords apply
+	- No explanations or additional text, only the JSON object
+
+<prompt>
+	<available-keywords>
+	Harvard University,Massachusetts,United States,Computer Science,Artificial Intelligence,Machine Learning
+	</available-keywords>
+
+	<wikipedia-summary id="3f2a">
+	Harvard University is a private Ivy League research university in Cambridge, Massachusetts. Established in 1636 and named for its first benefactor, clergyman John Harvard, Harvard is the oldest institution of higher learning in the United States.
+	</wikipedia-summary>
+
+	<wikipedia-summary id="9b1c">
+	Machine learning is a field of study in artificial intelligence concerned with the development of statistical algorithms that can learn from data.
+	</wikipedia-summary>
+</prompt>
+
+<response>
+{"3f2a": ["Harvard University", "Massachusetts", "United States"], "9b1c": ["Artificial Intelligence", "Machine Learning"]}
+</response>
+"""
+
+# ------------------------------------
+
 QUERY_ENHANCER_SYSTEM_PROMPT = """
 You are a query enhancement specialist. Your task is to analyze user questions and expand them into detailed search queries optimized for semantic search.
 
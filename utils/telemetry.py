@@ -0,0 +1,470 @@
+import bisect
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+TELEMETRY_FILE_PATH = os.path.join(
+	os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+	'generated_files',
+	'telemetry.jsonl',
+)
+# Seconds. Covers everything from a cached search to a long COMPLETE.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_current_span = ContextVar('current_span', default=None)
+
+
+# ----------------
+# SPANS
+# ----------------
+# Follows the OpenTelemetry span model (trace and span ids, parent, attributes, events,
+# status) closely enough that exported spans can be loaded into tracing tools, without
+# depending on the SDK. Spans started while another is active become its children.
+class Span:
+	def __init__(self, name, parent=None, attributes=None, start_time_ns=None):
+		self.name = name
+		self.trace_id = parent.trace_id if parent else f'{random.getrandbits(128):032x}'
+		self.span_id = f'{random.getrandbits(64):016x}'
+		self.parent_id = parent.span_id if parent else None
+		self.attributes = dict(attributes or {})
+		self.events = []
+		self.status = 'ok'
+		self.start_time_ns = start_time_ns or time.time_ns()
+		self.end_time_ns = None
+
+	@property
+	def duration_seconds(self):
+		return ((self.end_time_ns or time.time_ns()) - self.start_time_ns) / 1e9
+
+	def set_attribute(self, key, value):
+		self.attributes[key] = value
+
+	def set_attributes(self, **attributes):
+		self.attributes.update(attributes)
+
+	def add_event(self, name, **attributes):
+		self.events.append({'name': name, 'time_ns': time.time_ns(), 'attributes': attributes})
+
+	def record_error(self, error):
+		self.status = 'error'
+		self.attributes['error'] = f'{type(error).__name__}: {error}'
+
+	def as_dict(self):
+		return {
+			'name': self.name,
+			'trace_id': self.trace_id,
+			'span_id': self.span_id,
+			'parent_id': self.parent_id,
+			'start_time_ns': self.start_time_ns,
+			'end_time_ns': self.end_time_ns,
+			'duration_seconds': round(self.duration_seconds, 6),
+			'status': self.status,
+			'attributes': self.attributes,
+			'events': self.events,
+		}
+
+
+# ----------------
+# METRICS
+# ----------------
+class Counter:
+	def __init__(self, name, help_text):
+		self.name = name
+		self.help_text = help_text
+		self.values = {}
+		self._lock = Lock()
+
+	def inc(self, amount=1, **labels):
+		key = tuple(sorted(labels.items()))
+		with self._lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+	def snapshot(self):
+		with self._lock:
+			return [{'labels': dict(key), 'value': value} for key, value in self.values.items()]
+
+
+# A value that goes up and down, like a queue's depth
+class Gauge:
+	def __init__(self, name, help_text):
+		self.name = name
+		self.help_text = help_text
+		self.values = {}
+		self._lock = Lock()
+
+	def inc(self, amount=1, **labels):
+		key = tuple(sorted(labels.items()))
+		with self._lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+	def dec(self, amount=1, **labels):
+		self.inc(-amount, **labels)
+
+	def set(self, value, **labels):
+		key = tuple(sorted(labels.items()))
+		with self._lock:
+			self.values[key] = value
+
+	def snapshot(self):
+		with self._lock:
+			return [{'labels': dict(key), 'value': value} for key, value in self.values.items()]
+
+
+class Histogram:
+	def __init__(self, name, help_text, buckets=DURATION_BUCKETS):
+		self.name = name
+		self.help_text = help_text
+		self.buckets = buckets
+		self.values = {}
+		self._lock = Lock()
+
+	def observe(self, value, **labels):
+		key = tuple(sorted(labels.items()))
+		with self._lock:
+			series = self.values.setdefault(
+				key, {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+			)
+			series['counts'][bisect.bisect_left(self.buckets, value)] += 1
+			series['sum'] += value
+			series['count'] += 1
+
+	def snapshot(self):
+		with self._lock:
+			return [
+				{
+					'labels': dict(key),
+					'buckets': dict(zip([*self.buckets, '+Inf'], series['counts'], strict=True)),
+					'sum': series['sum'],
+					'count': series['count'],
+				}
+				for key, series in self.values.items()
+			]
+
+
+# ----------------
+# EXPORTERS
+# ----------------
+def _format_labels(labels):
+	if not labels:
+		return ''
+	escaped = {
+		key: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+		for key, value in labels.items()
+	}
+	return '{' + ','.join(f'{key}="{value}"' for key, value in sorted(escaped.items())) + '}'
+
+
+# Renders the metrics in the Prometheus text format and, with a `port`, serves them
+# on /metrics for Prometheus to scrape. Only on this machine unless `host` says otherwise.
+class PrometheusExporter:
+	_servers = {}
+	_servers_lock = Lock()
+
+	def __init__(self, port=None, host='127.0.0.1'):
+		self.port = port
+		self.host = host
+		self.telemetry = None
+
+	def attach(self, telemetry):
+		self.telemetry = telemetry
+		if not self.port:
+			return
+
+		# Streamlit reruns create new connectors, only the first one binds the port
+		with PrometheusExporter._servers_lock:
+			if self.port in PrometheusExporter._servers:
+				PrometheusExporter._servers[self.port].exporter = self
+				return
+
+			exporter = self
+
+			class MetricsHandler(BaseHTTPRequestHandler):
+				def do_GET(self):
+					body = self.server.exporter.render().encode()
+					self.send_response(200)
+					self.send_header('Content-Type', 'text/plain; version=0.0.4')
+					self.send_header('Content-Length', str(len(body)))
+					self.end_headers()
+					self.wfile.write(body)
+
+				def log_message(self, format, *args):
+					pass
+
+			server = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+			server.daemon_threads = True
+			server.exporter = exporter
+			Thread(target=server.serve_forever, daemon=True, name='prometheus-exporter').start()
+			PrometheusExporter._servers[self.port] = server
+
+	def export_span(self, span):
+		pass
+
+	def render(self):
+		lines = []
+
+		for counter in self.telemetry.counters.values():
+			lines += [
+				f'# HELP {counter.name} {counter.help_text}',
+				f'# TYPE {counter.name} counter',
+			]
+			lines += [
+				f'{counter.name}{_format_labels(series["labels"])} {series["value"]}'
+				for series in counter.snapshot()
+			]
+
+		self.telemetry.collect_stats()
+		for gauge in list(self.telemetry.gauges.values()):
+			lines += [
+				f'# HELP {gauge.name} {gauge.help_text}',
+				f'# TYPE {gauge.name} gauge',
+			]
+			lines += [
+				f'{gauge.name}{_format_labels(series["labels"])} {series["value"]}'
+				for series in gauge.snapshot()
+			]
+
+		for histogram in self.telemetry.histograms.values():
+			lines += [
+				f'# HELP {histogram.name} {histogram.help_text}',
+				f'# TYPE {histogram.name} histogram',
+			]
+			for series in histogram.snapshot():
+				cumulative = 0
+				for bound, count in series['buckets'].items():
+					cumulative += count
+					labels = _format_labels({**series['labels'], 'le': bound})
+					lines.append(f'{histogram.name}_bucket{labels} {cumulative}')
+				labels = _format_labels(series['labels'])
+				lines.append(f'{histogram.name}_sum{labels} {series["sum"]}')
+				lines.append(f'{histogram.name}_count{labels} {series["count"]}')
+
+		return '\n'.join(lines) + '\n'
+
+	def flush(self):
+		pass
+
+
+# Appends every finished span to a JSON lines file, along with a snapshot of the metrics
+# on every flush and at least every `metrics_interval_seconds` while spans come in (the
+# app has no shutdown hook to flush from)
+class JSONLExporter:
+	def __init__(self, path, metrics_interval_seconds=60):
+		self.path = path
+		self.metrics_interval_seconds = metrics_interval_seconds
+		self.telemetry = None
+		self._last_flush = time.monotonic()
+		self._lock = Lock()
+
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+
+	def attach(self, telemetry):
+		self.telemetry = telemetry
+
+	def _write(self, record):
+		with self._lock, open(self.path, 'a') as f:
+			f.write(json.dumps(record, default=str) + '\n')
+
+	def export_span(self, span):
+		self._write({'type': 'span', **span.as_dict()})
+
+		if time.monotonic() - self._last_flush >= self.metrics_interval_seconds:
+			self.flush()
+
+	def flush(self):
+		self._last_flush = time.monotonic()
+		self._write({'type': 'metrics', 'time_ns': time.time_ns(), **self.telemetry.snapshot()})
+
+
+# ----------------
+# TELEMETRY
+# ----------------
+# Spans for chat turns, KB build stages and every Cortex call, and metrics aggregated
+# from them. Spans named cortex.* count as Cortex calls: their duration, model,
+# token usage, retries and errors feed the cortex_* metrics. Exporters get every span
+# as it ends and decide what to do with the aggregates.
+# Components that keep their own stats (caches, the connection pool, the video registry)
+# are watched with watch_stats and read into gauges whenever metrics are exported.
+class Telemetry:
+	def __init__(self, exporters=()):
+		self.exporters = list(exporters)
+		self.counters = {}
+		self.gauges = {}
+		self.histograms = {}
+		self._stats_sources = {}
+		self._stats_lock = Lock()
+
+		self._counter('cortex_calls_total', 'Cortex calls by operation, model and status.')
+		self._counter('cortex_tokens_total', 'Cortex tokens used by model and kind.')
+		self._counter('cortex_retries_total', 'Cortex calls retried by operation and model.')
+		self._counter('cortex_malformed_responses_total', 'Cortex responses without content.')
+		self._histogram('cortex_call_duration_seconds', 'Cortex call wall time.')
+		self._histogram('span_duration_seconds', 'Wall time of every span by name.')
+
+		# Admission control for Cortex calls, see utils/admission.py
+		self._gauge('admission_queue_depth', 'Cortex calls waiting to be admitted by lane.')
+		self._gauge('admission_in_flight', 'Admitted Cortex calls still running by lane.')
+		self._histogram('admission_wait_seconds', 'Time Cortex calls waited to be admitted.')
+		self._counter('admission_throttled_total', 'Cortex calls throttled by the service.')
+		self._counter('admission_rejected_total', 'Cortex calls given up on by lane and reason.')
+
+		for exporter in self.exporters:
+			exporter.attach(self)
+
+	def _counter(self, name, help_text):
+		self.counters[name] = Counter(name, help_text)
+
+	def _gauge(self, name, help_text):
+		self.gauges[name] = Gauge(name, help_text)
+
+	def _histogram(self, name, help_text):
+		self.histograms[name] = Histogram(name, help_text)
+
+	def counter(self, name):
+		return self.counters[name]
+
+	def gauge(self, name):
+		return self.gauges[name]
+
+	def histogram(self, name):
+		return self.histograms[name]
+
+	# Exports the numeric fields of what `stats` returns as `<name>_<field>` gauges with
+	# `labels`. Watching the same name and labels again replaces the earlier source, so
+	# objects recreated on Streamlit reruns don't pile up.
+	def watch_stats(self, name, stats, help_text, **labels):
+		with self._stats_lock:
+			self._stats_sources[(name, tuple(sorted(labels.items())))] = (stats, help_text)
+
+	def collect_stats(self):
+		with self._stats_lock:
+			sources = list(self._stats_sources.items())
+
+		for (name, labels), (stats, help_text) in sources:
+			try:
+				values = stats()
+			except Exception as e:
+				print(f'Error reading {name} stats for metrics. {e}')
+				continue
+
+			for field, value in values.items():
+				if isinstance(value, bool) or not isinstance(value, int | float):
+					continue
+
+				metric = f'{name}_{field}'
+				with self._stats_lock:
+					gauge = self.gauges.setdefault(metric, Gauge(metric, f'{help_text} ({field})'))
+				gauge.set(value, **dict(labels))
+
+	# Starts a span without making it current. Generators use this directly, since a span
+	# made current inside one would leak into whatever runs between its yields.
+	def start_span(self, name, parent=None, **attributes):
+		return Span(name, parent or _current_span.get(), attributes)
+
+	# Makes `span` the current span for the block, so spans started in it become children
+	@contextmanager
+	def use_span(self, span, end_on_exit=True):
+		token = _current_span.set(span)
+
+		try:
+			yield span
+		except BaseException as e:
+			span.record_error(e)
+			raise
+		finally:
+			_current_span.reset(token)
+			if end_on_exit:
+				self.end_span(span)
+
+	def span(self, name, **attributes):
+		return self.use_span(self.start_span(name, **attributes))
+
+	# For spans whose timing is only known afterwards, like pipeline stages
+	def add_span(self, name, start_time_ns, end_time_ns, status='ok', **attributes):
+		span = Span(name, _current_span.get(), attributes, start_time_ns)
+		span.status = status
+		self.end_span(span, end_time_ns)
+		return span
+
+	def end_span(self, span, end_time_ns=None):
+		span.end_time_ns = end_time_ns or time.time_ns()
+		self.histograms['span_duration_seconds'].observe(span.duration_seconds, span=span.name)
+
+		if span.name.startswith('cortex.'):
+			operation = span.name
+			model = span.attributes.get('model', '')
+			self.counters['cortex_calls_total'].inc(
+				operation=operation, model=model, status=span.status
+			)
+			self.histograms['cortex_call_duration_seconds'].observe(
+				span.duration_seconds, operation=operation, model=model
+			)
+			for kind in ('prompt_tokens', 'completion_tokens'):
+				if span.attributes.get(kind):
+					self.counters['cortex_tokens_total'].inc(
+						span.attributes[kind], model=model, kind=kind
+					)
+			if span.attributes.get('retries'):
+				self.counters['cortex_retries_total'].inc(
+					span.attributes['retries'], operation=operation, model=model
+				)
+
+		for exporter in self.exporters:
+			exporter.export_span(span)
+
+	def snapshot(self):
+		self.collect_stats()
+		return {
+			'counters': {name: counter.snapshot() for name, counter in self.counters.items()},
+			'gauges': {name: gauge.snapshot() for name, gauge in list(self.gauges.items())},
+			'histograms': {
+				name: histogram.snapshot() for name, histogram in self.histograms.items()
+			},
+		}
+
+	def flush(self):
+		for exporter in self.exporters:
+			exporter.flush()
+
+
+def current_span():
+	return _current_span.get()
+
+
+# Adds a Cortex result's token usage to a span
+def record_usage(span, result):
+	usage = (result or {}).get('usage') or {}
+	span.set_attributes(
+		prompt_tokens=usage.get('prompt_tokens', 0),
+		completion_tokens=usage.get('completion_tokens', 0),
+	)
+
+
+EXPORTERS = {
+	'prometheus': lambda config: PrometheusExporter(
+		port=config.get('prometheus_port'),
+		host=config.get('prometheus_host', '127.0.0.1'),
+	),
+	'jsonl': lambda config: JSONLExporter(
+		config.get('jsonl_path', TELEMETRY_FILE_PATH),
+		config.get('metrics_interval_seconds', 60),
+	),
+}
+
+
+def create_telemetry(telemetry_config):
+	exporters = []
+
+	for name in telemetry_config.get('exporters', []):
+		if name not in EXPORTERS:
+			raise ValueError(
+				f'Unknown telemetry exporter: {name}. Use one of {", ".join(EXPORTERS)}.'
+			)
+		exporters.append(EXPORTERS[name](telemetry_config))
+
+	return Telemetry(exporters)
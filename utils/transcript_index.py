@@ -0,0 +1,85 @@
+import math
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+# Transcript modes for the coach prompt:
+# - window: only captions around the user's timestamp (plus an optional summary of what came before)
+# - full: the entire transcript, which grows the prompt with the length of the video
+TRANSCRIPT_MODE_WINDOW = 'window'
+TRANSCRIPT_MODE_FULL = 'full'
+
+
+class TranscriptIndex:
+	def __init__(self, captions):
+		self.captions = sorted(captions, key=lambda caption: caption['start'])
+		self.starts = [caption['start'] for caption in self.captions]
+		self.ends = [caption['end'] for caption in self.captions]
+		# Captions can overlap a little, so search on the running max of the end
+		# times to keep the array sorted for bisect.
+		self.max_ends = list(accumulate(self.ends, max))
+
+	def __len__(self):
+		return len(self.captions)
+
+	def _range(self, start_seconds, end_seconds):
+		first = bisect_left(self.max_ends, start_seconds)
+		last = bisect_right(self.starts, end_seconds)
+		return first, last
+
+	def window(self, timestamp, before_seconds=120, after_seconds=30):
+		first, last = self._range(timestamp - before_seconds, timestamp + after_seconds)
+		return [
+			caption
+			for caption in self.captions[first:last]
+			if caption['end'] >= timestamp - before_seconds
+		]
+
+	# A cheap, local "summary" of everything before the window. Captions are grouped into
+	# sections of `section_seconds` and each section keeps only its first `max_chars`
+	# characters, which is enough for the model to know what was already covered.
+	# Sections get longer once there would be more than `max_sections` of them so the
+	# summary stays the same size no matter how far into the video the user is.
+	def summarize_before(self, timestamp, section_seconds=60, max_chars=200, max_sections=10):
+		last = bisect_left(self.max_ends, timestamp)
+		section_seconds = max(section_seconds, math.ceil(max(timestamp, 0) / max_sections))
+		sections = []
+
+		for caption in self.captions[:last]:
+			section_start = int(caption['start'] // section_seconds) * section_seconds
+
+			if not sections or sections[-1]['start'] != section_start:
+				sections.append({'start': section_start, 'end': caption['end'], 'text': ''})
+
+			section = sections[-1]
+			section['end'] = caption['end']
+			if len(section['text']) < max_chars:
+				section['text'] = f'{section["text"]} {caption["text"]}'.strip()[:max_chars]
+
+		return sections
+
+	def for_prompt(self, timestamp, transcript_config):
+		mode = transcript_config.get('mode', TRANSCRIPT_MODE_WINDOW)
+
+		if mode == TRANSCRIPT_MODE_FULL:
+			return self.captions, []
+
+		if mode != TRANSCRIPT_MODE_WINDOW:
+			raise ValueError(f'Unknown transcript mode: {mode}')
+
+		before_seconds = transcript_config.get('window_before_seconds', 120)
+		captions = self.window(
+			timestamp,
+			before_seconds=before_seconds,
+			after_seconds=transcript_config.get('window_after_seconds', 30),
+		)
+
+		summary = []
+		if transcript_config.get('summarize_earlier', True):
+			summary = self.summarize_before(
+				timestamp - before_seconds,
+				section_seconds=transcript_config.get('summary_section_seconds', 60),
+				max_chars=transcript_config.get('summary_max_chars', 200),
+				max_sections=transcript_config.get('summary_max_sections', 10),
+			)
+
+		return captions, summary
@@ -1,26 +1,172 @@
 import json
+import os
+import time
 from io import StringIO
+from threading import Lock
 
 import requests
 import webvtt
 
+MUX_STREAM_URL = 'https://stream.mux.com'
+TRANSCRIPT_CACHE_DIR = os.path.join(
+	os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'generated_files', 'transcripts'
+)
 
-def get_video_transcript(playback_id, track_id):
-	url = f'https://stream.mux.com/{playback_id}/text/{track_id}.vtt'
-	response = requests.get(url)
-	response.raise_for_status()
 
-	vtt_content = response.text
+def parse_vtt(vtt_content):
 	vtt = webvtt.from_buffer(StringIO(vtt_content))
 
-	transcript = json.dumps(
-		[
-			{
-				'start': caption.start_in_seconds,
-				'end': caption.end_in_seconds,
-				'text': caption.text,
-			}
-			for caption in vtt.captions
-		]
-	)
-	return transcript
+	return [
+		{
+			'start': caption.start_in_seconds,
+			'end': caption.end_in_seconds,
+			'text': caption.text,
+		}
+		for caption in vtt.captions
+	]
+
+
+# Keeps parsed captions in memory and on disk, keyed by playback and track ID.
+# Streamlit reruns the app on every player time update so most calls are served
+# straight from memory. Once an entry is older than `revalidate_seconds` we ask
+# Mux whether it changed with ETag/If-Modified-Since and only re-download and
+# re-parse the VTT when it did. Fetches hold a lock for their own transcript only, so a
+# slow or unreachable Mux never holds up requests for other videos.
+class TranscriptStore:
+	def __init__(
+		self,
+		cache_dir=TRANSCRIPT_CACHE_DIR,
+		base_url=MUX_STREAM_URL,
+		revalidate_seconds=300,
+		timeout=10,
+	):
+		self.cache_dir = cache_dir
+		self.base_url = base_url.rstrip('/')
+		self.revalidate_seconds = revalidate_seconds
+		self.timeout = timeout
+		self._entries = {}
+		self._fetch_locks = {}
+		self._lock = Lock()
+
+	def _url(self, playback_id, track_id):
+		return f'{self.base_url}/{playback_id}/text/{track_id}.vtt'
+
+	def _cache_path(self, playback_id, track_id):
+		return os.path.join(self.cache_dir, f'{playback_id}_{track_id}.json')
+
+	def _load_from_disk(self, playback_id, track_id):
+		try:
+			with open(self._cache_path(playback_id, track_id)) as f:
+				entry = json.load(f)
+		except (OSError, ValueError):
+			return None
+
+		# Entries loaded from disk always get revalidated once
+		entry['checked_at'] = 0
+		return entry
+
+	def _save_to_disk(self, playback_id, track_id, entry):
+		os.makedirs(self.cache_dir, exist_ok=True)
+		path = self._cache_path(playback_id, track_id)
+		tmp_path = f'{path}.tmp'
+
+		with open(tmp_path, 'w') as f:
+			json.dump(
+				{
+					'etag': entry['etag'],
+					'last_modified': entry['last_modified'],
+					'captions': entry['captions'],
+				},
+				f,
+			)
+
+		os.replace(tmp_path, path)
+
+	def _fetch(self, playback_id, track_id, cached_entry):
+		headers = {}
+		if cached_entry:
+			if cached_entry.get('etag'):
+				headers['If-None-Match'] = cached_entry['etag']
+			if cached_entry.get('last_modified'):
+				headers['If-Modified-Since'] = cached_entry['last_modified']
+
+		response = requests.get(
+			self._url(playback_id, track_id), headers=headers, timeout=self.timeout
+		)
+
+		if response.status_code == 304 and cached_entry:
+			cached_entry['checked_at'] = time.time()
+			return cached_entry, False
+
+		response.raise_for_status()
+
+		entry = {
+			'etag': response.headers.get('ETag'),
+			'last_modified': response.headers.get('Last-Modified'),
+			'captions': parse_vtt(response.text),
+			'checked_at': time.time(),
+		}
+		return entry, True
+
+	def _fresh_entry(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+
+		if entry and time.time() - entry['checked_at'] < self.revalidate_seconds:
+			return entry
+		return None
+
+	def get(self, playback_id, track_id):
+		key = (playback_id, track_id)
+
+		entry = self._fresh_entry(key)
+		if entry:
+			return entry['captions']
+
+		with self._lock:
+			fetch_lock = self._fetch_locks.setdefault(key, Lock())
+
+		with fetch_lock:
+			# Another request may have revalidated it while this one waited
+			entry = self._fresh_entry(key)
+			if entry:
+				return entry['captions']
+
+			with self._lock:
+				entry = self._entries.get(key)
+			entry = entry or self._load_from_disk(playback_id, track_id)
+
+			try:
+				entry, changed = self._fetch(playback_id, track_id, entry)
+			except requests.RequestException:
+				# Serve a stale transcript rather than failing if Mux is unreachable,
+				# and wait for the next revalidation window before trying again.
+				if not entry:
+					raise
+				entry['checked_at'] = time.time()
+				changed = False
+
+			if changed:
+				self._save_to_disk(playback_id, track_id, entry)
+
+			with self._lock:
+				self._entries[key] = entry
+			return entry['captions']
+
+	# Drops a transcript from memory. The copy on disk stays, so the next get only has to
+	# revalidate it.
+	def forget(self, playback_id, track_id):
+		with self._lock:
+			self._entries.pop((playback_id, track_id), None)
+
+
+_transcript_store = TranscriptStore()
+
+
+# Returns the parsed captions: [{'start': 0.0, 'end': 4.0, 'text': '...'}]
+def get_video_transcript(playback_id, track_id):
+	return _transcript_store.get(playback_id, track_id)
+
+
+def forget_video_transcript(playback_id, track_id):
+	_transcript_store.forget(playback_id, track_id)
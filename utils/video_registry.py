@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from threading import Lock
+
+from utils.transcript_index import TranscriptIndex
+from utils.video_details import forget_video_transcript, get_video_transcript
+
+# Rough memory cost of a caption beyond its text: the caption dict and its floats, plus
+# its entries in the TranscriptIndex arrays
+CAPTION_OVERHEAD_BYTES = 400
+# The video in [mux] is registered under this key when it has a playback_id
+DEFAULT_VIDEO_KEY = 'default'
+
+
+def estimate_transcript_bytes(captions):
+	return sum(len(caption['text']) + CAPTION_OVERHEAD_BYTES for caption in captions)
+
+
+# The videos the app can serve, from the [videos.<key>] sections of secrets.toml, picked
+# with ?video=<key>. Each video's transcript, tags and transcript index are loaded the
+# first time it's asked for and kept in memory, least recently used first out once more
+# than `max_videos` are loaded or their transcripts add up to more than `max_memory_mb`.
+# An evicted video is just loaded again (from the transcript cache on disk) when it's
+# next asked for.
+class VideoRegistry:
+	def __init__(self, videos, default_video=DEFAULT_VIDEO_KEY, max_videos=16, max_memory_mb=256):
+		self.videos = videos
+		self.default_video = default_video
+		self.max_videos = max_videos
+		self.max_memory_bytes = max_memory_mb * 1024 * 1024
+		self.memory_bytes = 0
+		self._loaded = OrderedDict()
+		self._loading_locks = {}
+		self._lock = Lock()
+
+	def __contains__(self, key):
+		return key in self.videos
+
+	def keys(self):
+		return list(self.videos)
+
+	def _load(self, key, captions):
+		video = self.videos[key]
+
+		return {
+			'key': key,
+			# Answers are cached per playback ID, see AnswerCache
+			'video_id': video['playback_id'],
+			'playback_id': video['playback_id'],
+			'track_id': video['track_id'],
+			'video_title': video.get('video_title', ''),
+			'video_description': video.get('video_description', ''),
+			'video_tags': video.get('video_tags', []),
+			# Cortex Search filter for this video's excerpts. Without one, searches are
+			# scoped to chunks sharing a tag with the video.
+			'search_filter': video.get('search_filter'),
+			'captions': captions,
+			'transcript_index': TranscriptIndex(captions),
+			'memory_bytes': estimate_transcript_bytes(captions),
+		}
+
+	# Evicts the least recently used videos, never the one just loaded
+	def _evict(self):
+		while len(self._loaded) > 1 and (
+			len(self._loaded) > self.max_videos or self.memory_bytes > self.max_memory_bytes
+		):
+			_, evicted = self._loaded.popitem(last=False)
+			self.memory_bytes -= evicted['memory_bytes']
+			forget_video_transcript(evicted['playback_id'], evicted['track_id'])
+
+	def get(self, key=None):
+		key = key or self.default_video
+		if key not in self.videos:
+			raise KeyError(f'Unknown video: {key}')
+
+		video = self.videos[key]
+
+		# One load per video at a time, without holding up requests for other videos
+		with self._lock:
+			loading_lock = self._loading_locks.setdefault(key, Lock())
+
+		with loading_lock:
+			# The transcript store serves the same captions list from memory until the
+			# transcript changes on Mux, so a different list means a rebuild
+			captions = get_video_transcript(video['playback_id'], video['track_id'])
+
+			with self._lock:
+				context = self._loaded.get(key)
+				if context is not None and context['captions'] is captions:
+					self._loaded.move_to_end(key)
+					return context
+
+			context = self._load(key, captions)
+
+			with self._lock:
+				previous = self._loaded.pop(key, None)
+				if previous is not None:
+					self.memory_bytes -= previous['memory_bytes']
+
+				self._loaded[key] = context
+				self.memory_bytes += context['memory_bytes']
+				self._evict()
+
+		return context
+
+	def stats(self):
+		with self._lock:
+			return {
+				'videos': len(self.videos),
+				'loaded': list(self._loaded),
+				'memory_bytes': self.memory_bytes,
+			}
+
+
+def create_video_registry(streamlit_secrets):
+	videos = {key: dict(video) for key, video in streamlit_secrets.get('videos', {}).items()}
+
+	# Single video setups only have [mux]
+	mux_config = streamlit_secrets.get('mux', {})
+	if mux_config.get('playback_id') and DEFAULT_VIDEO_KEY not in videos:
+		videos[DEFAULT_VIDEO_KEY] = dict(mux_config)
+
+	registry_config = streamlit_secrets.get('video_registry', {})
+	return VideoRegistry(
+		videos,
+		default_video=registry_config.get('default_video', DEFAULT_VIDEO_KEY),
+		max_videos=registry_config.get('max_videos', 16),
+		max_memory_mb=registry_config.get('max_memory_mb', 256),
+	)
@@ -0,0 +1,251 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from utils.rate_limit import TokenBucket
+
+WIKIPEDIA_API_URL = 'https://en.wikipedia.org/w/api.php'
+USER_AGENT = 'rag-n-roll-ai-video (https://polarlabs.ca)'
+# Most titles the API takes in one query
+TITLES_PER_QUERY = 50
+
+
+class PageError(Exception):
+	pass
+
+
+class DisambiguationError(Exception):
+	pass
+
+
+# Fetches Wikipedia pages for a list of keywords straight from the MediaWiki API.
+# Searches and page fetches run concurrently, but every request first takes a token
+# from a shared bucket so the whole harvest stays within `requests_per_second`.
+# Titles returned for more than one keyword are only fetched once, and each page
+# costs two requests: one for the text, url and disambiguation flag, one for images.
+# Point `api_url` at a local stand-in (see utils/wiki_stand_in.py) to run it without
+# hitting Wikipedia.
+class WikipediaHarvester:
+	def __init__(
+		self,
+		api_url=WIKIPEDIA_API_URL,
+		requests_per_second=5,
+		burst=None,
+		max_workers=8,
+		results_per_search=5,
+		timeout=30,
+	):
+		self.api_url = api_url
+		self.limiter = TokenBucket(requests_per_second, burst)
+		self.max_workers = max_workers
+		self.results_per_search = results_per_search
+		self.timeout = timeout
+		self.session = requests.Session()
+		self.session.headers['User-Agent'] = USER_AGENT
+
+	def _request(self, params):
+		self.limiter.acquire()
+
+		response = self.session.get(
+			self.api_url,
+			params={'format': 'json', 'formatversion': 2, 'action': 'query', **params},
+			timeout=self.timeout,
+		)
+		response.raise_for_status()
+		return response.json()
+
+	def _continued_request(self, params):
+		continue_params = {}
+
+		while True:
+			result = self._request({**params, **continue_params})
+			yield result
+
+			if 'continue' not in result:
+				break
+			continue_params = result['continue']
+
+	def search(self, keyword):
+		result = self._request(
+			{
+				'list': 'search',
+				'srsearch': keyword,
+				'srlimit': self.results_per_search,
+				'srprop': '',
+			}
+		)
+		return [
+			item['title']
+			for item in result['query']['search']
+			if '(disambiguation)' not in item['title']
+		]
+
+	def fetch_page(self, title):
+		result = self._request(
+			{
+				'titles': title,
+				'prop': 'extracts|info|pageprops',
+				'explaintext': 1,
+				'inprop': 'url',
+				'ppprop': 'disambiguation',
+				'redirects': 1,
+			}
+		)
+		page = result['query']['pages'][0]
+
+		if page.get('missing') or page.get('invalid'):
+			raise PageError(title)
+		if 'disambiguation' in page.get('pageprops', {}):
+			raise DisambiguationError(title)
+
+		images = []
+		for image_result in self._continued_request(
+			{
+				'titles': page['title'],
+				'generator': 'images',
+				'gimlimit': 'max',
+				'prop': 'imageinfo',
+				'iiprop': 'url',
+			}
+		):
+			images.extend(
+				image['imageinfo'][0]['url']
+				for image in image_result.get('query', {}).get('pages', [])
+				if image.get('imageinfo')
+			)
+
+		content = page.get('extract', '')
+		return {
+			'title': page['title'],
+			'content': content,
+			# The summary is the intro of the page, everything before the first section
+			'summary': content.split('\n\n\n==', 1)[0].strip(),
+			'url': page['fullurl'],
+			'images': images,
+			'revision': page.get('lastrevid'),
+		}
+
+	# Returns the current revision ID of each title, following redirects the way
+	# fetch_page does, with one query per TITLES_PER_QUERY titles. Titles that are
+	# missing, or whose query failed, are left out.
+	def latest_revisions(self, titles):
+		revisions = {}
+
+		for start in range(0, len(titles), TITLES_PER_QUERY):
+			batch = titles[start : start + TITLES_PER_QUERY]
+			try:
+				result = self._request({'titles': '|'.join(batch), 'prop': 'info', 'redirects': 1})
+			except Exception as e:
+				print(f'Error checking Wikipedia for page changes, keeping fetched pages. {e}')
+				continue
+
+			query = result.get('query', {})
+			renamed = {
+				item['from']: item['to']
+				for item in [*query.get('normalized', []), *query.get('redirects', [])]
+			}
+			page_revisions = {
+				page['title']: page['lastrevid']
+				for page in query.get('pages', [])
+				if page.get('lastrevid')
+			}
+
+			for title in batch:
+				page_title = title
+				# A title can be normalized and then redirected
+				while page_title in renamed and renamed[page_title] != page_title:
+					page_title = renamed[page_title]
+				if page_title in page_revisions:
+					revisions[title] = page_revisions[page_title]
+
+		return revisions
+
+	def _search_keyword(self, keyword):
+		print(f'Searching Wikipedia for keyword: {keyword}')
+		try:
+			return self.search(keyword)
+		except Exception as e:
+			print(f'Error searching Wikipedia for keyword: {keyword}. {e}')
+			return []
+
+	def _fetch_page_entry(self, title):
+		print(f'Processing result: {title}')
+		try:
+			wiki_page = self.fetch_page(title)
+		except DisambiguationError:
+			print(f'DisambiguationError for result: {title}')
+			return None, {'title': title, 'error': 'DisambiguationError'}
+		except PageError:
+			print(f'PageError for result: {title}')
+			return None, {'title': title, 'error': 'PageError'}
+		except Exception as e:
+			print(f'Unexpected error fetching result: {title}')
+			return None, {'title': title, 'error': e.__str__()}
+
+		page_content = f'{wiki_page["title"]}\n{wiki_page["content"]}'
+		page_hash = hashlib.sha256(page_content.encode()).hexdigest()
+		print(f'Fetched page {wiki_page["title"]} with hash: {page_hash}')
+
+		return (
+			page_hash,
+			{
+				'page_content': page_content,
+				'page_summary': wiki_page['summary'],
+				'images': wiki_page['images'],
+				'page_url': wiki_page['url'],
+				'page_tags': [],
+			},
+			wiki_page['revision'],
+		), None
+
+	# Searches every keyword and returns the unique titles, in the order they were found
+	def search_titles(self, keywords):
+		titles = []
+		seen_titles = set()
+
+		with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			for keyword, search_results in zip(
+				keywords, executor.map(self._search_keyword, keywords), strict=True
+			):
+				print(
+					f'Found {len(search_results)} results for keyword: {keyword}: {search_results}'
+				)
+
+				for title in search_results:
+					if title not in seen_titles:
+						seen_titles.add(title)
+						titles.append(title)
+
+		return titles
+
+	# Returns a list with the (page hash, page info) pair for `title`, or an empty list
+	# if it couldn't be fetched (the failure is added to `failed_pages`). With a
+	# checkpoint, titles fetched by an earlier run are reused and newly fetched pages
+	# are recorded as soon as they arrive. A recorded page is fetched again when
+	# `latest_revisions` (from the method of the same name) has a different revision
+	# for it, so edited pages get a new hash and go through the rest of the build.
+	def fetch_title(self, title, checkpoint=None, failed_pages=None, latest_revisions=None):
+		fetched = checkpoint.get('fetch', title) if checkpoint else None
+		latest_revision = (latest_revisions or {}).get(title)
+		if fetched and latest_revision in (None, fetched.get('revision')):
+			print(f'Page {title} already fetched.')
+			return [(fetched['page_hash'], fetched['page_info'])]
+		if fetched:
+			print(f'Page {title} changed on Wikipedia, fetching it again.')
+
+		page, failure = self._fetch_page_entry(title)
+		if failure:
+			if failed_pages is not None:
+				failed_pages.append(failure)
+			return []
+
+		page_hash, page_info, revision = page
+		if checkpoint:
+			checkpoint.record(
+				'fetch',
+				title,
+				{'page_hash': page_hash, 'page_info': page_info, 'revision': revision},
+			)
+
+		return [(page_hash, page_info)]
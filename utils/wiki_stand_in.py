@@ -0,0 +1,156 @@
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from urllib.parse import parse_qs, urlparse
+
+# Most titles the real API takes in one query, the rest are dropped with a warning
+MAX_TITLES = 50
+
+
+def normalize_title(title):
+	title = title.replace('_', ' ').strip()
+	return title[:1].upper() + title[1:]
+
+
+# Fakes the parts of the MediaWiki API that WikipediaHarvester uses: search, page
+# extracts with info and page props, batched info queries and the images generator,
+# all in the formatversion=2 shape. Titles are normalized and redirects followed like
+# the real API does, and images come back `images_per_response` at a time with a
+# `continue` token so clients have to page through them.
+# `pages` maps titles to {'content', 'revision', 'images', 'disambiguation'} and
+# `redirects` maps titles to the title they redirect to. Every query's parameters are
+# kept in `requests`.
+class WikipediaStandIn:
+	def __init__(self, pages, redirects=None, images_per_response=2):
+		self.pages = {title: {'revision': 1, 'images': [], **page} for title, page in pages.items()}
+		self.redirects = dict(redirects or {})
+		self.images_per_response = images_per_response
+		self.requests = []
+		self._lock = Lock()
+
+	def _resolve(self, titles, follow_redirects):
+		normalized = []
+		redirects = []
+		resolved = []
+
+		for title in titles:
+			page_title = normalize_title(title)
+			if page_title != title:
+				normalized.append({'fromencoded': False, 'from': title, 'to': page_title})
+			if follow_redirects and page_title in self.redirects:
+				redirects.append({'from': page_title, 'to': self.redirects[page_title]})
+				page_title = self.redirects[page_title]
+			if page_title not in resolved:
+				resolved.append(page_title)
+
+		return normalized, redirects, resolved
+
+	def _page(self, title, props, params):
+		page = self.pages.get(title)
+		if page is None:
+			return {'ns': 0, 'title': title, 'missing': True}
+
+		result = {'pageid': list(self.pages).index(title) + 1, 'ns': 0, 'title': title}
+		if 'info' in props:
+			result['lastrevid'] = page['revision']
+			if 'url' in params.get('inprop', ''):
+				result['fullurl'] = f'https://en.wikipedia.org/wiki/{title.replace(" ", "_")}'
+		if 'extracts' in props:
+			result['extract'] = page['content']
+		if 'pageprops' in props and page.get('disambiguation'):
+			result['pageprops'] = {'disambiguation': ''}
+
+		return result
+
+	def _search(self, params):
+		keyword = params['srsearch'].lower()
+		limit = int(params.get('srlimit', 10))
+		titles = [
+			title
+			for title, page in self.pages.items()
+			if keyword in title.lower() or keyword in page['content'].lower()
+		]
+		return {'query': {'search': [{'ns': 0, 'title': title} for title in titles[:limit]]}}
+
+	def _images(self, title, params):
+		page = self.pages.get(title)
+		images = page['images'] if page else []
+		offset = int(params.get('gimcontinue', 0))
+		batch = images[offset : offset + self.images_per_response]
+
+		result = {'batchcomplete': True}
+		if batch:
+			result['query'] = {
+				'pages': [
+					{
+						'ns': 6,
+						'title': f'File:{image}',
+						'imageinfo': [{'url': f'https://upload.wikimedia.org/{image}'}],
+					}
+					for image in batch
+				]
+			}
+		if offset + len(batch) < len(images):
+			result['continue'] = {
+				'gimcontinue': str(offset + len(batch)),
+				'continue': 'gimcontinue||',
+			}
+
+		return result
+
+	def query(self, params):
+		with self._lock:
+			self.requests.append(params)
+
+		if params.get('list') == 'search':
+			return self._search(params)
+
+		titles = params.get('titles', '').split('|')
+		normalized, redirects, resolved = self._resolve(
+			titles[:MAX_TITLES], follow_redirects='redirects' in params
+		)
+
+		if params.get('generator') == 'images':
+			return self._images(resolved[0], params)
+
+		props = params.get('prop', '').split('|')
+		query = {'pages': [self._page(title, props, params) for title in resolved]}
+		if normalized:
+			query['normalized'] = normalized
+		if redirects:
+			query['redirects'] = redirects
+
+		result = {'batchcomplete': True, 'query': query}
+		if len(titles) > MAX_TITLES:
+			result['warnings'] = {
+				'query': {'warnings': f'Too many values supplied for titles, {MAX_TITLES} allowed.'}
+			}
+		return result
+
+
+class WikipediaStandInRequestHandler(BaseHTTPRequestHandler):
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		params = {key: values[-1] for key, values in parse_qs(urlparse(self.path).query).items()}
+
+		if params.get('action') != 'query' or params.get('format') != 'json':
+			status, body = 400, {'error': {'code': 'badparams', 'info': 'Only action=query'}}
+		else:
+			status, body = 200, self.server.stand_in.query(params)
+
+		data = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+
+# Serves the stand-in at http://<host>:<port>/w/api.php (any path works)
+def create_wikipedia_stand_in_server(stand_in, host='127.0.0.1', port=0):
+	server = ThreadingHTTPServer((host, port), WikipediaStandInRequestHandler)
+	server.daemon_threads = True
+	server.stand_in = stand_in
+	return server